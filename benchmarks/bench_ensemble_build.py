@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+"""Time building MD workflows for ensembles of increasing size.
+
+Usage::
+
+    python benchmarks/bench_ensemble_build.py [--sizes 10 100 1000]
+
+Creates throwaway Sims in a temporary directory and, for each ensemble size,
+times building every workflow with one ``make_md_workflow`` call per Sim
+against a single ``make_md_workflows`` call. No LaunchPad is needed.
+
+"""
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def main():
+    import mdsynthesis as mds
+    from mdworks.general import make_md_workflow, make_md_workflows
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    stages = [{'server': 'cluster{}'.format(i), 'user': 'me',
+               'staging': '/scratch/staging'} for i in range(4)]
+    files = ['md.tpr', 'md.cpt', 'md_prev.cpt', 'md.log', 'index.ndx']
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sims = [mds.Sim(os.path.join(tmpdir, 'sim{:05d}'.format(i))).abspath
+                for i in range(max(args.sizes))]
+
+        print('{:>8} {:>14} {:>14} {:>8}'.format(
+            'sims', 'per-Sim (s)', 'bulk (s)', 'speedup'))
+        for n in args.sizes:
+            members = sims[:n]
+
+            t0 = time.time()
+            for sim in members:
+                make_md_workflow(sim, sim, stages, files)
+            single = time.time() - t0
+
+            t0 = time.time()
+            wfs = make_md_workflows(members, members, stages, files)
+            bulk = time.time() - t0
+            assert len(wfs) == n
+
+            print('{:>8} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(
+                n, single, bulk, single / bulk))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+"""Compare the native CPT/TPR header readers against ``gmx dump``.
+
+Usage::
+
+    python benchmarks/bench_gromacs_headers.py md.cpt md.tpr [-n 5]
+
+Reports the best wall time over ``-n`` repeats of reading the checkpoint step
+and TPR nsteps each way, and checks that both give the same values. Use the
+checkpoint and run input of a representative (ideally large) system.
+
+"""
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def best_of(n, func):
+    times = []
+    for i in range(n):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+def dump_step(cpt):
+    import gromacs
+    out = gromacs.dump(cp=cpt, stdout=False)
+    return int([line.split(' ')[-1] for line in out[1].split('\n')
+                if 'step = ' in line][0])
+
+
+def dump_nsteps(tpr):
+    import gromacs
+    out = gromacs.dump(s=tpr, stdout=False)
+    return int([line.split(' ')[-1] for line in out[1].split('\n')
+                if 'nsteps' in line][0])
+
+
+def main():
+    from mdworks.gromacs.xdr import read_cpt_header, tpr_nsteps, _dump_nsteps
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('cpt')
+    parser.add_argument('tpr')
+    parser.add_argument('-n', type=int, default=5, help='repeats')
+    args = parser.parse_args()
+
+    # work on a copy so the nsteps cache starts cold and stays out of the way
+    tmpdir = tempfile.mkdtemp()
+    tpr = os.path.join(tmpdir, os.path.basename(args.tpr))
+    shutil.copy2(args.tpr, tpr)
+
+    try:
+        rows = [
+            ('cpt step, gmx dump', best_of(args.n, lambda: dump_step(args.cpt))),
+            ('cpt step, native', best_of(args.n, lambda: read_cpt_header(args.cpt)['step'])),
+            ('tpr nsteps, gmx dump', best_of(args.n, lambda: dump_nsteps(tpr))),
+            ('tpr nsteps, streamed dump', best_of(args.n, lambda: _dump_nsteps(tpr))),
+            ('tpr nsteps, cold cache', best_of(1, lambda: tpr_nsteps(tpr))),
+            ('tpr nsteps, warm cache', best_of(args.n, lambda: tpr_nsteps(tpr))),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for name, (seconds, value) in rows:
+        print('{:<28} {:>10.4f} s   -> {}'.format(name, seconds, value))
+
+    assert rows[0][1][1] == rows[1][1][1], "step mismatch"
+    assert len(set(r[1][1] for r in rows[2:])) == 1, "nsteps mismatch"
+
+
+if __name__ == '__main__':
+    main()
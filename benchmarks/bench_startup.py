@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+"""Time importing mdworks modules and the first run of light tasks.
+
+Usage::
+
+    python benchmarks/bench_startup.py [-n 5] [--budget 50] [--importtime]
+
+Each measurement runs in a fresh interpreter, as a rocket deserializing an
+mdworks task would, and the median and best over ``-n`` repeats are shown.
+Import times are given in total and beyond importing fireworks itself, which
+every FireTask needs anyway; heavy imports fireworks makes itself are not
+counted against mdworks. First-run latency covers importing the task's
+module, deserializing the task and running it once on throwaway directories.
+
+Heavy dependencies that only some tasks need (mdsynthesis, GromacsWrapper,
+paramiko, ...) must not be imported by merely loading a task module or
+running a task that doesn't use them; any that are get listed, and make the
+script exit with status 1, as does any import exceeding ``--budget``
+milliseconds beyond fireworks. With ``--importtime``, the slowest imports
+below each module are listed, as reported by ``python -X importtime``.
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+#: checkout holding this script, benchmarked whether or not it is installed
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+#: dependencies to be imported only by the tasks that use them
+LAZY = ('mdsynthesis', 'MDAnalysis', 'gromacs', 'paramiko', 'numpy', 'yaml')
+
+MODULES = ['mdworks.transfer', 'mdworks.ssh', 'mdworks.metrics',
+           'mdworks.status', 'mdworks.firetasks', 'mdworks.gromacs.firetasks',
+           'mdworks.general']
+
+# task name -> (module, class, params, setup code run before timing)
+TASKS = {
+    'BeaconTask': ('mdworks.firetasks', 'BeaconTask', {'uuid': 'sim'}, ''),
+    'LiveSyncStopTask': ('mdworks.firetasks', 'LiveSyncStopTask',
+                         {'uuid': 'sim'}, ''),
+    'Stage2RunDirTask': (
+        'mdworks.firetasks', 'Stage2RunDirTask', {'uuid': 'sim'},
+        "os.makedirs(os.path.join(os.environ['STAGING'], 'sim'))\n"
+        "for name in ('md.tpr', 'md.cpt'):\n"
+        "    with open(os.path.join(os.environ['STAGING'], 'sim', name),"
+        " 'wb') as f:\n"
+        "        f.write(b'0' * 4096)\n"),
+    'GromacsXTCAggregateTask': ('mdworks.gromacs.firetasks',
+                                'GromacsXTCAggregateTask',
+                                {'archive': '{tmp}'}, ''),
+}
+
+IMPORT = """
+import sys, time, json
+t0 = time.time()
+import {module}
+t = time.time() - t0
+print(json.dumps({{'seconds': t, 'fireworks': 'fireworks' in sys.modules,
+                  'lazy': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+FIRST_RUN = """
+import os, sys, time, json
+{setup}
+t0 = time.time()
+from {module} import {cls}
+task = {cls}.from_dict({cls}({params!r}).to_dict())
+t1 = time.time()
+task.run_task({{}})
+t = time.time()
+print(json.dumps({{'seconds': t - t0, 'load': t1 - t0, 'run': t - t1,
+                  'lazy': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def checkout_env(env=None):
+    """`env`, or else ours, with the checkout first on the module path."""
+    env = dict(os.environ if env is None else env)
+    env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return env
+
+
+def run(code, env=None):
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  env=checkout_env(env))
+    return json.loads(out.decode('utf-8').strip().split('\n')[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def importtime(module, top=8):
+    """Slowest imports below `module`, by cumulative time."""
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import {}'.format(module)],
+                            stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                            env=checkout_env())
+    _, err = proc.communicate()
+    rows = []
+    for line in err.decode('utf-8').split('\n'):
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=5, help="repeats")
+    parser.add_argument('--budget', type=float,
+                        help="fail if any import takes longer than this many "
+                        "milliseconds beyond importing fireworks")
+    parser.add_argument('--importtime', action='store_true',
+                        help="list the slowest imports below each module")
+    args = parser.parse_args()
+
+    failed = False
+
+    base = [run(IMPORT.format(module='fireworks', lazy=LAZY))
+            for i in range(args.n)]
+    # heavy imports of fireworks itself are no concern of ours
+    ours = [m for m in LAZY if m not in base[0]['lazy']]
+    base = [r['seconds'] for r in base]
+    print('{:<28} {:>10} {:>10} {:>12}  {}'.format(
+        'import', 'median ms', 'best ms', 'own ms', 'eager heavy imports'))
+    print('{:<28} {:>10.1f} {:>10.1f} {:>12}'.format(
+        'fireworks', 1e3 * median(base), 1e3 * min(base), '-'))
+
+    for module in MODULES:
+        results = [run(IMPORT.format(module=module, lazy=LAZY))
+                   for i in range(args.n)]
+        times = [r['seconds'] for r in results]
+        own = 1e3 * (median(times) -
+                     (median(base) if results[0]['fireworks'] else 0))
+        lazy = [m for m in results[0]['lazy'] if m in ours]
+        print('{:<28} {:>10.1f} {:>10.1f} {:>12.1f}  {}'.format(
+            module, 1e3 * median(times), 1e3 * min(times), own,
+            ', '.join(lazy) or '-'))
+
+        if lazy or (args.budget is not None and own > args.budget):
+            failed = True
+
+        if args.importtime:
+            for us, name in importtime(module):
+                print('    {:>10.1f} {}'.format(us / 1e3, name))
+
+    print()
+    print('{:<28} {:>10} {:>10} {:>12}  {}'.format(
+        'first run', 'median ms', 'load ms', 'run ms', 'eager heavy imports'))
+    for name, (module, cls, params, setup) in sorted(TASKS.items()):
+        results = []
+        for i in range(args.n):
+            tmp = tempfile.mkdtemp()
+            try:
+                env = dict(os.environ,
+                           STAGING=os.path.join(tmp, 'staging'),
+                           SCRATCHDIR=os.path.join(tmp, 'scratch'),
+                           HOST='localhost', USER='bench')
+                os.makedirs(env['SCRATCHDIR'])
+                task_params = {k: v.format(tmp=tmp) for k, v in params.items()}
+                results.append(run(FIRST_RUN.format(
+                    module=module, cls=cls, params=task_params, setup=setup,
+                    lazy=LAZY), env=env))
+            finally:
+                shutil.rmtree(tmp)
+
+        lazy = [m for m in results[0]['lazy'] if m in ours]
+        print('{:<28} {:>10.1f} {:>10.1f} {:>12.1f}  {}'.format(
+            name, 1e3 * median([r['seconds'] for r in results]),
+            1e3 * median([r['load'] for r in results]),
+            1e3 * median([r['run'] for r in results]),
+            ', '.join(lazy) or '-'))
+        if lazy:
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
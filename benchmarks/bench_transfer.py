@@ -0,0 +1,316 @@
+#! /usr/bin/env python
+"""Time the staging, pull and cleanup tasks against a local SFTP stand-in.
+
+Usage::
+
+    python benchmarks/bench_transfer.py [--sims 2] [--latency 0.02]
+        [--bandwidth 100] [--batch] [--streams 4] [--cache] [--fetch]
+        [--no-verify] [--no-exec] [--compare 200] [--json results.json]
+
+Starts an in-process SSH/SFTP server on localhost (see ``tests/sftp_standin.py``)
+behind a proxy adding ``--latency`` seconds each way and limiting each
+connection to ``--bandwidth`` MB/s, builds synthetic Sims with a few large
+and many small files, and runs for each Sim in turn
+
+    staging       ``StagingTask`` sending the inputs to the staging area
+    stage2rundir  ``Stage2RunDirTask`` placing them in the rundir, fetching
+                  them from the archive with ``--fetch`` (and then skipping
+                  staging)
+    pull          ``FilePullTask`` bringing the rundir, now also holding
+                  synthetic outputs, back into an archive
+    cleanup       ``CleanupTask`` removing the rundir; with ``--background``,
+                  removals still running at the end are waited for, untimed,
+                  before the stand-in stops
+
+Each phase reports its wall time, payload moved and throughput, and the SFTP
+requests, exec channels, connections and bytes the server saw; requests
+approximate round trips, although pipelined ones overlap. Save results with
+``--json`` to compare runs before and after a change. The mdworks checkout
+holding this script is benchmarked, whether or not mdworks is installed.
+
+With ``--compare MB``, a single file of that size is instead sent and fetched
+with paramiko's plain ``put``/``get`` and with :func:`mdworks.transfer.put`
+and :func:`~mdworks.transfer.get` under the given task options, to check the
+chunked engine against what it replaces.
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+# run from a checkout, without installing mdworks; the stand-in lives with
+# the tests, which use it too
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+from sftp_standin import Standin  # noqa: E402
+
+PHASES = ('staging', 'stage2rundir', 'pull', 'cleanup')
+
+#: phases of ``--compare``
+COMPARE = ('sftp.put', 'put', 'sftp.get', 'get')
+
+#: small inputs of a typical Sim: topology, includes, index and parameters
+SMALL_INPUTS = ['topol.top', 'index.ndx', 'md.mdp', 'posre.itp']
+
+#: small outputs of a typical leg besides backups and analysis files
+SMALL_OUTPUTS = ['md.gro', 'confout.gro', 'mdout.mdp']
+
+
+def write(path, nbytes):
+    """Write `nbytes` of incompressible data to `path`."""
+    with open(path, 'wb') as f:
+        while nbytes > 0:
+            block = min(nbytes, 1 << 22)
+            f.write(os.urandom(block))
+            nbytes -= block
+
+
+def make_inputs(archive, args):
+    """Inputs of one Sim in `archive`; returns their paths."""
+    os.makedirs(archive)
+    sizes = {'md.tpr': args.tpr_mb << 20, 'md.cpt': args.cpt_mb << 20}
+    for i in range(args.small_inputs):
+        name = SMALL_INPUTS[i % len(SMALL_INPUTS)]
+        if i >= len(SMALL_INPUTS):
+            name = 'mol{}.itp'.format(i)
+        sizes[name] = 1024 * (2 + (i * 37) % 62)
+
+    for name, size in sizes.items():
+        write(os.path.join(archive, name), size)
+    return sorted(os.path.join(archive, name) for name in sizes)
+
+
+def make_outputs(rundir, args):
+    """Outputs of one leg of MD, added to `rundir`."""
+    for i, ext in enumerate(['xtc', 'trr'][:args.trajectories]):
+        write(os.path.join(rundir, 'md.' + ext), args.traj_mb << 20)
+    for i in range(args.trajectories - 2):
+        write(os.path.join(rundir, 'md.part{:04d}.xtc'.format(i + 2)),
+              args.traj_mb << 20)
+
+    write(os.path.join(rundir, 'md.edr'), 2 << 20)
+    write(os.path.join(rundir, 'md.log'), 1 << 20)
+    write(os.path.join(rundir, 'md_prev.cpt'), args.cpt_mb << 20)
+    for i in range(args.small_outputs):
+        name = (SMALL_OUTPUTS[i] if i < len(SMALL_OUTPUTS)
+                else 'pullx{}.xvg'.format(i))
+        write(os.path.join(rundir, name), 1024 * (1 + (i * 13) % 40))
+
+
+def transfer_bytes(stored):
+    """Payload bytes a task reports having moved."""
+    # kept per Sim, as e.g. 'transfer_<uuid>'
+    return sum((value or {}).get('bytes', 0) for key, value in stored.items()
+               if key.split('_')[0] in ('transfer', 'fetch', 'populate'))
+
+
+def wait_background():
+    """Wait for removals ``CleanupTask`` left running in the background."""
+    for thread in threading.enumerate():
+        if thread.name.startswith('cleanup-'):
+            thread.join()
+
+
+class Tally(object):
+    """Wall time, payload and server counters accumulated per phase."""
+    def __init__(self, standin):
+        self.standin = standin
+        self.phases = {}
+
+    def run(self, phase, task, fw_spec):
+        self.time(phase, lambda: task.run_task(fw_spec),
+                  lambda action: transfer_bytes(
+                      action.stored_data if action is not None else {}))
+
+    def time(self, phase, func, nbytes):
+        """Tally calling `func`, which moves ``nbytes(<its result>)``."""
+        before = self.standin.counters.snapshot()
+        t0 = time.time()
+        result = func()
+        seconds = time.time() - t0
+        after = self.standin.counters.snapshot()
+
+        row = self.phases.setdefault(phase, dict(
+            {k: 0 for k in after}, seconds=0., bytes=0, runs=0))
+        row['runs'] += 1
+        row['seconds'] += seconds
+        row['bytes'] += nbytes(result)
+        for k in after:
+            row[k] += after[k] - before[k]
+
+    def report(self, phases=PHASES):
+        columns = ('seconds', 'MB', 'MB/s', 'requests', 'exec',
+                   'connections', 'MB up', 'MB down')
+        print('{:<14}'.format('phase') +
+              ''.join('{:>12}'.format(c) for c in columns))
+        for phase in phases:
+            row = self.phases.get(phase)
+            if row is None:
+                continue
+            print('{:<14}{:>12.3f}{:>12.1f}{:>12}{:>12}{:>12}{:>12}'
+                  '{:>12.1f}{:>12.1f}'.format(
+                      phase, row['seconds'], row['bytes'] / 1e6,
+                      '{:.1f}'.format(row['bytes'] / 1e6 / row['seconds'])
+                      if row['bytes'] and row['seconds'] else '-',
+                      row['requests'], row['exec'], row['connections'],
+                      row['bytes_up'] / 1e6, row['bytes_down'] / 1e6))
+
+
+def compare(tally, session, tmpdir, args, transfer_opts):
+    """Time plain and chunked transfers of one `args.compare` MB file."""
+    from mdworks import transfer
+
+    opts = {k: v for k, v in transfer_opts.items()
+            if k in ('streams', 'chunk_size', 'verify')}
+    source = os.path.join(tmpdir, 'large')
+    write(source, args.compare << 20)
+    nbytes = args.compare << 20
+    remote = os.path.join(os.environ['SCRATCHDIR'], 'large')
+
+    tally.time('sftp.put', lambda: session.sftp.put(source, remote + '.plain'),
+               lambda result: nbytes)
+    tally.time('put', lambda: transfer.put(session, source, remote, **opts),
+               lambda result: nbytes)
+    tally.time('sftp.get', lambda: session.sftp.get(remote, source + '.plain'),
+               lambda result: nbytes)
+    tally.time('get', lambda: transfer.get(session, remote, source + '.got',
+                                           **opts),
+               lambda result: nbytes)
+
+
+def main():
+    from mdworks.ssh import configure_pool
+    from mdworks.firetasks import (StagingTask, Stage2RunDirTask,
+                                   FilePullTask, CleanupTask)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sims', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="seconds added each way; default 0.01")
+    parser.add_argument('--bandwidth', type=float,
+                        help="MB/s per connection and direction; default "
+                        "unlimited")
+    parser.add_argument('--no-exec', action='store_true',
+                        help="refuse exec channels, as an SFTP-only account")
+    group = parser.add_argument_group('Sim shape')
+    group.add_argument('--tpr-mb', type=int, default=4)
+    group.add_argument('--cpt-mb', type=int, default=16)
+    group.add_argument('--traj-mb', type=int, default=96)
+    group.add_argument('--trajectories', type=int, default=2)
+    group.add_argument('--small-inputs', type=int, default=20)
+    group.add_argument('--small-outputs', type=int, default=40)
+    group = parser.add_argument_group('task options')
+    group.add_argument('--batch', action='store_true')
+    group.add_argument('--compress', action='store_true')
+    group.add_argument('--streams', type=int, default=1)
+    group.add_argument('--chunk-mb', type=int)
+    group.add_argument('--cache', action='store_true')
+    group.add_argument('--fetch', action='store_true')
+    group.add_argument('--no-verify', action='store_true')
+    group.add_argument('--cleanup-mode', default='auto',
+                       choices=['auto', 'exec', 'sftp'])
+    group.add_argument('--background', action='store_true')
+    parser.add_argument('--compare', type=int, metavar='MB',
+                        help="only compare plain and chunked transfers of "
+                        "one file this large")
+    parser.add_argument('--json', help="write results to this file")
+    args = parser.parse_args()
+
+    standin = Standin(latency=args.latency,
+                      bandwidth=args.bandwidth and args.bandwidth * 1e6,
+                      allow_exec=not args.no_exec).start()
+    pool = configure_pool(known_hosts=standin.known_hosts)
+
+    tmpdir = tempfile.mkdtemp(prefix='mdworks-bench-')
+    environ = dict(os.environ)
+    try:
+        remote = os.path.join(tmpdir, 'remote')
+        os.environ['STAGING'] = os.path.join(remote, 'staging')
+        os.environ['SCRATCHDIR'] = os.path.join(remote, 'scratch')
+        os.environ['HOST'] = standin.server
+        for d in ('STAGING', 'SCRATCHDIR'):
+            os.makedirs(os.environ[d])
+
+        server = {'server': standin.server, 'user': 'bench',
+                  'key_filename': standin.key_filename}
+        transfer_opts = dict(streams=args.streams, batch=args.batch,
+                             compress=args.compress,
+                             verify=not args.no_verify)
+        if args.chunk_mb:
+            transfer_opts['chunk_size'] = args.chunk_mb << 20
+
+        tally = Tally(standin)
+        if args.compare:
+            with pool.session(standin.server, 'bench',
+                              standin.key_filename) as session:
+                compare(tally, session, tmpdir, args, transfer_opts)
+        else:
+            for n in range(args.sims):
+                uuid = 'sim{:04d}'.format(n)
+                archive = os.path.join(tmpdir, 'archive', uuid)
+                inputs = make_inputs(archive, args)
+                rundir = os.path.join(os.environ['SCRATCHDIR'], uuid)
+                fw_spec = {'server': standin.server, 'user': 'bench',
+                           'files': [rundir]}
+
+                if not args.fetch:
+                    tally.run('staging', StagingTask(
+                        stages=[{'server': standin.server, 'user': 'bench',
+                                 'staging': os.environ['STAGING']}],
+                        files=inputs, uuid=uuid, cache=args.cache,
+                        key_filename=standin.key_filename,
+                        **transfer_opts), {})
+
+                if args.fetch:
+                    fetch = dict(server, source=archive, **transfer_opts)
+                    task = Stage2RunDirTask(
+                            uuid=uuid, fetch=fetch,
+                            files=[os.path.basename(f) for f in inputs])
+                else:
+                    task = Stage2RunDirTask(uuid=uuid)
+                tally.run('stage2rundir', task, {})
+
+                make_outputs(rundir, args)
+
+                pulled = os.path.join(tmpdir, 'pulled', uuid)
+                tally.run('pull', FilePullTask(
+                    dest=pulled, uuid=uuid,
+                    key_filename=standin.key_filename, **transfer_opts),
+                    fw_spec)
+
+                tally.run('cleanup', CleanupTask(
+                    uuid=uuid, mode=args.cleanup_mode,
+                    background=args.background,
+                    key_filename=standin.key_filename), fw_spec)
+
+        print('{}; latency {} s each way, bandwidth {}'.format(
+            '{} MB file'.format(args.compare) if args.compare
+            else '{} Sims'.format(args.sims), args.latency,
+            '{} MB/s'.format(args.bandwidth) if args.bandwidth
+            else 'unlimited'))
+        tally.report(COMPARE if args.compare else PHASES)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'phases': tally.phases}, f,
+                          indent=1, sort_keys=True)
+    finally:
+        # the stand-in must outlive background cleanup
+        wait_background()
+        pool.close_all()
+        standin.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,17 @@ from __future__ import unicode_literals
 
 from six import string_types
 import os
+import stat
+import errno
+import threading
 
 import traceback
 from os.path import expandvars, expanduser, abspath
 from fireworks import FireTaskBase, FWAction
 
+from .ssh import get_pool, rexists
+from .transfer import MANIFEST, TransferStats, Retrier, is_partial_of
+
 
 class StagingTask(FireTaskBase):
     """
@@ -25,8 +31,39 @@ class StagingTask(FireTaskBase):
         - key_filename: (str) optional SSH key location for remote transfer
         - shell_interpret: (bool) - if True (default) interpret local paths to files with a shell; allows variables and e.g. `~`
         - allow_missing: (bool) - if False (default), raise an error if one of the files to stage is not present
-        - max_retry: (int) - number of times to retry failed transfers; defaults to `0` (no retries)
-        - retry_delay: (int) - number of seconds to wait between retries; defaults to `10`
+        - max_retry: (int) - number of times to retry each failed file transfer or other remote
+          operation; defaults to `0` (no retries)
+        - retry_delay: (int) - base number of seconds to wait before retrying; doubled with each
+          retry of the same operation, with random jitter; defaults to `10`
+        - retry_max_delay: (int) - maximum number of seconds to wait before a retry; defaults to `300`
+        - concurrent: (bool) - if True, stage to all stages in parallel; defaults to `False`
+        - max_workers: (int) - maximum number of stages staged to at once when `concurrent`; defaults to `4`
+        - host_interval: (float) - minimum number of seconds between starting stagings to the same server,
+          shared by all StagingTasks in this process; defaults to `5`
+        - incremental: (bool) - if True, keep a manifest of size, mtime and content hash at each
+          destination and upload only new or changed files, deleting only stale ones, instead of
+          wiping the destination and re-uploading everything; defaults to `False`
+        - streams: (int) - number of parallel SFTP channels used for each large file; defaults to `1`
+        - chunk_size: (int) - size in bytes of the resumable chunks large files are sent in
+        - resume: (bool) - if True (default), resume interrupted large-file uploads from their
+          last completed chunk
+        - verify: (bool) - if True (default), hash files as they are sent and compare with the
+          remote side's digests before renaming them into place, sending again what differs;
+          requires `md5sum` on the remote resource, without which only size changes are caught
+        - batch: (bool) - if True, send all small files as one tar stream over a single channel
+          instead of one SFTP round trip per file; requires `tar` on the remote resource;
+          defaults to `False`
+        - compress: (bool) - if True, gzip the tar stream used in `batch` mode; defaults to `False`
+        - cache: (bool) - if True, keep a single copy of each distinct file in a content-addressed
+          cache on each stage, and copy it into the Sim's staging directory, as a reflink where the
+          filesystem supports it; identical inputs across an ensemble are then sent once. The cache
+          is `<staging>/.mdworks-cache` unless the stage gives a 'cache' directory, best on the same
+          filesystem. Requires shell access on the stage, without which files are uploaded
+          directly; files MD appends to (.xtc, .trr, .edr, .log) always are; defaults to `False`
+        - cache_max_bytes: (int) - evict least recently used cache entries beyond this total size;
+          defaults to no limit
+        - cache_max_age: (float) - evict cache entries unused for this many seconds; defaults to
+          30 days
 
     """
     _fw_name = 'StagingTask'
@@ -34,102 +71,343 @@ class StagingTask(FireTaskBase):
 
     def run_task(self, fw_spec):
         import yaml
-        import time
-        import paramiko
+        from .metrics import stored_key
 
-        files = self.get('files')
         stages = self.get('stages')
 
-        shell_interpret = self.get('shell_interpret', True)
-        max_retry = self.get('max_retry', 0)
-        allow_missing = self.get('allow_missing', False)
-        retry_delay = self.get('retry_delay', 10)
-        mode = self.get('mode', 'move')
-
-        # we don't want an error raised for missing files, so we remove them.
-        # perhaps change with a try-except instead
-        if allow_missing:
-            files = [f for f in files if os.path.exists(f)]
-
         # if stages is a path, we load the stages info from the file
         if isinstance(stages, string_types):
             with open(stages, 'r') as f:
-                stages = yaml.load(f)
+                stages = yaml.safe_load(f)
+
+        files = self._local_files()
 
-        # send the files to each stage
+        # transfers and retries are tallied for each stage separately
+        self._stats = {}
+        self._retriers = {}
+        self._cache_fallback = set()
         for stage in stages:
-            # we place files in a staging directory corresponding to its uuid
-            # easy to find that way
-            dest = os.path.join(stage['staging'], self['uuid'])
-            
-            # create ssh connection
-            ssh = paramiko.SSHClient()
-            ssh.load_host_keys(expanduser(os.path.join("~", ".ssh", "known_hosts")))
-            ssh.connect(stage['server'], username=stage['user'], key_filename=self.get('key_filename'))
-            sftp = ssh.open_sftp()
-
-            # if destination exists, delete all files inside; don't want stale files
-            if self._rexists(sftp, dest):
+            stats = self._stats.setdefault(self._key(stage), TransferStats())
+            self._retriers[self._key(stage)] = Retrier(
+                    max_retry=self.get('max_retry', 0),
+                    delay=self.get('retry_delay', 10),
+                    max_delay=self.get('retry_max_delay', 300),
+                    stats=stats)
+
+        if self.get('concurrent', False) and len(stages) > 1:
+            from multiprocessing.pool import ThreadPool
+
+            workers = ThreadPool(min(self.get('max_workers', 4), len(stages)))
+            try:
+                # map re-raises the first failure after all stages finish
+                records = workers.map(lambda stage: self._stage(stage, files),
+                                      stages)
+            finally:
+                workers.close()
+                workers.join()
+        else:
+            records = [self._stage(stage, files) for stage in stages]
+
+        total = TransferStats.combined(self._stats.values())
+        uuid = self['uuid']
+        return FWAction(stored_data={
+            stored_key('transfer', uuid): total.as_dict(),
+            stored_key('metrics', 'staging', uuid): records})
+
+    @staticmethod
+    def _key(stage):
+        return stage['server'], stage['staging']
+
+    def _retry(self, func, stage, *args):
+        """Call ``func(stage, *args)``, retrying it as configured."""
+        return self._retriers[self._key(stage)](func, stage, *args)
+
+    def _session(self, stage):
+        """Pooled ssh connection to `stage`; reused across tasks in this rocket."""
+        return get_pool().session(stage['server'], stage['user'],
+                                  self.get('key_filename'))
+
+    def _put(self, stage, src, dest):
+        """Upload one file with the transfer engine."""
+        from . import transfer
+
+        with self._session(stage) as session:
+            transfer.put(session, src, dest,
+                         stats=self._stats[self._key(stage)],
+                         streams=self.get('streams', 1),
+                         chunk_size=self.get('chunk_size'),
+                         resume=self.get('resume', True),
+                         verify=self.get('verify', True))
+
+    def _put_batch(self, stage, paths, dest, names=None):
+        """Upload `paths` as a single tar stream."""
+        from . import transfer
+
+        with self._session(stage) as session:
+            transfer.put_batch(session, paths, dest,
+                               stats=self._stats[self._key(stage)],
+                               compress=self.get('compress', False),
+                               arcnames=names,
+                               verify=self.get('verify', True))
+
+    def _put_many(self, stage, paths, dest, names=None):
+        """Upload `paths` into `dest`, batching small files if requested.
+
+        Files are named as in `names`, a dict keyed by local path, and
+        otherwise keep their basename. Each file, or the batch as a whole,
+        is retried on its own; files already sent are kept.
+
+        """
+        from . import transfer
+
+        names = names or {}
+
+        if self.get('batch', False):
+            small = [p for p in paths
+                     if os.path.getsize(p) < transfer.LARGE_FILE]
+            self._retry(self._put_batch, stage, small, dest, names)
+            paths = [p for p in paths if p not in small]
+
+        for src in paths:
+            self._retry(self._put, stage, src,
+                        os.path.join(dest, names.get(src,
+                                                     os.path.basename(src))))
+
+    def _put_cached(self, stage, paths, dest, manifest=None):
+        """Place `paths` in `dest` through the stage's content-addressed
+        cache, uploading only contents the cache does not hold yet.
+
+        Where the cache cannot copy entries, e.g. without shell access on
+        the resource, the files are uploaded to `dest` directly instead.
+
+        """
+        import uuid
+        from .transfer import (RemoteCache, CACHE, CACHE_ROUNDS, APPEND_EXTS,
+                               local_manifest)
+
+        # outputs MD appends to are unique to a Sim; caching them only
+        # takes space
+        direct = [p for p in paths if p.endswith(APPEND_EXTS)]
+        self._put_many(stage, direct, dest)
+
+        paths = [p for p in paths if p not in direct]
+        if not paths:
+            return
+
+        manifest = manifest or local_manifest(paths)
+        digests = {p: manifest[os.path.basename(p)]['hash'] for p in paths}
+
+        cache = RemoteCache(stage.get('cache',
+                                      os.path.join(stage['staging'], CACHE)))
+        missing = set(self._retry(self._cache_missing, stage, cache,
+                                  digests.values()))
+
+        # uploads go to names of our own, so tasks staging the same content
+        # at once never write the same file
+        token = uuid.uuid4().hex[:12]
+        copies = [(digests[p], os.path.join(dest, os.path.basename(p)))
+                  for p in paths]
+        sent = set()
+        for attempt in range(CACHE_ROUNDS):
+            # one upload per missing content, however many files share it
+            sources = {}
+            for p in paths:
+                if digests[p] in missing:
+                    sources.setdefault(digests[p], p)
+            self._put_many(stage, list(sources.values()), cache.incoming,
+                           names={p: cache.incoming_name(d, token)
+                                  for d, p in sources.items()})
+            sent.update(p for p in paths if digests[p] in sources)
+
+            # entries evicted by another task since we looked are sent again
+            try:
+                missing = set(self._retry(self._cache_place, stage, cache,
+                                          list(sources), copies, token))
+            except Exception:
+                traceback.print_exc()
+                self._cache_fallback.add(self._key(stage))
+                # what we uploaded goes to its place; the rest is sent there
+                moved = set(self._retry(self._cache_unload, stage, cache,
+                                        {d: os.path.join(dest,
+                                                         os.path.basename(p))
+                                         for d, p in sources.items()},
+                                        token))
+                self._put_many(stage, [p for p in paths
+                                       if sources.get(digests[p]) != p
+                                       or digests[p] not in moved], dest)
+                return
+            if not missing:
+                break
+            copies = [(d, path) for d, path in copies if d in missing]
+        else:
+            raise IOError("Cache entries {} keep disappearing before they "
+                          "can be copied".format(sorted(missing)))
+
+        self._stats[self._key(stage)].add_cached(
+                sum(os.path.getsize(p) for p in paths if p not in sent),
+                files=len(paths) - len(sent))
+
+        self._retry(self._cache_evict, stage, cache)
+
+    def _cache_missing(self, stage, cache, digests):
+        with self._session(stage) as session:
+            return cache.missing(session.sftp, digests)
+
+    def _cache_place(self, stage, cache, uploaded, copies, token):
+        with self._session(stage) as session:
+            return cache.place(session, uploaded, copies, token)
+
+    def _cache_unload(self, stage, cache, uploaded, token):
+        with self._session(stage) as session:
+            return cache.unload(session.sftp, uploaded, token)
+
+    def _cache_evict(self, stage, cache):
+        with self._session(stage) as session:
+            return cache.evict(session.sftp,
+                               max_bytes=self.get('cache_max_bytes'),
+                               max_age=self.get('cache_max_age',
+                                                30 * 24 * 3600))
+
+    def _local_files(self):
+        """Resolve the local paths of the files to stage."""
+        shell_interpret = self.get('shell_interpret', True)
+        allow_missing = self.get('allow_missing', False)
+
+        files = []
+        for f in self['files']:
+            src = abspath(expanduser(expandvars(f))) if shell_interpret else f
+
+            # we don't want an error raised for missing files, so we
+            # skip them if allow_missing is True
+            if allow_missing and not os.path.exists(src):
+                continue
+
+            files.append(src)
+
+        return files
+
+    def _stage(self, stage, files):
+        """Send `files` to a single stage; returns the stage's metrics."""
+        from .metrics import Phase
+
+        with Phase('staging', uuid=self['uuid'], host=stage['server']) as phase:
+            self._stage_files(stage, files)
+
+        extra = {}
+        if self.get('cache', False):
+            # whether files had to be uploaded directly instead
+            extra['cache_fallback'] = self._key(stage) in self._cache_fallback
+        return phase.record(stats=self._stats[self._key(stage)], **extra)
+
+    def _stage_files(self, stage, files):
+        from .ssh import throttle
+
+        # we place files in a staging directory corresponding to its uuid
+        # easy to find that way
+        dest = os.path.join(stage['staging'], self['uuid'])
+
+        # give the ssh daemon some time to breathe between stagings; with many
+        # simulations may be staging many simulations at once from same server
+        throttle(stage['server'], self.get('host_interval', 5))
+
+        if self.get('incremental', False):
+            upload, manifest = self._retry(self._plan_sync, stage, dest, files)
+        else:
+            upload, manifest = self._retry(self._clear, stage, dest, files), None
+
+        if self.get('cache', False):
+            self._put_cached(stage, upload, dest, manifest)
+        else:
+            self._put_many(stage, upload, dest)
+
+        if manifest is not None:
+            self._retry(self._write_manifest, stage, dest, manifest)
+
+    def _clear(self, stage, dest, files):
+        """Make `dest` hold nothing but partial uploads of `files`."""
+        with self._session(stage) as session:
+            sftp = session.sftp
+
+            # if destination exists, delete all files inside; don't want
+            # stale files, but keep partial uploads we can resume
+            names = [os.path.basename(src) for src in files]
+            if rexists(sftp, dest):
                 for f in sftp.listdir(dest):
-                    sftp.remove(os.path.join(dest, f))
+                    if not is_partial_of(f, names):
+                        sftp.remove(os.path.join(dest, f))
             else:
                 sftp.mkdir(dest)
 
-            for f in self["files"]:
-                try:
-                    src = abspath(expanduser(expandvars(f))) if shell_interpret else f
+        return files
 
-                    # we don't want an error raised for missing files, so we
-                    # skip them if allow_missing is True
-                    if allow_missing and not os.path.exists(src):
-                        continue
+    def _plan_sync(self, stage, dest, files):
+        """Delete stale files in `dest`; return the files that must be
+        uploaded to bring it up to date, and the manifest to write after."""
+        from .transfer import (local_manifest, read_manifest, remote_files,
+                               plan_sync)
 
-                    sftp.put(src, os.path.join(dest, os.path.basename(src)))
-                except:
-                    traceback.print_exc()
-                    if max_retry:
-                        # we want to avoid hammering either the local or remote machine
-                        time.sleep(retry_delay)
-                        self['max_retry'] -= 1
-                        self.run_task(fw_spec)
-                    else:
-                        raise
-
-            sftp.close()
-            ssh.close()
-
-            # give the ssh daemon some time to breathe between stagings;
-            # with many simulations may be staging many simulations at once
-            # from same server
-            time.sleep(5)
+        with self._session(stage) as session:
+            sftp = session.sftp
+            if rexists(sftp, dest):
+                remote = read_manifest(sftp, dest)
+                sizes = remote_files(sftp, dest)
+            else:
+                sftp.mkdir(dest)
+                remote, sizes = {}, {}
+
+            local = local_manifest(files, previous=remote)
+            upload, delete = plan_sync(local, remote, sizes)
+
+            for name in delete:
+                sftp.remove(os.path.join(dest, name))
+
+        paths = {os.path.basename(src): src for src in files}
+        return [paths[name] for name in upload], local
+
+    def _write_manifest(self, stage, dest, manifest):
+        from .transfer import write_manifest
+
+        with self._session(stage) as session:
+            write_manifest(session.sftp, dest, manifest)
 
     def _rexists(self, sftp, path):
         """
         os.path.exists for paramiko's SCP object
         """
-        try:
-            sftp.stat(path)
-        except IOError as e:
-            if e[0] == 2:
-                return False
-            raise
-        else:
-            return True
+        return rexists(sftp, path)
 
 
 class Stage2RunDirTask(FireTaskBase):
     """
     A FireTask to make the rundir for an MD run, and copy files from staging.
+    With `fetch`, inputs not found in staging are instead fetched from the
+    archive (or a mirror of it) by the resource that actually runs the job.
 
     Required params:
         - uuid: (str) uuid of Sim to make rundir for
+    Optional params:
+        - populate: (str) - how to place staged files in the rundir; one of 'auto' (default),
+          'reflink', 'hardlink', 'symlink' or 'copy'. 'auto' uses a reflink or hardlink when
+          staging and scratch share a filesystem and copies otherwise; copying is always
+          the fallback. Hardlinks and symlinks are only made to inputs MD never writes
+          (.tpr, .top, .itp, .mdp, .ndx) that have no other links
+        - copy_workers: (int) - number of files copied in parallel; defaults to `4`
+        - files: ([str]) - names of the files the run needs; with `fetch`, those not found in
+          staging are fetched, and those found at neither are skipped
+        - fetch: (dict) - where to fetch inputs from, giving for each of the following keys:
+                - 'server': host holding the inputs, as reachable from the compute resource
+                - 'user': username to authenticate with
+                - 'source': absolute path of the directory holding the inputs
+            and optionally 'key_filename', and 'streams', 'chunk_size', 'batch', 'compress',
+            'verify', 'max_retry', 'retry_delay' and 'retry_max_delay' as for FilePullTask
 
     """
     _fw_name = 'Stage2RunDirTask'
     required_params = ["uuid"]
 
     def run_task(self, fw_spec):
-        import shutil
+        from .metrics import Phase, stored_key
+        from .transfer import populate
 
         rundir = os.path.join(os.environ['SCRATCHDIR'], self['uuid'])
         staging = os.path.join(os.environ['STAGING'], self['uuid'])
@@ -140,9 +418,160 @@ class Stage2RunDirTask(FireTaskBase):
             # we don't care if the directory already exists
             pass
 
-        # copy files from stage to rundir
-        for f in os.listdir(staging):
-            shutil.copy(os.path.join(staging, f), rundir)
+        # place files from stage in rundir; the staging manifest stays behind.
+        # without prefetching, nothing may have been staged at all
+        if os.path.isdir(staging) or not self.get('fetch'):
+            names = [f for f in os.listdir(staging) if f != MANIFEST]
+        else:
+            names = []
+
+        with Phase('populate', uuid=self['uuid']) as phase:
+            methods = {}
+            if names:
+                methods = populate(staging, rundir, names,
+                                   method=self.get('populate', 'auto'),
+                                   workers=self.get('copy_workers', 4))
+
+        nbytes = sum(os.path.getsize(os.path.join(staging, f)) for f in names)
+        stored_data = {stored_key('populate', self['uuid']): {
+            'seconds': round(phase.seconds, 3),
+            'files': len(names),
+            'bytes': nbytes,
+            'methods': methods}}
+        metrics = [phase.record(files=len(names), bytes=nbytes,
+                                methods=methods)]
+
+        if self.get('fetch'):
+            wanted = [os.path.basename(f) for f in self.get('files', [])]
+            with Phase('fetch', uuid=self['uuid']) as phase:
+                stats = self._fetch([f for f in wanted if f not in names],
+                                    rundir)
+            stored_data[stored_key('fetch', self['uuid'])] = stats.as_dict()
+            metrics.append(phase.record(stats=stats,
+                                        source=self['fetch']['server']))
+
+        stored_data[stored_key('metrics', 'populate', self['uuid'])] = metrics
+        return FWAction(stored_data=stored_data)
+
+    def _fetch(self, names, rundir):
+        """Fetch inputs `names` from the fetch source into `rundir`."""
+        from . import transfer
+
+        fetch = self['fetch']
+        server = (fetch['server'], fetch['user'], fetch.get('key_filename'))
+        source = fetch['source']
+
+        stats = TransferStats()
+        retry = Retrier(max_retry=fetch.get('max_retry', 0),
+                        delay=fetch.get('retry_delay', 10),
+                        max_delay=fetch.get('retry_max_delay', 300),
+                        stats=stats)
+
+        def listing():
+            with get_pool().session(*server) as session:
+                return transfer.remote_files(session.sftp, source)
+
+        def get(name):
+            with get_pool().session(*server) as session:
+                transfer.get(session, os.path.join(source, name),
+                             os.path.join(rundir, name), stats=stats,
+                             streams=fetch.get('streams', 1),
+                             chunk_size=fetch.get('chunk_size'),
+                             verify=fetch.get('verify', True))
+
+        def get_batch(batch):
+            with get_pool().session(*server) as session:
+                transfer.get_batch(session, source, batch, rundir,
+                                   stats=stats,
+                                   compress=fetch.get('compress', False),
+                                   verify=fetch.get('verify', True))
+
+        # only inputs that exist at the source; one round trip
+        sizes = retry(listing)
+        names = [name for name in names if name in sizes]
+
+        if names and fetch.get('batch', False):
+            small = [name for name in names
+                     if sizes[name] < transfer.LARGE_FILE]
+            retry(get_batch, small)
+            names = [name for name in names if name not in small]
+
+        for name in names:
+            retry(get, name)
+
+        return stats
+
+
+# LiveSyncers running in this process, by Sim uuid
+_live_syncers = {}
+
+
+class LiveSyncTask(FireTaskBase):
+    """
+    A FireTask to start streaming a rundir's outputs back to the archive
+    while MD runs. Place it before the MD task in the same Firework and
+    finish with a LiveSyncStopTask after it.
+
+    Required params:
+        - uuid: (str) uuid of Sim whose rundir, `$SCRATCHDIR/<uuid>`, to stream
+        - archive: (str) absolute path of the archive directory
+        - server: (str) host holding the archive, as reachable from the compute resource
+        - user: (str) username to authenticate with
+    Optional params:
+        - key_filename: (str) optional SSH key location for remote transfer
+        - interval: (float) - seconds between sync rounds; defaults to `300`
+        - settle: (float) - seconds a checkpoint or other rewritten file must be unmodified
+          before it is sent; defaults to `5`
+        - verify: (bool) - if True (default), hash what is sent and compare with the archive
+          side's digests, sending again what differs; requires `md5sum` on the archive host
+
+    """
+    _fw_name = 'LiveSyncTask'
+    required_params = ["uuid", "archive", "server", "user"]
+
+    def run_task(self, fw_spec):
+        from .transfer import LiveSyncer
+
+        syncer = LiveSyncer(os.path.join(os.environ['SCRATCHDIR'], self['uuid']),
+                            self['server'], self['user'], self['archive'],
+                            key_filename=self.get('key_filename'),
+                            interval=self.get('interval', 300),
+                            settle=self.get('settle', 5),
+                            verify=self.get('verify', True))
+        syncer.start()
+        _live_syncers[self['uuid']] = syncer
+
+
+class LiveSyncStopTask(FireTaskBase):
+    """
+    A FireTask to stop the LiveSyncTask for a Sim, after one final round.
+
+    Required params:
+        - uuid: (str) uuid of Sim to stop streaming for
+
+    """
+    _fw_name = 'LiveSyncStopTask'
+    required_params = ["uuid"]
+
+    def run_task(self, fw_spec):
+        syncer = _live_syncers.pop(self['uuid'], None)
+        if syncer is None:
+            return
+
+        from .metrics import Phase, stored_key
+
+        # only the final round holds up the job
+        with Phase('live_sync', uuid=self['uuid']) as phase:
+            try:
+                syncer.stop()
+            except Exception:
+                # the pull Firework fetches whatever didn't make it
+                traceback.print_exc()
+
+        return FWAction(stored_data={
+            stored_key('live_sync', self['uuid']): syncer.stats.as_dict(),
+            stored_key('metrics', 'live_sync', self['uuid']): [
+                phase.record(stats=syncer.stats, archive_host=syncer.server)]})
 
 
 class BeaconTask(FireTaskBase):
@@ -158,9 +587,84 @@ class BeaconTask(FireTaskBase):
     required_params = ["uuid"]
 
     def run_task(self, fw_spec):
-        return FWAction(update_spec={'files': [os.path.join(os.environ['SCRATCHDIR'], self['uuid'])],
+        rundir = os.path.join(os.environ['SCRATCHDIR'], self['uuid'])
+
+        # 'rundirs' accumulates over the beacons of all Sims in a bundle
+        return FWAction(update_spec={'files': [rundir],
                                      'server': os.environ['HOST'],
-                                     'user': os.environ['USER']})
+                                     'user': os.environ['USER']},
+                        mod_spec=[{'_set': {'rundirs->' + self['uuid']: rundir}}])
+
+
+class BundleMDTask(FireTaskBase):
+    """
+    A FireTask to run MD for several Sims together in one job, each in its
+    own rundir `$SCRATCHDIR/<uuid>`.
+
+    Required params:
+        - uuids: ([str]) uuids of the Sims to run
+    Optional params:
+        - mode: (str) - 'multidir' (default) calls `run_md.sh` once with all rundirs as
+          arguments, e.g. for `mdrun -multidir`; 'parallel' calls `run_md.sh` for each rundir
+          at once; 'serial' calls it for each rundir in turn
+        - run_hints: (dict) - run length hints 'maxh' and 'nsteps' for `run_md.sh`, passed
+          as `MDWORKS_MAXH` and `MDWORKS_NSTEPS` in its environment
+
+    """
+    _fw_name = 'BundleMDTask'
+    required_params = ["uuids"]
+
+    def run_task(self, fw_spec):
+        import time
+        import subprocess
+        from .metrics import Phase
+
+        mode = self.get('mode', 'multidir')
+        rundirs = [os.path.join(os.environ['SCRATCHDIR'], uuid)
+                   for uuid in self['uuids']]
+
+        env = dict(os.environ)
+        hints = self.get('run_hints') or {}
+        for key in ('maxh', 'nsteps'):
+            if hints.get(key) is not None:
+                env['MDWORKS_' + key.upper()] = str(hints[key])
+
+        with Phase('md') as phase:
+            if mode == 'multidir':
+                t0 = time.time()
+                rc = subprocess.call('run_md.sh {}'.format(' '.join(rundirs)),
+                                     shell=True, env=env)
+                results = {uuid: (rc, time.time() - t0)
+                           for uuid in self['uuids']}
+            elif mode == 'parallel':
+                t0 = time.time()
+                procs = {uuid: subprocess.Popen('run_md.sh {}'.format(rundir),
+                                                shell=True, env=env)
+                         for uuid, rundir in zip(self['uuids'], rundirs)}
+                results = {}
+                for uuid, proc in procs.items():
+                    rc = proc.wait()
+                    results[uuid] = (rc, time.time() - t0)
+            elif mode == 'serial':
+                results = {}
+                for uuid, rundir in zip(self['uuids'], rundirs):
+                    t0 = time.time()
+                    rc = subprocess.call('run_md.sh {}'.format(rundir),
+                                         shell=True, env=env)
+                    results[uuid] = (rc, time.time() - t0)
+            else:
+                raise ValueError("No known bundle mode `{}`.".format(mode))
+
+        failed = sorted(uuid for uuid, (rc, _) in results.items() if rc != 0)
+        if failed:
+            raise RuntimeError("run_md.sh failed for Sims {}".format(
+                ', '.join(failed)))
+
+        seconds = {uuid: round(t, 1) for uuid, (_, t) in results.items()}
+        return FWAction(stored_data={
+            'md_seconds': seconds,
+            'metrics_md': [phase.record(sims=len(rundirs), mode=mode,
+                                     md_seconds=seconds)]})
 
 
 class FilePullTask(FireTaskBase):
@@ -172,48 +676,167 @@ class FilePullTask(FireTaskBase):
         - dest: (str) destination directory, if not specified within files parameter
     Optional params:
         - key_filename: (str) optional SSH key location for remote transfer
+        - streams: (int) - number of parallel SFTP channels used for each large file; defaults to `1`
+        - chunk_size: (int) - size in bytes of the resumable chunks large files are fetched in
+        - resume: (bool) - if True (default), resume interrupted large-file downloads from their
+          last completed chunk
+        - verify: (bool) - if True (default), hash files as they arrive while the remote side
+          hashes them too, and only rename files into place once the digests agree, fetching
+          again what differs; requires `md5sum` on the remote resource, without which only files
+          changed while fetched are caught
+        - batch: (bool) - if True, fetch all small files of a directory as one tar stream over a
+          single channel; requires `tar` on the remote resource; defaults to `False`
+        - compress: (bool) - if True, gzip the tar stream used in `batch` mode; defaults to `False`
+        - tail: (bool) - if True, files a LiveSyncTask already streamed into `dest` are
+          completed by fetching only their remaining tail, verified like any other file;
+          defaults to `False`
+        - max_retry: (int) - number of times to retry each failed file transfer; defaults to `0`
+        - retry_delay: (int) - base number of seconds to wait before retrying; doubled with each
+          retry of the same file, with random jitter; defaults to `10`
+        - retry_max_delay: (int) - maximum number of seconds to wait before a retry; defaults to `300`
+        - uuid: (str) - uuid of the Sim pulled for; where the MD Firework ran a bundle of Sims,
+          only this Sim's rundir is pulled. Also recorded with the task's metrics
 
     """
     _fw_name = 'FilePullTask'
     required_params = ["dest"]
 
     def run_task(self, fw_spec):
-        shell_interpret = self.get('shell_interpret', True)
+        from .metrics import Phase, stored_key
+
         ignore_errors = self.get('ignore_errors')
 
-        # remote transfers
-        # Create SFTP connection
-        import paramiko
-        ssh = paramiko.SSHClient()
-        ssh.load_host_keys(expanduser(os.path.join("~", ".ssh", "known_hosts")))
-        ssh.connect(fw_spec['server'], username=fw_spec['user'], key_filename=self.get('key_filename'))
-        sftp = ssh.open_sftp()
+        self._server = (fw_spec['server'], fw_spec['user'],
+                        self.get('key_filename'))
+        self._stats = TransferStats()
+        self._retry = Retrier(max_retry=self.get('max_retry', 0),
+                              delay=self.get('retry_delay', 10),
+                              max_delay=self.get('retry_max_delay', 300),
+                              stats=self._stats)
+
+        # in a bundle, only this Sim's rundir
+        rundirs = fw_spec.get('rundirs', {})
+        if self.get('uuid') in rundirs:
+            sources = [rundirs[self['uuid']]]
+        else:
+            sources = fw_spec["files"]
 
-        for src in fw_spec["files"]:
-            try:
-                dest = self['dest']
+        with Phase('pull', uuid=self.get('uuid'),
+                   host=fw_spec['server']) as phase:
+            for src in sources:
+                try:
+                    dest = self['dest']
 
-                # make destination if it doesn't exist already
-                if not os.path.exists(dest):
-                    os.mkdirs(dest)
+                    # make destination if it doesn't exist already
+                    if not os.path.exists(dest):
+                        os.makedirs(dest)
 
-                # try case where src is a directory
-                try:
-                    for g in sftp.listdir(src):
-                        sftp.get(os.path.join(src, g), os.path.join(dest, g))
-                except IOError:
-                    # if src isn't a directory, it should be a file
-                    sftp.get(src, os.path.join(dest, os.path.basename(src)))
+                    self._pull(src, dest)
 
-            except:
-                traceback.print_exc()
-                if not ignore_errors:
-                    raise ValueError(
-                        "There was an error performing pull from {} "
-                        "to {}".format(self["files"], self["dest"]))
+                except:
+                    traceback.print_exc()
+                    if not ignore_errors:
+                        raise ValueError(
+                            "There was an error performing pull from {} "
+                            "to {}".format(sources, self["dest"]))
+
+        # tell children, e.g. of a postrun workflow, where the files went
+        uuid = self.get('uuid')
+        return FWAction(stored_data={
+                            stored_key('transfer', uuid): self._stats.as_dict(),
+                            stored_key('metrics', 'pull', uuid): [
+                                phase.record(stats=self._stats)]},
+                        update_spec={'archive': self['dest']})
+
+    def _session(self):
+        """Pooled SFTP connection to the server the files live on."""
+        return get_pool().session(*self._server)
+
+    def _pull(self, src, dest):
+        """Pull file or directory `src` into `dest`, retrying each file."""
+        from . import transfer
+
+        # try case where src is a directory
+        attrs = self._retry(self._listdir, src)
+        if attrs is None:
+            # if src isn't a directory, it should be a file
+            self._retry(self._get, src, os.path.join(dest, os.path.basename(src)))
+            return
+
+        names = [a.filename for a in attrs
+                 if a.filename != transfer.SYNC_JOURNAL]
+
+        # files a LiveSyncer already streamed most of
+        if self.get('tail', False):
+            for g, offset in self._retry(self._synced, src).items():
+                if g in names:
+                    names.remove(g)
+                    self._retry(self._get_tail, src, dest, g, offset)
+
+        if self.get('batch', False):
+            small = [a.filename for a in attrs
+                     if a.filename in names
+                     and stat.S_ISREG(a.st_mode or 0)
+                     and a.st_size < transfer.LARGE_FILE]
+            self._retry(self._get_batch, src, small, dest)
+            names = [g for g in names if g not in small]
+
+        for g in names:
+            self._retry(self._get, os.path.join(src, g), os.path.join(dest, g))
+
+    def _listdir(self, src):
+        """Attributes of the entries of remote directory `src`; None if
+        `src` isn't a directory."""
+        with self._session() as session:
+            try:
+                return session.sftp.listdir_attr(src)
+            except IOError:
+                return None
+
+    def _get(self, src, dest):
+        """Download one file with the transfer engine."""
+        from . import transfer
+
+        with self._session() as session:
+            transfer.get(session, src, dest, stats=self._stats,
+                         streams=self.get('streams', 1),
+                         chunk_size=self.get('chunk_size'),
+                         resume=self.get('resume', True),
+                         verify=self.get('verify', True))
+
+    def _get_batch(self, src, names, dest):
+        """Download files `names` in `src` as a single tar stream."""
+        from . import transfer
+
+        with self._session() as session:
+            transfer.get_batch(session, src, names, dest, stats=self._stats,
+                               compress=self.get('compress', False),
+                               verify=self.get('verify', True))
+
+    def _synced(self, src):
+        """Prefix sizes recorded by a LiveSyncer in remote `src`."""
+        import json
+        from .transfer import SYNC_JOURNAL
+
+        with self._session() as session:
+            try:
+                with session.sftp.open(os.path.join(src, SYNC_JOURNAL), 'r') as f:
+                    return json.loads(f.read().decode('utf-8'))
+            except (IOError, ValueError):
+                return {}
 
-        sftp.close()
-        ssh.close()
+    def _get_tail(self, src, dest, name, offset):
+        from .transfer import get_tail
+
+        remotepath = os.path.join(src, name)
+        localpath = os.path.join(dest, name)
+        try:
+            with self._session() as session:
+                get_tail(session, remotepath, localpath, offset,
+                         stats=self._stats, verify=self.get('verify', True))
+        except (IOError, OSError):
+            # local copy isn't the synced prefix after all; fetch it whole
+            self._get(remotepath, localpath)
 
 
 class CleanupTask(FireTaskBase):
@@ -221,40 +844,97 @@ class CleanupTask(FireTaskBase):
     A FireTask for removing the directory and all files generated from an MD
     run.
 
+    Optional params:
+        - key_filename: (str) optional SSH key location for remote transfer
+        - mode: (str) - how to remove each item: 'exec' runs a single remote `rm -rf`; 'sftp' walks
+          the tree over SFTP; 'auto' tries 'exec' and falls back to 'sftp'; defaults to `'auto'`.
+          How many items were removed each way is recorded as 'methods' in the task's metrics
+        - workers: (int) - number of parallel SFTP channels removing files in 'sftp' mode; defaults to `4`
+        - background: (bool) - only rename each item aside before finishing, and remove it in the
+          background, so the Fireworks after cleanup need not wait; defaults to `False`
+        - max_retry: (int) - number of times to retry removing each item; defaults to `0`
+        - retry_delay: (int) - base number of seconds to wait before retrying; defaults to `10`
+        - retry_max_delay: (int) - maximum number of seconds to wait before a retry; defaults to `300`
+
     """
     _fw_name = 'CleanupTask'
     required_params = ["uuid"]
 
     def run_task(self, fw_spec):
-        shell_interpret = self.get('shell_interpret', True)
-        ignore_errors = self.get('ignore_errors')
+        from .metrics import Phase, stored_key
+
+        mode = self.get('mode', 'auto')
+        if mode not in ('auto', 'exec', 'sftp'):
+            raise ValueError("No known cleanup mode `{}`.".format(mode))
+
+        self._server = (fw_spec['server'], fw_spec['user'],
+                        self.get('key_filename'))
+        stats = TransferStats()
+        retry = Retrier(max_retry=self.get('max_retry', 0),
+                        delay=self.get('retry_delay', 10),
+                        max_delay=self.get('retry_max_delay', 300),
+                        stats=stats)
+
+        # in a bundle, only this Sim's rundir
+        rundirs = fw_spec.get('rundirs', {})
+        if self['uuid'] in rundirs:
+            items = [rundirs[self['uuid']]]
+        else:
+            items = fw_spec["files"]
+
+        with Phase('cleanup', uuid=self['uuid'],
+                   host=fw_spec['server']) as phase:
+            used = []
+            for item in items:
+                try:
+                    used.append(retry(self._remove, item, mode))
+                except:
+                    traceback.print_exc()
+                    raise
 
-        # Create SFTP connection
-        import paramiko
-        ssh = paramiko.SSHClient()
-        ssh.load_host_keys(expanduser(os.path.join("~", ".ssh", "known_hosts")))
-        ssh.connect(fw_spec['server'], username=fw_spec['user'], key_filename=self.get('key_filename'))
-        sftp = ssh.open_sftp()
+        # with 'auto', 'sftp' counts the items `rm` failed for
+        methods = {how: used.count(how) for how in set(used)}
+        return FWAction(stored_data={
+            stored_key('metrics', 'cleanup', self['uuid']): [phase.record(
+                items=len(items), retries=stats.retries, mode=mode,
+                methods=methods, background=self.get('background', False))]})
 
-        def delete_dir(sftp, directory):
-            for g in sftp.listdir(directory):
-                # first remove files
-                sftp.remove(os.path.join(directory, g))
+    def _remove(self, item, mode):
+        """Remove `item`; returns how, 'exec' or 'sftp'."""
+        from .transfer import remove_tree_exec
 
-            # then delete the directory
-            sftp.rmdir(directory)
+        background = self.get('background', False)
 
-        for item in fw_spec["files"]:
+        if mode != 'sftp':
             try:
-                # try case where item is a directory
-                try:
-                    delete_dir(sftp, item)
-                except IOError:
-                    # if src isn't a directory, it should be a file
-                    sftp.remove(item)
-            except:
+                with get_pool().session(*self._server) as session:
+                    remove_tree_exec(session, item, background=background)
+                return 'exec'
+            except Exception:
+                if mode == 'exec':
+                    raise
                 traceback.print_exc()
-                raise
 
-        sftp.close()
-        ssh.close()
+        if background:
+            from .transfer import set_aside
+
+            with get_pool().session(*self._server) as session:
+                item = set_aside(session, item)
+            if item is not None:
+                # not a daemon: the rocket waits for it before exiting
+                threading.Thread(target=self._remove_sftp, args=(item,),
+                                 name='cleanup-{}'.format(item)).start()
+        else:
+            self._remove_sftp(item)
+        return 'sftp'
+
+    def _remove_sftp(self, item):
+        from .transfer import remove_tree_sftp
+
+        with get_pool().session(*self._server) as session:
+            try:
+                remove_tree_sftp(session, item,
+                                 workers=self.get('workers', 4))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
@@ -1,20 +1,24 @@
 from six import string_types
 import os
 
-import mdsynthesis as mds
-import yaml
-
-from fireworks import ScriptTask, PyTask, FileTransferTask
+from fireworks import ScriptTask
 from fireworks import Workflow, Firework
 
 from .firetasks import FilePullTask, BeaconTask, Stage2RunDirTask, StagingTask
-from .firetasks import CleanupTask
-from .gromacs.firetasks import GromacsContinueTask
+from .firetasks import CleanupTask, LiveSyncTask, LiveSyncStopTask
+from .firetasks import BundleMDTask
+from .gromacs.firetasks import GromacsContinueTask, GromacsMultiLegTask
+from .gromacs.firetasks import GromacsBundleContinueTask
+from .status import StatusStore, default_path
 
 
 def make_md_workflow(sim, archive, stages, files, md_engine='gromacs',
                      md_category='md', local_category='local',
-                     postrun_wf=None, post_wf=None):
+                     postrun_wf=None, post_wf=None, staging_opts=None,
+                     nsteps=None, legs_per_job=1, walltime=None,
+                     live_sync=None, cleanup_opts=None, fetch=None,
+                     prefetch=False, walltime_reserve=300, md_categories=None,
+                     run_hints=None, status=None):
     """Construct a general, single MD simulation workflow.
 
     Assumptions
@@ -31,7 +35,9 @@ def make_md_workflow(sim, archive, stages, files, md_engine='gromacs',
     The script ``run_md.sh`` must be somewhere on your path, and must take
     a single argument giving the directory to execute MD out of. It should
     create and change the working directory to that directory before anything
-    else.
+    else. It may pass the run length hints it is given in the environment
+    variables ``MDWORKS_MAXH`` and ``MDWORKS_NSTEPS`` on to mdrun's ``-maxh``
+    and ``-nsteps``; see :mod:`mdworks.gromacs.perf`.
 
     Parameters
     ----------
@@ -62,6 +68,57 @@ def make_md_workflow(sim, archive, stages, files, md_engine='gromacs',
     post_wf : Workflow
         Workflow to perform after completed MD (no continuation); use for final
         postprocessing. 
+    staging_opts : dict
+        Additional optional parameters passed on to the ``StagingTask``, e.g.
+        ``{'concurrent': True, 'max_workers': 4, 'host_interval': 1}``.
+    nsteps : int
+        Total number of steps to run; if not given, it is read from the TPR
+        file when deciding whether to continue.
+    legs_per_job : int
+        Maximum number of legs the MD Firework runs back to back in the same
+        rundir before pulling back to the archive and continuing from there.
+        The default of 1 makes a round trip through the archive every leg.
+    walltime : float
+        Seconds of walltime the MD Firework has; with ``legs_per_job`` > 1,
+        no leg is started that is not expected to finish within it. Defaults
+        to the ``MDWORKS_WALLTIME`` environment variable on the resource.
+        If given, MD is also hinted to stop ``walltime_reserve`` seconds
+        before the walltime is up.
+    live_sync : dict
+        If given, outputs are streamed back to the archive while MD runs, and
+        the pull afterwards only fetches what remains. Gives the 'server' and
+        'user' with which the compute resource reaches the archive, and
+        optionally 'key_filename', 'interval' and 'settle' as for
+        ``LiveSyncTask``.
+    cleanup_opts : dict
+        Additional optional parameters passed on to the ``CleanupTask``, e.g.
+        ``{'mode': 'sftp', 'background': True}``.
+    walltime_reserve : float
+        Seconds of ``walltime`` kept back for setting up and finishing each
+        leg around MD itself.
+    md_categories : list
+        If given, each continuation submits the next leg to whichever of
+        these categories the Sim has run fastest in so far, as judged from
+        the performance in the mdrun log; categories not tried yet go first.
+    run_hints : dict
+        Run length hints for ``run_md.sh``, 'maxh' and 'nsteps'; set by the
+        continuation from the Sim's performance history. Defaults to only
+        a 'maxh' derived from ``walltime``.
+    fetch : dict
+        If given, inputs are staged lazily: the MD Firework fetches them at
+        start from the Sim's archive, so only the resource that actually runs
+        the job receives them. Gives the 'server' and 'user' with which the
+        compute resource reaches the archive, and optionally 'key_filename',
+        a 'mirror' directory on that server holding a copy of each Sim's
+        inputs under ``<mirror>/<uuid>`` to fetch from instead, and transfer
+        options as for ``Stage2RunDirTask``.
+    prefetch : bool
+        With ``fetch``, still stage to every resource in ``stages`` before
+        the MD Firework as usual; it then only fetches what was not staged.
+    status : str
+        Path of the status log to record the Sim's submission and the
+        progress of each leg in; defaults to the ``MDWORKS_STATUS``
+        environment variable. See :mod:`mdworks.status`.
 
     Returns
     -------
@@ -69,88 +126,470 @@ def make_md_workflow(sim, archive, stages, files, md_engine='gromacs',
         MD workflow; can be submitted to LaunchPad of choice.
 
     """
+    import mdsynthesis as mds
+
     sim = mds.Sim(sim)
 
     #TODO: perhaps move to its own FireTask?
     sim.categories['md_status'] = 'running'
 
-    ft_stage = StagingTask(stages=stages,
-                           files=files,
-                           archive=archive,
-                           uuid=sim.uuid,
-                           shell_interpret=True,
-                           max_retry=5,
-                           allow_missing=True)
-
-    fw_stage = Firework([ft_stage],
-                        spec={'_launch_dir': archive,
-                              '_category': local_category},
-                        name='staging')
-
-    ## MD execution; takes place in queue context of compute resource
-
-    # copy input files to scratch space
-    ft_copy = Stage2RunDirTask(uuid=sim.uuid)
-
-    # send info on where files live to pull firework
-    ft_info = BeaconTask(uuid=sim.uuid)
-
-    # next, run MD
-    ft_md = ScriptTask(script='run_md.sh {}'.format(
-                            os.path.join('${SCRATCHDIR}/', sim.uuid)),
-                       use_shell=True,
-                       fizzle_bad_rc=True)
-
-    fw_md = Firework([ft_copy, ft_info, ft_md],
-                     spec={'_category': md_category},
-                     name='md',
-                     parents=fw_stage)
-
- 
-    ## Pull files back to archive; takes place locally
-    ft_copyback = FilePullTask(dest=archive)
-
-    fw_copyback = Firework([ft_copyback],
-                           spec={'_launch_dir': archive,
-                                 '_category': local_category},
-                           name='pull',
-                           parents=fw_md)
-
-    ## Clean up files in rundir on remote resource
-    ft_cleanup = CleanupTask(uuid=sim.uuid)
-
-    fw_cleanup = Firework([ft_cleanup],
-                          spec={'_launch_dir': archive,
-                                '_category': local_category},
-                          name='cleanup',
-                          parents=[fw_copyback, fw_md])
-
-    ## Decide if we need to continue and submit new workflow if so; takes place
-    ## locally
-
-    if md_engine == 'gromacs':
-        ft_continue = GromacsContinueTask(sim=sim, archive=archive,
-                stages=stages, files=files, md_engine=md_engine,
-                md_category=md_category, local_category=local_category,
-                postrun_wf=postrun_wf, post_wf=post_wf)
-    else:
-        raise ValueError("No known md engine `{}`.".format(md_engine))
-
-    fw_continue = Firework([ft_continue],
-                           spec={'_launch_dir': archive,
-                                 '_category': local_category},
-                           name='continue',
-                           parents=fw_cleanup)
-
-    wf = Workflow([fw_stage, fw_md, fw_copyback, fw_cleanup, fw_continue],
-                  name='{} | md'.format(sim.name),
-                  metadata=dict(sim.categories))
-
-    ## Mix in postrun workflow, if given
-    if postrun_wf:
+    template = _MDWorkflowTemplate(stages, files, md_engine=md_engine,
+                                   md_category=md_category,
+                                   local_category=local_category,
+                                   postrun_wf=postrun_wf, post_wf=post_wf,
+                                   staging_opts=staging_opts, nsteps=nsteps,
+                                   legs_per_job=legs_per_job,
+                                   walltime=walltime, live_sync=live_sync,
+                                   cleanup_opts=cleanup_opts, fetch=fetch,
+                                   prefetch=prefetch,
+                                   walltime_reserve=walltime_reserve,
+                                   md_categories=md_categories,
+                                   run_hints=run_hints, status=status)
+
+    if template.status:
+        StatusStore(template.status).submitted([(sim.uuid, sim.name)])
+
+    return template.build(sim.abspath, sim.uuid, sim.name, archive,
+                          dict(sim.categories))
+
+
+def make_md_workflows(sims, archives, stages, files, md_engine='gromacs',
+                      md_category='md', local_category='local',
+                      postrun_wf=None, post_wf=None, staging_opts=None,
+                      nsteps=None, legs_per_job=1, walltime=None,
+                      live_sync=None, cleanup_opts=None, fetch=None,
+                      prefetch=False, walltime_reserve=300, md_categories=None,
+                      run_hints=None, status=None):
+    """Construct MD workflows for a whole ensemble of Sims at once.
+
+    Equivalent to calling :func:`make_md_workflow` for each Sim, but the
+    parameters shared by all Sims are validated and turned into task and
+    spec templates once, and the Sims' ``md_status`` is set in a single
+    pass over the ensemble.
+
+    Parameters
+    ----------
+    sims : list
+        MDSynthesis Sims, or paths to them.
+    archives : list
+        Absolute path of the archive directory for each Sim, in the same
+        order as ``sims``.
+
+    All other parameters are as for :func:`make_md_workflow`, and apply to
+    every Sim.
+
+    Returns
+    -------
+    list
+        MD workflows, one per Sim; submit them together with
+        ``LaunchPad.bulk_add_wfs``.
+
+    """
+    import mdsynthesis as mds
+
+    if len(sims) != len(archives):
+        raise ValueError("Need exactly one archive per Sim; got {} Sims and "
+                         "{} archives.".format(len(sims), len(archives)))
+
+    template = _MDWorkflowTemplate(stages, files, md_engine=md_engine,
+                                   md_category=md_category,
+                                   local_category=local_category,
+                                   postrun_wf=postrun_wf, post_wf=post_wf,
+                                   staging_opts=staging_opts, nsteps=nsteps,
+                                   legs_per_job=legs_per_job,
+                                   walltime=walltime, live_sync=live_sync,
+                                   cleanup_opts=cleanup_opts, fetch=fetch,
+                                   prefetch=prefetch,
+                                   walltime_reserve=walltime_reserve,
+                                   md_categories=md_categories,
+                                   run_hints=run_hints, status=status)
+
+    sims = mds.Bundle(sims)
+    sims.categories['md_status'] = 'running'
+
+    if template.status:
+        StatusStore(template.status).submitted([(sim.uuid, sim.name)
+                                                for sim in sims])
+
+    return [template.build(sim.abspath, sim.uuid, sim.name, archive,
+                           dict(sim.categories))
+            for sim, archive in zip(sims, archives)]
+
+
+def make_md_bundles(sims, archives, stages, files, bundle_size=8,
+                    md_engine='gromacs', md_category='md',
+                    local_category='local', postrun_wf=None, post_wf=None,
+                    staging_opts=None, nsteps=None, walltime=None,
+                    walltime_reserve=300, live_sync=None, cleanup_opts=None,
+                    fetch=None, prefetch=False, bundle_mode='multidir',
+                    status=None):
+    """Construct MD workflows that run Sims together, several to a job.
+
+    For systems too small to make good use of a compute node on their own,
+    up to ``bundle_size`` Sims share each MD Firework, each in its own rundir
+    under ``$SCRATCHDIR``. Each Sim still gets its own pull into its own
+    archive, its own cleanup and its own continuation decision; the Sims of
+    a bundle that continue are bundled together again for their next leg,
+    while those that are finished drop out.
+
+    With the default ``bundle_mode`` of 'multidir', ``run_md.sh`` is called
+    once with the rundirs of all Sims in the bundle as its arguments, e.g.
+    for ``gmx mdrun -multidir``; see :class:`~mdworks.firetasks.BundleMDTask`
+    for the alternatives.
+
+    Parameters
+    ----------
+    sims : list
+        MDSynthesis Sims, or paths to them.
+    archives : list
+        Absolute path of the archive directory for each Sim, in the same
+        order as ``sims``.
+    bundle_size : int
+        Maximum number of Sims run together in one MD Firework.
+    bundle_mode : {'multidir', 'parallel', 'serial'}
+        How the Sims of a bundle are run by the MD Firework.
+
+    All other parameters are as for :func:`make_md_workflow`, and apply to
+    every Sim. Each bundle runs a single leg per job in ``md_category``.
+
+    Returns
+    -------
+    list
+        MD workflows, one per bundle; submit them together with
+        ``LaunchPad.bulk_add_wfs``.
+
+    """
+    import mdsynthesis as mds
+
+    if len(sims) != len(archives):
+        raise ValueError("Need exactly one archive per Sim; got {} Sims and "
+                         "{} archives.".format(len(sims), len(archives)))
+
+    template = _MDWorkflowTemplate(stages, files, md_engine=md_engine,
+                                   md_category=md_category,
+                                   local_category=local_category,
+                                   postrun_wf=postrun_wf, post_wf=post_wf,
+                                   staging_opts=staging_opts, nsteps=nsteps,
+                                   walltime=walltime, live_sync=live_sync,
+                                   cleanup_opts=cleanup_opts, fetch=fetch,
+                                   prefetch=prefetch,
+                                   walltime_reserve=walltime_reserve,
+                                   bundle_mode=bundle_mode, status=status)
+
+    sims = mds.Bundle(sims)
+    sims.categories['md_status'] = 'running'
+
+    members = [(sim.abspath, sim.uuid, sim.name, archive)
+               for sim, archive in zip(sims, archives)]
+
+    if template.status:
+        StatusStore(template.status).submitted(
+                [(uuid, name) for _, uuid, name, _ in members])
+
+    return [template.build_bundle(members[i:i + bundle_size])
+            for i in range(0, len(members), bundle_size)]
+
+
+class _MDWorkflowTemplate(object):
+    """Parts of an MD workflow that are the same for every Sim.
+
+    Built once from the shared parameters of :func:`make_md_workflow`, then
+    used to stamp out the workflow for each Sim with :meth:`build`.
+
+    """
+    def __init__(self, stages, files, md_engine='gromacs', md_category='md',
+                 local_category='local', postrun_wf=None, post_wf=None,
+                 staging_opts=None, nsteps=None, legs_per_job=1,
+                 walltime=None, live_sync=None, cleanup_opts=None,
+                 fetch=None, prefetch=False, walltime_reserve=300,
+                 md_categories=None, run_hints=None, bundle_mode='multidir',
+                 status=None):
+        if md_engine == 'gromacs':
+            self.continue_task = GromacsContinueTask
+            self.multileg_task = GromacsMultiLegTask
+            self.bundle_continue_task = GromacsBundleContinueTask
+        else:
+            raise ValueError("No known md engine `{}`.".format(md_engine))
+
+        self.stages = stages
+        self.files = files
+        self.local_category = local_category
+
+        self.stage_params = dict(shell_interpret=True,
+                                 max_retry=5,
+                                 allow_missing=True)
+        self.stage_params.update(staging_opts or {})
+
+        self.cleanup_params = dict(max_retry=5)
+        self.cleanup_params.update(cleanup_opts or {})
+
+        self.md_spec = {'_category': md_category}
+        self.legs_per_job = legs_per_job
+        self.multileg_params = dict(files=files, max_legs=legs_per_job,
+                                    walltime=walltime, nsteps=nsteps,
+                                    walltime_reserve=walltime_reserve)
+
+        # a single leg may use all the walltime; several legs in place each
+        # get their maxh from the walltime left instead
+        if run_hints is None and walltime:
+            run_hints = {'maxh': round(max(walltime - walltime_reserve, 0)
+                                       / 3600., 4)}
+        self.run_hints = run_hints or {}
+        self.live_sync = live_sync
+        self.fetch = fetch
+        self.prefetch = prefetch
+
+        # resolved here, so rockets need not have the environment variable
+        self.status = default_path(status)
+
+        self.continue_params = dict(stages=stages, files=files,
+                                    md_engine=md_engine,
+                                    md_category=md_category,
+                                    local_category=local_category,
+                                    postrun_wf=postrun_wf, post_wf=post_wf,
+                                    staging_opts=staging_opts, nsteps=nsteps,
+                                    legs_per_job=legs_per_job,
+                                    walltime=walltime, live_sync=live_sync,
+                                    cleanup_opts=cleanup_opts, fetch=fetch,
+                                    prefetch=prefetch,
+                                    walltime_reserve=walltime_reserve,
+                                    md_categories=md_categories,
+                                    status=self.status)
+
+        # bundles run single legs, all in md_category
+        self.bundle_mode = bundle_mode
+        self.bundle_continue_params = dict(self.continue_params,
+                                           bundle_mode=bundle_mode)
+        del self.bundle_continue_params['legs_per_job']
+        del self.bundle_continue_params['md_categories']
+
         if isinstance(postrun_wf, dict):
             postrun_wf = Workflow.from_dict(postrun_wf)
+        self.postrun_wf = postrun_wf
+
+    def build(self, sim, uuid, name, archive, metadata):
+        """Workflow for one Sim.
+
+        Parameters
+        ----------
+        sim : str
+            MDSynthesis Sim, or path to it, handed on to the continuation.
+        uuid, name : str
+            The Sim's uuid and name.
+        archive : str
+            Absolute path to the Sim's archive directory.
+        metadata : dict
+            Workflow metadata; the Sim's categories.
+
+        """
+        # Firework copies its spec, so one dict serves all local Fireworks
+        local_spec = {'_launch_dir': archive,
+                      '_category': self.local_category}
+
+        ## Stage input files to all resources, unless they are fetched lazily
+        fws = []
+        if not self.fetch or self.prefetch:
+            ft_stage = StagingTask(stages=self.stages,
+                                   files=self.files,
+                                   archive=archive,
+                                   uuid=uuid,
+                                   **self.stage_params)
+
+            fws.append(Firework([ft_stage],
+                                spec=local_spec,
+                                name='staging'))
+
+        ## MD execution; takes place in queue context of compute resource
+
+        # copy input files to scratch space, fetching any not staged
+        if self.fetch:
+            fetch = dict(self.fetch)
+            mirror = fetch.pop('mirror', None)
+            fetch['source'] = os.path.join(mirror, uuid) if mirror else archive
+            ft_copy = Stage2RunDirTask(uuid=uuid, files=self.files,
+                                       fetch=fetch)
+        else:
+            ft_copy = Stage2RunDirTask(uuid=uuid)
+
+        # send info on where files live to pull firework
+        ft_info = BeaconTask(uuid=uuid)
+
+        # next, run MD; possibly several legs in place
+        if self.legs_per_job > 1:
+            ft_md = self.multileg_task(uuid=uuid, **self.multileg_params)
+        else:
+            ft_md = ScriptTask(script='{}run_md.sh {}'.format(
+                                    _hint_environment(self.run_hints),
+                                    os.path.join('${SCRATCHDIR}/', uuid)),
+                               use_shell=True,
+                               fizzle_bad_rc=True)
+
+        md_tasks = [ft_copy, ft_info, ft_md]
+
+        # optionally stream outputs back while MD runs
+        if self.live_sync:
+            md_tasks = [ft_copy, ft_info,
+                        LiveSyncTask(uuid=uuid, archive=archive,
+                                     **self.live_sync),
+                        ft_md,
+                        LiveSyncStopTask(uuid=uuid)]
+
+        fw_md = Firework(md_tasks,
+                         spec=self.md_spec,
+                         name='md',
+                         parents=fws)
+
+        ## Pull files back to archive; takes place locally
+        ft_copyback = FilePullTask(dest=archive, tail=bool(self.live_sync),
+                                   max_retry=5, uuid=uuid)
+
+        fw_copyback = Firework([ft_copyback],
+                               spec=local_spec,
+                               name='pull',
+                               parents=fw_md)
+
+        ## Clean up files in rundir on remote resource
+        ft_cleanup = CleanupTask(uuid=uuid, **self.cleanup_params)
+
+        fw_cleanup = Firework([ft_cleanup],
+                              spec=local_spec,
+                              name='cleanup',
+                              parents=[fw_copyback, fw_md])
+
+        ## Decide if we need to continue and submit new workflow if so; takes
+        ## place locally
+        ft_continue = self.continue_task(sim=sim, archive=archive,
+                                         **self.continue_params)
+
+        fw_continue = Firework([ft_continue],
+                               spec=local_spec,
+                               name='continue',
+                               parents=fw_cleanup)
+
+        wf = Workflow(fws + [fw_md, fw_copyback, fw_cleanup, fw_continue],
+                      name='{} | md'.format(name),
+                      metadata=metadata)
+
+        ## Mix in postrun workflow, if given
+        if self.postrun_wf:
+            wf.append_wf(Workflow.from_wflow(self.postrun_wf),
+                         [fw_copyback.fw_id])
+
+        return wf
+
+    def build_bundle(self, members):
+        """Workflow running several Sims together in one MD Firework.
+
+        Parameters
+        ----------
+        members : list
+            For each Sim, a tuple of the Sim (or path to it), its uuid and
+            name, and the absolute path to its archive directory.
+
+        """
+        sims, uuids, names, archives = zip(*members)
+
+        ## Stage input files of all Sims to all resources, unless they are
+        ## fetched lazily
+        fws = []
+        if not self.fetch or self.prefetch:
+            ft_stages = [StagingTask(stages=self.stages,
+                                     files=self.files,
+                                     archive=archive,
+                                     uuid=uuid,
+                                     **self.stage_params)
+                         for uuid, archive in zip(uuids, archives)]
+
+            fws.append(Firework(ft_stages,
+                                spec={'_category': self.local_category},
+                                name='staging'))
+
+        ## MD execution of all Sims; takes place in queue context of compute
+        ## resource
+        md_tasks = []
+        for uuid, archive in zip(uuids, archives):
+            if self.fetch:
+                fetch = dict(self.fetch)
+                mirror = fetch.pop('mirror', None)
+                fetch['source'] = (os.path.join(mirror, uuid) if mirror
+                                   else archive)
+                md_tasks.append(Stage2RunDirTask(uuid=uuid, files=self.files,
+                                                 fetch=fetch))
+            else:
+                md_tasks.append(Stage2RunDirTask(uuid=uuid))
+
+            md_tasks.append(BeaconTask(uuid=uuid))
+
+            if self.live_sync:
+                md_tasks.append(LiveSyncTask(uuid=uuid, archive=archive,
+                                             **self.live_sync))
+
+        md_tasks.append(BundleMDTask(uuids=list(uuids), mode=self.bundle_mode,
+                                     run_hints=self.run_hints))
+
+        if self.live_sync:
+            md_tasks.extend(LiveSyncStopTask(uuid=uuid) for uuid in uuids)
+
+        fw_md = Firework(md_tasks,
+                         spec=self.md_spec,
+                         name='md',
+                         parents=list(fws))
+
+        ## Pull each Sim's files back to its archive, and clean up its rundir
+        fws.append(fw_md)
+        pulls = []
+        cleanups = []
+        for uuid, archive in zip(uuids, archives):
+            local_spec = {'_launch_dir': archive,
+                          '_category': self.local_category}
+
+            ft_copyback = FilePullTask(dest=archive,
+                                       tail=bool(self.live_sync),
+                                       max_retry=5, uuid=uuid)
+            fw_copyback = Firework([ft_copyback],
+                                   spec=local_spec,
+                                   name='pull',
+                                   parents=fw_md)
+
+            fw_cleanup = Firework([CleanupTask(uuid=uuid,
+                                               **self.cleanup_params)],
+                                  spec=local_spec,
+                                  name='cleanup',
+                                  parents=[fw_copyback, fw_md])
+
+            fws.extend([fw_copyback, fw_cleanup])
+            pulls.append(fw_copyback)
+            cleanups.append(fw_cleanup)
+
+        ## Decide for each Sim if it continues, and submit a new bundle for
+        ## those that do; takes place locally
+        ft_continue = self.bundle_continue_task(sims=list(sims),
+                                                archives=list(archives),
+                                                **self.bundle_continue_params)
+
+        fw_continue = Firework([ft_continue],
+                               spec={'_category': self.local_category},
+                               name='continue',
+                               parents=cleanups)
+
+        wf = Workflow(fws + [fw_continue],
+                      name='{} | md bundle'.format(', '.join(names)),
+                      metadata={'md_status': 'running', 'uuids': list(uuids)})
+
+        ## Mix in postrun workflow after each Sim's pull, if given
+        if self.postrun_wf:
+            for fw_copyback in pulls:
+                wf.append_wf(Workflow.from_wflow(self.postrun_wf),
+                             [fw_copyback.fw_id])
+
+        return wf
+
 
-        wf.append_wf(Workflow.from_wflow(postrun_wf), [fw_copyback.fw_id])
-        
-    return wf
+def _hint_environment(hints):
+    """Shell prefix passing run length `hints` to ``run_md.sh``."""
+    env = ''
+    if hints.get('maxh') is not None:
+        env += 'MDWORKS_MAXH={} '.format(hints['maxh'])
+    if hints.get('nsteps') is not None:
+        env += 'MDWORKS_NSTEPS={} '.format(hints['nsteps'])
+    return env
@@ -2,17 +2,157 @@ from __future__ import unicode_literals
 
 import os
 
-import mdsynthesis as mds
 from fireworks import FireTaskBase, FWAction, Workflow
 
 
+def cpt_and_tpr(files, directory):
+    """Paths in `directory` of the CPT and TPR files among `files`."""
+    # bit of an ad-hoc way to grab the checkpoint file
+    cpt = [f for f in files
+               if (('cpt' in f) and ('prev' not in f))]
+
+    if len(cpt) > 1:
+        raise ValueError("Multiple CPT files in 'files'; include "
+                         "only one.")
+    elif len(cpt) < 1:
+        raise ValueError("No CPT file in 'files'; "
+                         "cannot do continue check.")
+    else:
+        cpt = os.path.join(directory, cpt[0])
+
+    # bit of an ad-hoc way to grab the tpr file
+    tpr = [f for f in files if ('tpr' in f)]
+
+    if len(tpr) > 1:
+        raise ValueError("Multiple TPR files in 'files'; include "
+                         "only one.")
+    elif len(tpr) < 1:
+        raise ValueError("No TPR file in 'files'; "
+                         "cannot do continue check.")
+    else:
+        tpr = os.path.join(directory, tpr[0])
+
+    return cpt, tpr
+
+
+def mdrun_log(files, directory, tpr):
+    """Path in `directory` of the mdrun log; the log among `files`, or else
+    named after the TPR as mdrun's ``-deffnm`` would."""
+    logs = [f for f in files if f.endswith('.log')]
+    if logs:
+        return os.path.join(directory, logs[0])
+    return os.path.join(directory, '{}.log'.format(
+        os.path.splitext(os.path.basename(tpr))[0]))
+
+
+class GromacsMultiLegTask(FireTaskBase):
+    """
+    A FireTask to run several MD legs back to back in the same rundir on
+    the compute resource, in place of a single ``run_md.sh`` call.
+
+    After each leg the step in the rundir's CPT file is checked against the
+    TPR's nsteps, as in ``GromacsContinueTask``. Another leg is started only
+    if steps remain, fewer than `max_legs` legs have run, and the remaining
+    walltime is expected to fit it; the workflow then pulls back to the
+    archive and continues from there as usual.
+
+    Parameters
+    ----------
+    uuid : str
+        uuid of the Sim; the rundir is ``$SCRATCHDIR/<uuid>``.
+    files : list
+        Names of files needed for each leg; used to find the CPT and TPR.
+    max_legs : int
+        Maximum number of legs to run in this job.
+    walltime : float, optional
+        Seconds of walltime available to this task, counted from its start;
+        defaults to the ``MDWORKS_WALLTIME`` environment variable, if set.
+        Without it, legs are limited only by `max_legs`.
+    leg_margin : float, optional
+        A new leg is started only if the remaining walltime exceeds the
+        longest leg so far times this factor; defaults to 1.2.
+    nsteps : int, optional
+        Total number of steps to run; if given, the TPR is not inspected.
+    walltime_reserve : float, optional
+        With a walltime, each leg is hinted to stop this many seconds before
+        it is up, through ``MDWORKS_MAXH``; defaults to 300.
+
+    """
+    _fw_name = 'GromacsMultiLegTask'
+    required_params = ["uuid", "files", "max_legs"]
+    optional_params = ["walltime", "leg_margin", "nsteps", "walltime_reserve"]
+
+    def run_task(self, fw_spec):
+        import time
+        import subprocess
+        from ..metrics import Phase, stored_key
+        from .xdr import read_cpt_header, tpr_nsteps
+
+        start = time.time()
+        rundir = os.path.join(os.environ['SCRATCHDIR'], self['uuid'])
+        cpt, tpr = cpt_and_tpr(self['files'], rundir)
+
+        # workflow builders pass walltime=None explicitly when not given
+        walltime = self.get('walltime') or os.environ.get('MDWORKS_WALLTIME')
+        walltime = float(walltime) if walltime else None
+        margin = self.get('leg_margin', 1.2)
+        reserve = self.get('walltime_reserve', 300)
+
+        nsteps = self.get('nsteps')
+        if nsteps is None:
+            nsteps = tpr_nsteps(tpr)
+
+        durations = []
+        step = None
+        with Phase('md', uuid=self['uuid']) as phase:
+            while len(durations) < self['max_legs']:
+                t0 = time.time()
+                env = dict(os.environ)
+                if walltime is not None:
+                    left = walltime - (t0 - start) - reserve
+                    env['MDWORKS_MAXH'] = str(round(max(left, 0) / 3600., 4))
+
+                rc = subprocess.call('run_md.sh {}'.format(rundir), shell=True,
+                                     env=env)
+                durations.append(time.time() - t0)
+
+                if rc != 0:
+                    raise RuntimeError("run_md.sh exited with status {} on leg "
+                                       "{}".format(rc, len(durations)))
+
+                step = read_cpt_header(cpt)['step']
+                if step >= nsteps:
+                    break
+
+                if walltime is not None:
+                    remaining = walltime - (time.time() - start)
+                    if remaining < max(durations) * margin:
+                        break
+
+        summary = {'legs': len(durations),
+                   'leg_seconds': [round(d, 1) for d in durations],
+                   'step': step,
+                   'nsteps': nsteps}
+
+        return FWAction(stored_data=dict(summary, **{
+            stored_key('metrics', 'md', self['uuid']): [
+                phase.record(**summary)]}))
+
+
 class GromacsContinueTask(FireTaskBase):
     """
     A FireTask to check the step listed in the CPT file against the total
     number of steps desired in the TPR file. If there are steps left to
     go, another MD workflow is submitted.
 
-    Requires `gmx dump` be present in the session's PATH.
+    The performance of the leg just run is read from the mdrun log and kept
+    in the Sim's history (see :mod:`mdworks.gromacs.perf`), which sizes the
+    next leg to the walltime and, given `md_categories`, picks the category
+    it runs in.
+
+    The step is read directly from the CPT file header. The TPR's nsteps is
+    cached next to the TPR after it is first read, which requires `gmx dump`
+    be present in the session's PATH unless `nsteps` is given.
 
     Parameters
     ----------
@@ -41,6 +181,28 @@ class GromacsContinueTask(FireTaskBase):
     files : list 
         Names of files (not paths) needed for each leg of the simulation. Need
         not exist, but if they do they will get staged before each run.
+    staging_opts : dict, optional
+        Additional optional parameters for each leg's ``StagingTask``.
+    nsteps : int, optional
+        Total number of steps to run; if given, the TPR is not inspected.
+    legs_per_job : int, optional
+        Maximum number of legs each MD Firework runs in place.
+    walltime : float, optional
+        Seconds of walltime each MD Firework has.
+    live_sync : dict, optional
+        How each MD Firework streams outputs back to the archive.
+    cleanup_opts : dict, optional
+        Additional optional parameters for each leg's ``CleanupTask``.
+    fetch : dict, optional
+        Where each leg's MD Firework fetches its inputs from, if lazily.
+    prefetch : bool, optional
+        Whether inputs fetched lazily are still staged to all resources.
+    walltime_reserve : float, optional
+        Seconds of each MD Firework's walltime kept back around MD itself.
+    md_categories : list, optional
+        Categories to route each next leg to the fastest of.
+    status : str, optional
+        Path of the status log to record each leg's progress in.
 
     """
     _fw_name = 'GromacsContinueTask'
@@ -53,75 +215,292 @@ class GromacsContinueTask(FireTaskBase):
                        "md_category",
                        "postrun_wf",
                        "post_wf"]
+    optional_params = ["staging_opts", "nsteps", "legs_per_job", "walltime",
+                       "live_sync", "cleanup_opts", "fetch", "prefetch",
+                       "walltime_reserve", "md_categories", "status"]
 
     def run_task(self, fw_spec):
-        import gromacs
+        import mdsynthesis as mds
         from ..general import make_md_workflow
+        from ..metrics import Phase, stored_key
+        from ..status import StatusStore
+        from .perf import choose_category, leg_hints
+
+        sim = mds.Sim(self['sim'])
+
+        with Phase('continue', uuid=sim.uuid) as phase:
+            leg = check_leg(self['archive'], self['files'],
+                            nsteps=self.get('nsteps'),
+                            md_category=self['md_category'])
+            step, nsteps, history = leg['step'], leg['nsteps'], leg['history']
+
+            if self.get('status'):
+                StatusStore(self['status']).append(
+                        [leg_status(sim, leg, self['md_category'])])
+
+            # size and place the next leg by the performance so far
+            md_category = self['md_category']
+            if self.get('md_categories'):
+                md_category = choose_category(history, self['md_categories'])
+
+            reserve = self.get('walltime_reserve', 300)
+            hints = leg_hints(history, step, nsteps, self.get('walltime'),
+                              md_category, reserve=reserve)
+
+            # if step < nsteps, we submit a new workflow
+            if step < nsteps:
+                wf = make_md_workflow(sim=self['sim'],
+                                      archive=self['archive'],
+                                      stages=self['stages'],
+                                      files=self['files'],
+                                      md_engine=self['md_engine'],
+                                      md_category=md_category,
+                                      local_category=self['local_category'],
+                                      postrun_wf=self['postrun_wf'],
+                                      post_wf=self['post_wf'],
+                                      staging_opts=self.get('staging_opts'),
+                                      nsteps=self.get('nsteps'),
+                                      legs_per_job=self.get('legs_per_job', 1),
+                                      walltime=self.get('walltime'),
+                                      live_sync=self.get('live_sync'),
+                                      cleanup_opts=self.get('cleanup_opts'),
+                                      fetch=self.get('fetch'),
+                                      prefetch=self.get('prefetch', False),
+                                      walltime_reserve=reserve,
+                                      md_categories=self.get('md_categories'),
+                                      run_hints=hints or None,
+                                      status=self.get('status'))
+                additions = [wf]
+            else:
+                additions = finish(sim, self.get('post_wf'))
 
-        # bit of an ad-hoc way to grab the checkpoint file
-        cpt = [f for f in self['files']
-                   if (('cpt' in f) and ('prev' not in f))]
-
-        if len(cpt) > 1:
-            raise ValueError("Multiple CPT files in 'files'; include "
-                             "only one.")
-        elif len(cpt) < 1:
-            raise ValueError("No CPT file in 'files'; "
-                             "cannot do continue check.")
-        else:
-            cpt = os.path.join(self['archive'], cpt[0])
-
-        # bit of an ad-hoc way to grab the tpr file
-        tpr = [f for f in self['files'] if ('tpr' in f)]
-
-        if len(tpr) > 1:
-            raise ValueError("Multiple TPR files in 'files'; include "
-                             "only one.")
-        elif len(tpr) < 1:
-            raise ValueError("No TPR file in 'files'; "
-                             "cannot do continue check.")
-        else:
-            tpr = os.path.join(self['archive'], tpr[0])
-
-        # let's extract the current frame and place it in the archive, since
-        # this is useful for starting runs up at any point from the current end
+        record = phase.record(step=step, nsteps=nsteps,
+                              md_category=md_category, run_hints=hints,
+                              ns_per_day=(history[-1]['ns_per_day']
+                                          if history else None),
+                              trjconv_seconds=leg['trjconv_seconds'],
+                              nsteps_seconds=leg['nsteps_seconds'])
+
+        return FWAction(additions=additions, stored_data={
+            stored_key('metrics', 'continue', sim.uuid): [record]})
+
+
+class GromacsBundleContinueTask(FireTaskBase):
+    """
+    A FireTask to decide, for each Sim of a bundle that just ran together in
+    one MD Firework, whether it continues, as ``GromacsContinueTask`` does
+    for a single Sim. The Sims that continue are submitted as one new bundle;
+    those finished get their ``post_wf``.
+
+    Parameters
+    ----------
+    sims : list
+        MDSynthesis Sims, or paths to them.
+    archives : list
+        Absolute path of the archive directory of each Sim.
+
+    All other parameters are as for ``GromacsContinueTask``, and apply to
+    every Sim; in addition:
+
+    bundle_mode : str, optional
+        How the bundle runs its Sims; see ``BundleMDTask``.
+    status : str, optional
+        Path of the status log to record each leg's progress in.
+
+    """
+    _fw_name = 'GromacsBundleContinueTask'
+    required_params = ["sims",
+                       "archives",
+                       "stages",
+                       "files",
+                       "md_engine",
+                       "local_category",
+                       "md_category",
+                       "postrun_wf",
+                       "post_wf"]
+    optional_params = ["staging_opts", "nsteps", "walltime",
+                       "walltime_reserve", "live_sync", "cleanup_opts",
+                       "fetch", "prefetch", "bundle_mode", "status"]
+
+    def run_task(self, fw_spec):
+        import mdsynthesis as mds
+        from ..general import make_md_bundles
+        from ..metrics import Phase
+        from ..status import StatusStore
+
+        additions = []
+        records = []
+        statuses = []
+        continuing = []
+        for path, archive in zip(self['sims'], self['archives']):
+            sim = mds.Sim(path)
+
+            with Phase('continue', uuid=sim.uuid) as phase:
+                leg = check_leg(archive, self['files'],
+                                nsteps=self.get('nsteps'),
+                                md_category=self['md_category'])
+                statuses.append(leg_status(sim, leg, self['md_category']))
+
+                if leg['step'] < leg['nsteps']:
+                    continuing.append((path, archive))
+                else:
+                    additions.extend(finish(sim, self.get('post_wf')))
+
+            history = leg['history']
+            records.append(phase.record(
+                step=leg['step'], nsteps=leg['nsteps'],
+                ns_per_day=history[-1]['ns_per_day'] if history else None,
+                trjconv_seconds=leg['trjconv_seconds'],
+                nsteps_seconds=leg['nsteps_seconds']))
+
+        # one append for the whole bundle
+        if self.get('status'):
+            StatusStore(self['status']).append(statuses)
+
+        if continuing:
+            sims, archives = zip(*continuing)
+            additions.extend(make_md_bundles(
+                    list(sims), list(archives),
+                    stages=self['stages'],
+                    files=self['files'],
+                    bundle_size=len(sims),
+                    md_engine=self['md_engine'],
+                    md_category=self['md_category'],
+                    local_category=self['local_category'],
+                    postrun_wf=self['postrun_wf'],
+                    post_wf=self['post_wf'],
+                    staging_opts=self.get('staging_opts'),
+                    nsteps=self.get('nsteps'),
+                    walltime=self.get('walltime'),
+                    walltime_reserve=self.get('walltime_reserve', 300),
+                    live_sync=self.get('live_sync'),
+                    cleanup_opts=self.get('cleanup_opts'),
+                    fetch=self.get('fetch'),
+                    prefetch=self.get('prefetch', False),
+                    bundle_mode=self.get('bundle_mode', 'multidir'),
+                    status=self.get('status')))
+
+        return FWAction(additions=additions,
+                        stored_data={'metrics_continue': records})
+
+
+def check_leg(archive, files, nsteps=None, md_category=None):
+    """Where a Sim stands after a leg, from the files pulled to `archive`.
+
+    Extracts the current frame into the archive as a GRO file, reads the
+    step reached from the CPT file and, unless given, the total `nsteps`
+    from the TPR, and adds the leg's performance to the Sim's history.
+
+    Returns
+    -------
+    dict
+        'step', 'nsteps', 'history' and the 'host' the leg ran on, and the
+        seconds taken by trjconv and by finding nsteps.
+
+    """
+    import gromacs
+    from ..metrics import Phase
+    from .xdr import read_cpt_header, tpr_nsteps
+    from .perf import record_leg
+
+    cpt, tpr = cpt_and_tpr(files, archive)
+
+    # let's extract the current frame and place it in the archive, since
+    # this is useful for starting runs up at any point from the current end
+    with Phase('trjconv') as trjconv:
         gromacs.trjconv(f=cpt, s=tpr,
-                        o=os.path.join(self['archive'], '{}.gro'.format(
+                        o=os.path.join(archive, '{}.gro'.format(
                             os.path.splitext(os.path.basename(tpr))[0])),
                         input=('0',))
 
-        # extract step number from CPT file
-        out = gromacs.dump(cp=cpt, stdout=False)
-        step = int([line.split(' ')[-1] for line in out[1].split('\n') if 'step = ' in line][0])
-
-        # extract nsteps from TPR file
-        out = gromacs.dump(s=tpr, stdout=False)
-        nsteps = int([line.split(' ')[-1] for line in out[1].split('\n') if 'nsteps' in line][0])
-
-        # if step < nsteps, we submit a new workflow
-        if step < nsteps:
-            wf = make_md_workflow(sim=self['sim'],
-                                  archive=self['archive'],
-                                  stages=self['stages'],
-                                  files=self['files'],
-                                  md_engine=self['md_engine'],
-                                  md_category=self['md_category'],
-                                  local_category=self['local_category'],
-                                  postrun_wf=self['postrun_wf'],
-                                  post_wf=self['post_wf'])
-
-            return FWAction(additions=[wf])
-        else:
-            sim = mds.Sim(self['sim'])
-            sim.categories['md_status'] = 'finished'
-
-            # if given, we submit the post workflow
-            post_wf = self.get('post_wf')
-            if post_wf:
-                if isinstance(post_wf, dict):
-                    post_wf = Workflow.from_dict(post_wf)
-
-                # this makes a fresh copy without already-used fw_ids
-                post_wf = Workflow.from_wflow(post_wf)
-
-                return FWAction(additions=[post_wf])
+    # extract step number from CPT file header
+    step = read_cpt_header(cpt)['step']
+
+    # extract nsteps from TPR file, unless given
+    with Phase('nsteps') as read_nsteps:
+        if nsteps is None:
+            nsteps = tpr_nsteps(tpr)
+
+    # keep the leg's performance
+    history = record_leg(archive, mdrun_log(files, archive, tpr), step,
+                         md_category)
+
+    # the host is known only if the leg's log had a summary
+    host = (history[-1]['host']
+            if history and history[-1]['step'] == step else None)
+
+    return {'step': step,
+            'nsteps': nsteps,
+            'history': history,
+            'host': host,
+            'trjconv_seconds': round(trjconv.seconds, 3),
+            'nsteps_seconds': round(read_nsteps.seconds, 3)}
+
+
+def leg_status(sim, leg, md_category):
+    """Status record of the leg `leg` of `sim`, as given by `check_leg`."""
+    return {'uuid': sim.uuid,
+            'name': sim.name,
+            'event': 'leg',
+            'step': leg['step'],
+            'nsteps': leg['nsteps'],
+            'finished': leg['step'] >= leg['nsteps'],
+            'host': leg['host'],
+            'md_category': md_category}
+
+
+def finish(sim, post_wf):
+    """Mark `sim` as finished; returns the workflows to submit after it."""
+    sim.categories['md_status'] = 'finished'
+
+    # if given, we submit the post workflow
+    if not post_wf:
+        return []
+
+    if isinstance(post_wf, dict):
+        post_wf = Workflow.from_dict(post_wf)
+
+    # this makes a fresh copy without already-used fw_ids
+    return [Workflow.from_wflow(post_wf)]
+
+
+class GromacsXTCAggregateTask(FireTaskBase):
+    """
+    A FireTask to append the trajectory segments in a Sim's archive to a
+    single master trajectory, dropping the frames duplicated at leg
+    boundaries, and to keep a frame offset index for it; see
+    :mod:`mdworks.gromacs.xtc`. Only what the segments gained since the
+    last run is read. Meant for a ``postrun_wf``, so it runs after each pull.
+
+    Parameters
+    ----------
+    archive : str, optional
+        Archive directory holding the segments; defaults to the directory
+        the preceding ``FilePullTask`` pulled into, or else the launch
+        directory.
+    master : str, optional
+        Name of the master trajectory in the archive; defaults to
+        'traj.xtc'. Its index is kept next to it with suffix ``.idx``.
+    pattern : str, optional
+        Glob pattern of segment names; defaults to '*.xtc'.
+
+    """
+    _fw_name = 'GromacsXTCAggregateTask'
+    optional_params = ["archive", "master", "pattern"]
+
+    def run_task(self, fw_spec):
+        from ..metrics import Phase
+        from .xtc import XTCAggregator
+
+        archive = (self.get('archive') or fw_spec.get('archive')
+                   or os.getcwd())
+        aggregator = XTCAggregator(archive,
+                                   master=self.get('master', 'traj.xtc'),
+                                   pattern=self.get('pattern', '*.xtc'))
+
+        with Phase('aggregate') as phase:
+            result = aggregator.update()
+
+        return FWAction(stored_data={'aggregate': result,
+                                     'metrics_aggregate': [
+                                         phase.record(**result)]})
@@ -0,0 +1,200 @@
+"""
+Per-Sim history of how fast MD legs ran, and hints for the next leg.
+
+After each leg, the performance summary mdrun writes at the end of its log is
+appended to a history kept in the Sim's archive. From it the continuation
+estimates how many steps the next leg can do in the walltime available, and
+which of several resource categories runs the Sim fastest.
+
+Hints reach ``run_md.sh`` through the environment:
+
+    MDWORKS_MAXH
+        Hours mdrun may run for; pass on as ``-maxh`` so that mdrun writes a
+        checkpoint and stops cleanly before the allocation ends.
+    MDWORKS_NSTEPS
+        Step the leg is expected to reach; pass on as ``-nsteps``, which for
+        a continuation counts from the start of the run, not of the leg.
+
+e.g. ``gmx mdrun ... ${MDWORKS_MAXH:+-maxh $MDWORKS_MAXH}
+${MDWORKS_NSTEPS:+-nsteps $MDWORKS_NSTEPS}``.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import json
+import time
+
+#: name of the performance history kept in each Sim's archive
+PERF_HISTORY = '.mdworks-perf.json'
+
+_HOST = re.compile(r'Hardware detected on host (\S+)')
+_STEPS = re.compile(r'Statistics over (\d+) steps')
+_TIME = re.compile(r'^\s*Time:\s+([\d.]+)\s+([\d.]+)', re.M)
+_PERFORMANCE = re.compile(r'^Performance:\s+([\d.]+)', re.M)
+
+
+def parse_log(path, tail=1 << 20):
+    """Performance of the last run in the mdrun log at `path`.
+
+    Only the last `tail` bytes are read, which hold the summary mdrun
+    writes when a run ends.
+
+    Returns
+    -------
+    dict
+        'steps' run, 'wall_seconds', 'ns_per_day' and, if found, the 'host'
+        of the last run; None if the log holds no complete summary.
+
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - tail))
+        text = f.read().decode('utf-8', 'replace')
+
+    # each run, including appending continuations, starts a new section
+    start = text.rfind('Log file opened on')
+    if start >= 0:
+        text = text[start:]
+
+    steps = _STEPS.findall(text)
+    times = _TIME.findall(text)
+    perf = _PERFORMANCE.findall(text)
+    if not (steps and times and perf):
+        return None
+
+    host = _HOST.findall(text)
+    return {'steps': int(steps[-1]),
+            'wall_seconds': float(times[-1][1]),
+            'ns_per_day': float(perf[-1]),
+            'host': host[-1] if host else None}
+
+
+def read_history(archive):
+    """Performance history of the Sim with archive directory `archive`."""
+    try:
+        with open(os.path.join(archive, PERF_HISTORY)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def write_history(archive, history):
+    """Atomically replace the performance history in `archive`."""
+    path = os.path.join(archive, PERF_HISTORY)
+    with open(path + '.part', 'w') as f:
+        json.dump(history, f)
+    os.rename(path + '.part', path)
+
+
+def record_leg(archive, log, step, md_category):
+    """Add the leg that ended at `step` to the Sim's history.
+
+    Parameters
+    ----------
+    archive : str
+        Sim's archive directory, holding the pulled mdrun `log`.
+    log : str
+        Path to the mdrun log of the leg.
+    step : int
+        Step in the checkpoint after the leg.
+    md_category : str
+        Category of the Firework the leg ran in.
+
+    Returns
+    -------
+    list
+        The updated history; unchanged if the log has no summary, or the
+        leg was already recorded.
+
+    """
+    history = read_history(archive)
+    if history and history[-1]['step'] == step:
+        return history
+
+    perf = parse_log(log) if os.path.exists(log) else None
+    if perf is None:
+        return history
+
+    perf.update(step=step, md_category=md_category, time=int(time.time()),
+                steps_per_second=(perf['steps'] / perf['wall_seconds']
+                                  if perf['wall_seconds'] else None))
+    history.append(perf)
+    write_history(archive, history)
+
+    return history
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[n // 2] if n % 2
+            else (values[n // 2 - 1] + values[n // 2]) / 2.)
+
+
+def steps_per_second(history, md_category=None, last=3):
+    """Median rate of the `last` legs, in `md_category` if any ran there;
+    None without history."""
+    legs = [h for h in history if h.get('steps_per_second')]
+    same = [h for h in legs if h['md_category'] == md_category]
+    legs = (same or legs)[-last:]
+    if not legs:
+        return None
+    return _median([h['steps_per_second'] for h in legs])
+
+
+def choose_category(history, md_categories, last=3):
+    """Category among `md_categories` in which the Sim runs fastest.
+
+    Categories the Sim has not run in yet are tried first, in order.
+
+    """
+    rates = {}
+    for category in md_categories:
+        legs = [h for h in history if h['md_category'] == category
+                and h.get('steps_per_second')][-last:]
+        if not legs:
+            return category
+        rates[category] = _median([h['steps_per_second'] for h in legs])
+
+    return max(md_categories, key=lambda c: rates[c])
+
+
+def leg_hints(history, step, nsteps, walltime, md_category=None,
+              reserve=300):
+    """Run length hints for the next leg.
+
+    Parameters
+    ----------
+    history : list
+        The Sim's performance history.
+    step, nsteps : int
+        Step reached so far, and total steps to run.
+    walltime : float
+        Seconds of walltime the next MD Firework has; without it, no hints
+        are given.
+    md_category : str
+        Category the next leg runs in.
+    reserve : float
+        Seconds of the walltime kept back for setting up and finishing the
+        leg.
+
+    Returns
+    -------
+    dict
+        'maxh' and, given a rate estimate, 'nsteps'.
+
+    """
+    if not walltime:
+        return {}
+
+    budget = max(float(walltime) - reserve, 0.)
+    hints = {'maxh': round(budget / 3600., 4)}
+
+    rate = steps_per_second(history, md_category)
+    if rate:
+        hints['nsteps'] = int(min(nsteps, step + rate * budget))
+
+    return hints
+
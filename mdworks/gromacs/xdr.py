@@ -0,0 +1,233 @@
+"""
+Native readers for the headers of GROMACS checkpoint (CPT) and run input
+(TPR) files.
+
+Both formats are XDR-encoded (big-endian, 4-byte aligned). Only the leading
+header is read, so these are cheap regardless of system size and need no
+GROMACS installation.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import json
+import struct
+
+#: magic number opening every checkpoint file
+CPT_MAGIC1 = 171817
+
+#: name of the per-directory cache of TPR nsteps values
+TPR_CACHE = '.mdworks-tpr.json'
+
+
+class XDRReader(object):
+    """Sequential reader of XDR primitives from a binary file object."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def _unpack(self, fmt, size):
+        data = self.f.read(size)
+        if len(data) != size:
+            raise EOFError("Unexpected end of XDR data")
+        return struct.unpack(fmt, data)[0]
+
+    def int(self):
+        return self._unpack('>i', 4)
+
+    def int64(self):
+        return self._unpack('>q', 8)
+
+    def float(self):
+        return self._unpack('>f', 4)
+
+    def double(self):
+        return self._unpack('>d', 8)
+
+    def real(self, double):
+        return self.double() if double else self.float()
+
+    def string(self):
+        """XDR string: length, then bytes padded to a multiple of 4."""
+        n = self._unpack('>I', 4)
+        data = self.f.read(n + (-n % 4))
+        if len(data) < n:
+            raise EOFError("Unexpected end of XDR data")
+        return data[:n].decode('utf-8', 'replace')
+
+    def gmx_string(self):
+        """String as written by ``gmx_fio_do_string``: size including the
+        terminating null, then an XDR string."""
+        self.int()
+        return self.string().rstrip('\x00')
+
+
+def read_cpt_header(path):
+    """Read the header of a GROMACS checkpoint file.
+
+    Mirrors ``do_cpt_header`` in GROMACS' ``checkpoint.cpp``.
+
+    Returns
+    -------
+    dict
+        Keys include 'version', 'file_version', 'natoms', 'integrator',
+        'simulation_part', 'step' and 't'.
+
+    """
+    with open(path, 'rb') as f:
+        xd = XDRReader(f)
+
+        magic = xd.int()
+        if magic != CPT_MAGIC1:
+            raise ValueError("{} is not a GROMACS checkpoint file "
+                             "(magic {})".format(path, magic))
+
+        header = {'version': xd.string()}
+        for key in ('btime', 'buser', 'bhost', 'fprog', 'ftime'):
+            header[key] = xd.string()
+
+        v = header['file_version'] = xd.int()
+        header['double_prec'] = xd.int() if v >= 13 else -1
+        if v >= 12:
+            header['host'] = xd.string()
+        header['natoms'] = xd.int()
+        header['ngtc'] = xd.int()
+        header['nhchainlength'] = xd.int() if v >= 10 else 1
+        header['nnhpres'] = xd.int() if v >= 11 else 0
+        header['nlambda'] = xd.int() if v >= 14 else 0
+        header['integrator'] = xd.int()
+        header['simulation_part'] = xd.int() if v >= 3 else 1
+        header['step'] = xd.int64() if v >= 5 else xd.int()
+        header['t'] = xd.double()
+
+    return header
+
+
+def read_tpr_header(path):
+    """Read the header of a GROMACS run input file.
+
+    Mirrors ``do_tpxheader`` in GROMACS' ``tpxio.cpp``. The inputrec, which
+    holds ``nsteps``, follows the full topology and is not reached here; see
+    :func:`tpr_nsteps`.
+
+    Returns
+    -------
+    dict
+        Keys 'version', 'precision', 'file_version', 'file_generation',
+        'natoms', 'ngtc', 'lambda' and the presence flags 'bIr', 'bTop',
+        'bX', 'bV', 'bF', 'bBox'.
+
+    """
+    with open(path, 'rb') as f:
+        xd = XDRReader(f)
+
+        version = xd.gmx_string()
+        if not version.startswith('VERSION'):
+            raise ValueError("{} is not a GROMACS run input file".format(path))
+
+        header = {'version': version, 'precision': xd.int()}
+        double = header['precision'] == 8
+
+        v = header['file_version'] = xd.int()
+        if 77 <= v <= 79:
+            header['file_tag'] = xd.gmx_string()
+        header['file_generation'] = xd.int()
+        if v >= 81:
+            header['file_tag'] = xd.gmx_string()
+
+        header['natoms'] = xd.int()
+        header['ngtc'] = xd.int() if v >= 28 else 0
+        if v < 62:
+            xd.int()
+            xd.real(double)
+        if v >= 79:
+            header['fep_state'] = xd.int()
+        header['lambda'] = xd.real(double)
+        for flag in ('bIr', 'bTop', 'bX', 'bV', 'bF', 'bBox'):
+            header[flag] = bool(xd.int())
+
+    return header
+
+
+def _dump_nsteps(tpr):
+    """Get nsteps from ``gmx dump``, stopping as soon as it is printed.
+
+    The inputrec is dumped before the topology, so only the first part of
+    the output is ever read.
+
+    """
+    import gromacs
+
+    pattern = re.compile(r'^\s*nsteps\s*=\s*(-?\d+)')
+    proc = gromacs.dump.Popen(s=tpr, stdout=False, stderr=False)
+    try:
+        for line in proc.stdout:
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            match = pattern.match(line)
+            if match:
+                return int(match.group(1))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+    raise ValueError("No nsteps found in dump of {}".format(tpr))
+
+
+def _tpr_key(tpr, block=1 << 20):
+    """Size of a TPR file and a digest of its first and last `block` bytes.
+
+    Between them, these blocks hold the inputrec in both the older layout,
+    which puts it before the topology, and the current one, which puts it
+    last. Unlike the mtime, the key survives the TPR being pulled back and
+    forth between legs.
+
+    """
+    import hashlib
+
+    size = os.path.getsize(tpr)
+    h = hashlib.md5()
+    with open(tpr, 'rb') as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            h.update(f.read(block))
+    return {'size': size, 'digest': h.hexdigest()}
+
+
+def tpr_nsteps(tpr):
+    """Total number of steps requested by a TPR file.
+
+    The value is cached in a :data:`TPR_CACHE` file next to the TPR, keyed
+    by its size and a digest of the blocks holding its inputrec, so an
+    unchanged TPR is only ever inspected once, however often it is copied
+    between legs.
+
+    """
+    cache = os.path.join(os.path.dirname(os.path.abspath(tpr)), TPR_CACHE)
+    name = os.path.basename(tpr)
+    key = _tpr_key(tpr)
+
+    try:
+        with open(cache, 'r') as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        entries = {}
+
+    entry = entries.get(name)
+    if entry and all(entry.get(k) == val for k, val in key.items()):
+        return entry['nsteps']
+
+    # cheap sanity check before anything heavier
+    if not read_tpr_header(tpr)['bIr']:
+        raise ValueError("{} holds no inputrec".format(tpr))
+
+    entries[name] = dict(key, nsteps=_dump_nsteps(tpr))
+    tmp = cache + '.part'
+    with open(tmp, 'w') as f:
+        json.dump(entries, f)
+    os.rename(tmp, cache)
+
+    return entries[name]['nsteps']
@@ -0,0 +1,250 @@
+"""
+Incremental aggregation of XTC trajectory segments.
+
+Each leg leaves a trajectory segment in the archive, either a new
+``.partNNNN.xtc`` file or a longer version of one already there. The segments
+are appended to a single master trajectory as raw frames, without decoding
+coordinates, dropping frames at or before the last step already in the master
+so that the overlap at leg boundaries appears only once.
+
+Next to the master, an index holds one fixed-size record per frame, with the
+frame's byte offset, step and time. Frame ``i`` is therefore found in constant
+time, without reading the trajectory, and each aggregation only reads what the
+segments gained since the last one.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import struct
+
+#: magic numbers of XTC frames; 2023 frames have a 64-bit byte count
+XTC_MAGIC = (1995, 2023)
+
+#: one index record: frame offset, step and time
+_RECORD = struct.Struct('>qqd')
+
+_HEADER = struct.Struct('>iiif')
+
+
+def read_frame_header(f):
+    """Read the frame starting at the position of open file `f`.
+
+    Returns
+    -------
+    tuple
+        ``(size, step, time, data)``, with the frame's size in bytes and its
+        raw bytes; None if `f` holds no complete frame there.
+
+    """
+    head = f.read(92)
+    if len(head) < 56:
+        return None
+
+    magic, natoms, step, time = _HEADER.unpack_from(head)
+    if magic not in XTC_MAGIC:
+        raise ValueError("Not an XTC frame at offset {}".format(
+            f.tell() - len(head)))
+
+    if natoms <= 9:
+        # small systems are stored uncompressed
+        size = 56 + 12 * natoms
+    else:
+        if magic == 2023:
+            head += f.read(4)
+            if len(head) < 96:
+                return None
+            nbytes, = struct.unpack_from('>q', head, 88)
+            start = 96
+        else:
+            if len(head) < 92:
+                return None
+            nbytes, = struct.unpack_from('>i', head, 88)
+            start = 92
+        size = start + nbytes + (-nbytes % 4)
+
+    rest = f.read(size - len(head)) if size > len(head) else b''
+    data = (head + rest)[:size]
+    if len(data) < size:
+        return None
+
+    # a short frame read the start of the next one; step back over it
+    if len(head) > size:
+        f.seek(size - len(head), os.SEEK_CUR)
+
+    return size, step, time, data
+
+
+def first_step(path):
+    """Step of the first frame in XTC file `path`; None if it has none."""
+    with open(path, 'rb') as f:
+        frame = read_frame_header(f)
+    return frame[1] if frame else None
+
+
+class XTCIndex(object):
+    """Frame offset index of a master trajectory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the index file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.path) // _RECORD.size
+        except OSError:
+            return 0
+
+    def __getitem__(self, i):
+        """``(offset, step, time)`` of frame `i`."""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("frame {} out of range".format(i))
+
+        with open(self.path, 'rb') as f:
+            f.seek(i * _RECORD.size)
+            return _RECORD.unpack(f.read(_RECORD.size))
+
+    def read_frame(self, master, i):
+        """Raw bytes of frame `i` of trajectory `master`."""
+        offset = self[i][0]
+        with open(master, 'rb') as f:
+            f.seek(offset)
+            return read_frame_header(f)[3]
+
+
+class XTCAggregator(object):
+    """Append XTC segments in a directory to one master trajectory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the segments and the master.
+    master : str
+        Name of the master trajectory.
+    pattern : str
+        Glob pattern of segment names; the master itself is never a segment.
+
+    """
+    def __init__(self, directory, master='traj.xtc', pattern='*.xtc'):
+        self.directory = directory
+        self.master = os.path.join(directory, master)
+        self.pattern = pattern
+        self.index = XTCIndex(self.master + '.idx')
+        self.state_path = self.master + '.state.json'
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'frames': 0, 'size': 0, 'last_step': None,
+                    'segments': {}}
+
+    def _save_state(self, state):
+        with open(self.state_path + '.part', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.state_path + '.part', self.state_path)
+
+    def segments(self):
+        """Segment paths, in order of their first step."""
+        import glob
+
+        paths = [p for p in glob.glob(os.path.join(self.directory,
+                                                   self.pattern))
+                 if os.path.abspath(p) != os.path.abspath(self.master)]
+        steps = {p: first_step(p) for p in paths}
+        return sorted((p for p in paths if steps[p] is not None),
+                      key=lambda p: (steps[p], p))
+
+    def update(self):
+        """Append what the segments gained since the last update.
+
+        Returns
+        -------
+        dict
+            Number of frames appended and skipped as overlap, bytes read
+            from segments, and frames in the master.
+
+        """
+        import fcntl
+
+        with open(self.state_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            state = self._load_state()
+            # drop anything written after the last completed update
+            self._truncate(state)
+
+            appended = skipped = nread = 0
+            with open(self.master, 'ab') as master, \
+                    open(self.index.path, 'ab') as index:
+                master.seek(0, os.SEEK_END)
+                for path in self.segments():
+                    a, s, n = self._consume(path, state, master, index)
+                    appended += a
+                    skipped += s
+                    nread += n
+
+                master.flush()
+                os.fsync(master.fileno())
+                index.flush()
+                os.fsync(index.fileno())
+
+                state['size'] = master.tell()
+            self._save_state(state)
+
+        return {'appended': appended, 'skipped': skipped,
+                'bytes_read': nread, 'frames': state['frames']}
+
+    def _truncate(self, state):
+        for path, size in ((self.master, state['size']),
+                           (self.index.path, state['frames'] * _RECORD.size)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _consume(self, path, state, master, index):
+        name = os.path.basename(path)
+        seg = state['segments'].get(name)
+        st = os.stat(path)
+
+        # a segment rewritten from scratch is read again from its start
+        if (seg is None or st.st_size < seg['offset']
+                or first_step(path) != seg['first_step']):
+            seg = {'offset': 0, 'first_step': first_step(path)}
+        elif st.st_size == seg['offset']:
+            return 0, 0, 0
+
+        start = seg['offset']
+        appended = skipped = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while True:
+                frame = read_frame_header(f)
+                if frame is None:
+                    # incomplete last frame; still being written
+                    break
+                size, step, time, data = frame
+                seg['offset'] += size
+
+                if state['last_step'] is not None and step <= state['last_step']:
+                    skipped += 1
+                    continue
+
+                index.write(_RECORD.pack(master.tell(), step, time))
+                master.write(data)
+                state['last_step'] = step
+                state['frames'] += 1
+                appended += 1
+
+        state['segments'][name] = seg
+        return appended, skipped, seg['offset'] - start
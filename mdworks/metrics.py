@@ -0,0 +1,263 @@
+"""
+Instrumentation of workflow phases.
+
+Each task records, for each phase it performs, the wall time, and where
+applicable the files and bytes moved, throughput and retries. Records are
+returned in the Firework's ``stored_data`` under a key of the task's own
+starting with ``'metrics'`` (see :func:`stored_key`), and handed to any
+registered sinks; setting the ``MDWORKS_METRICS`` environment variable to a
+path appends every record to that file as a line of JSON.
+
+Records from either source are aggregated with :func:`summarize`, or from the
+command line with::
+
+    python -m mdworks.metrics metrics.jsonl [...] [--by phase host]
+    python -m mdworks.metrics --launchpad my_launchpad.yaml [--by phase host]
+
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+import time
+
+#: environment variable giving a JSON-lines file to append all records to
+METRICS_ENV = 'MDWORKS_METRICS'
+
+_sinks = []
+
+
+def add_sink(sink):
+    """Register callable `sink` to be called with every record emitted."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+class JSONLinesSink(object):
+    """Append records to the file at `path`, one JSON object per line.
+
+    Each record is written with a single append, so several processes can
+    share one file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def emit(record):
+    """Hand `record` to all sinks; a failing sink never fails the task."""
+    import traceback
+
+    sinks = list(_sinks)
+    if os.environ.get(METRICS_ENV):
+        sinks.append(JSONLinesSink(os.environ[METRICS_ENV]))
+
+    for sink in sinks:
+        try:
+            sink(record)
+        except Exception:
+            traceback.print_exc()
+
+
+def stored_key(name, *parts):
+    """Key for a task to keep `name` under in its Firework's stored data.
+
+    Fireworks merges the stored data of all tasks in a Firework into one
+    dict, so tasks that can share a Firework, e.g. one per Sim of a bundle,
+    each need their own keys: ``stored_key('metrics', 'pull', uuid)`` gives
+    ``'metrics_pull_<uuid>'``. Parts that are None are left out.
+
+    """
+    return '_'.join([name] + [str(p) for p in parts if p is not None])
+
+
+def local_host():
+    """Name of the host this task runs on."""
+    import socket
+
+    return os.environ.get('HOST') or socket.gethostname()
+
+
+class Phase(object):
+    """Time one phase of a task, and build its record.
+
+    Use as a context manager around the phase::
+
+        with Phase('pull', uuid=uuid, host=server) as phase:
+            ...
+        records.append(phase.record(stats=stats))
+
+    """
+    def __init__(self, phase, uuid=None, host=None):
+        self.phase = phase
+        self.uuid = uuid
+        self.host = host
+        self.start = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+
+    def record(self, stats=None, **extra):
+        """The phase's record, emitted to all sinks.
+
+        Parameters
+        ----------
+        stats : :class:`~mdworks.transfer.TransferStats`
+            Transfers made in the phase, if any.
+        extra
+            Any further fields to record.
+
+        """
+        record = {'phase': self.phase,
+                  'uuid': self.uuid,
+                  'host': self.host or local_host(),
+                  'start': round(self.start, 3),
+                  'seconds': round(self.seconds, 3)}
+        if stats is not None:
+            transfer = stats.as_dict()
+            # the phase's wall time, not just time spent transferring
+            transfer['transfer_seconds'] = transfer.pop('seconds')
+            record.update(transfer)
+        record.update(extra)
+
+        emit(record)
+        return record
+
+
+def read_jsonl(paths):
+    """Records from JSON-lines files `paths`, skipping unreadable lines."""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def from_launchpad(lpad, query=None):
+    """Records stored by completed launches on LaunchPad `lpad`.
+
+    Besides the records stored by tasks, gives one record per launch with
+    phase ``'fw:<name>'`` and the launch's runtime; this covers Fireworks,
+    such as single-leg MD, whose tasks record nothing themselves.
+
+    Parameters
+    ----------
+    query : dict
+        Restrict to Fireworks matching this query.
+
+    """
+    names = {}
+    fw_query = dict(query or {})
+    for fw in lpad.fireworks.find(fw_query, {'name': 1, 'launches': 1}):
+        for launch_id in fw.get('launches', []):
+            names[launch_id] = fw['name']
+
+    records = []
+    for launch in lpad.launches.find({'launch_id': {'$in': list(names)},
+                                      'state': 'COMPLETED'}):
+        stored = (launch.get('action') or {}).get('stored_data') or {}
+        for key in sorted(stored):
+            if key == 'metrics' or key.startswith('metrics_'):
+                records.extend(stored[key])
+
+        if launch.get('runtime_secs') is not None:
+            records.append({'phase': 'fw:{}'.format(names[launch['launch_id']]),
+                            'uuid': None,
+                            'host': launch.get('host'),
+                            'start': None,
+                            'seconds': launch['runtime_secs']})
+    return records
+
+
+def summarize(records, by=('phase', 'host')):
+    """Aggregate `records` over the fields `by`.
+
+    Returns
+    -------
+    list
+        One dict per group, with the group's fields and the number of
+        records, their total and longest wall time, total files, bytes and
+        retries, and the throughput over the time spent transferring;
+        slowest groups first.
+
+    """
+    groups = {}
+    for r in records:
+        key = tuple(r.get(field) for field in by)
+        g = groups.setdefault(key, dict(zip(by, key), count=0, seconds=0.0,
+                                        max_seconds=0.0, files=0, bytes=0,
+                                        retries=0, transfer_seconds=0.0))
+        g['count'] += 1
+        g['seconds'] += r.get('seconds') or 0
+        g['max_seconds'] = max(g['max_seconds'], r.get('seconds') or 0)
+        for field in ('files', 'bytes', 'retries', 'transfer_seconds'):
+            g[field] += r.get(field) or 0
+
+    rows = []
+    for g in groups.values():
+        g['throughput_MBps'] = (round(g['bytes'] / g['transfer_seconds'] / 1e6, 3)
+                                if g['transfer_seconds'] else None)
+        g['mean_seconds'] = g['seconds'] / g['count']
+        rows.append(g)
+
+    return sorted(rows, key=lambda g: g['seconds'], reverse=True)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description="Aggregate mdworks phase metrics to find bottlenecks.")
+    parser.add_argument('files', nargs='*', help="JSON-lines metrics files")
+    parser.add_argument('--launchpad', help="LaunchPad yaml file to read "
+                        "stored metrics from")
+    parser.add_argument('--by', nargs='+', default=['phase', 'host'],
+                        help="fields to group by; defaults to phase and host")
+    args = parser.parse_args(argv)
+
+    records = read_jsonl(args.files)
+    if args.launchpad:
+        from fireworks import LaunchPad
+        records.extend(from_launchpad(LaunchPad.from_file(args.launchpad)))
+
+    columns = ['count', 'seconds', 'mean_seconds', 'max_seconds', 'files',
+               'bytes', 'throughput_MBps', 'retries']
+    width = max([len('/'.join(args.by))] +
+                [len('/'.join(str(r[f]) for f in args.by))
+                 for r in summarize(records, args.by)])
+
+    print('{:<{w}} '.format('/'.join(args.by), w=width) +
+          ' '.join('{:>15}'.format(c) for c in columns))
+    for row in summarize(records, args.by):
+        cells = []
+        for c in columns:
+            value = row[c]
+            if isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            cells.append('{:>15}'.format('-' if value is None else value))
+        print('{:<{w}} '.format('/'.join(str(row[f]) for f in args.by),
+                                w=width) + ' '.join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Pooled SSH/SFTP sessions shared by the transfer FireTasks.
+
+A single :class:`SSHPool` lives for the whole rocket process, so that
+FireTasks talking to the same remote resource reuse an already-authenticated
+connection instead of doing a full handshake and key exchange each time.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import errno
+import atexit
+import threading
+from contextlib import contextmanager
+from os.path import expanduser
+
+
+class SFTPSession(object):
+    """An open SSH connection together with its SFTP channel.
+
+    Attributes
+    ----------
+    key : tuple
+        ``(server, user, key_filename)`` the session was opened for.
+    ssh : paramiko.SSHClient
+        The underlying SSH client.
+    sftp : paramiko.SFTPClient
+        SFTP channel opened on ``ssh``.
+    remote_hash : bool
+        Whether the remote side can hash files for verifying transfers; None
+        until first tried.
+    hasher : :class:`~mdworks.transfer._RemoteHasher`
+        Remote hashing channel shared by the verified transfers over this
+        session; None until first needed.
+
+    """
+    def __init__(self, key, ssh, sftp):
+        self.key = key
+        self.ssh = ssh
+        self.sftp = sftp
+        self.last_used = time.time()
+        self.remote_hash = None
+        self.hasher = None
+
+    @property
+    def server(self):
+        return self.key[0]
+
+    def is_active(self):
+        """Cheap check that the transport has not been torn down."""
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def is_alive(self):
+        """Health check: transport is up and accepts a keepalive packet."""
+        if not self.is_active():
+            return False
+        try:
+            self.ssh.get_transport().send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        for conn in (self.sftp, self.ssh):
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class SSHPool(object):
+    """Pool of reusable SSH/SFTP sessions keyed by
+    ``(server, user, key_filename)``.
+
+    Parameters
+    ----------
+    max_per_host : int
+        Maximum number of sessions, idle or in use, open to any one server.
+        Keeps us under the remote sshd's ``MaxStartups``.
+    idle_timeout : float
+        Seconds an idle session is kept before it is closed.
+    wait_timeout : float
+        Seconds to wait for a free slot on a saturated host before giving
+        up; ``None`` waits forever.
+    known_hosts : str
+        Path to the ``known_hosts`` file used to verify servers.
+
+    """
+    def __init__(self, max_per_host=4, idle_timeout=300, wait_timeout=600,
+                 known_hosts=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.known_hosts = known_hosts or expanduser(
+                os.path.join("~", ".ssh", "known_hosts"))
+
+        self._idle = {}     # key -> [SFTPSession]
+        self._nopen = {}    # server -> number of open sessions
+        self._cond = threading.Condition()
+
+    def _connect(self, key):
+        import paramiko
+
+        server, user, key_filename = key
+        host, port = split_server(server)
+        ssh = paramiko.SSHClient()
+        if os.path.exists(self.known_hosts):
+            ssh.load_host_keys(self.known_hosts)
+        ssh.connect(host, port=port, username=user, key_filename=key_filename)
+        return SFTPSession(key, ssh, ssh.open_sftp())
+
+    def _forget(self, session):
+        # must hold self._cond
+        session.close()
+        self._nopen[session.server] -= 1
+        self._cond.notify_all()
+
+    def _evict_idle(self, now=None):
+        # must hold self._cond
+        now = time.time() if now is None else now
+        for key, sessions in list(self._idle.items()):
+            for session in list(sessions):
+                if now - session.last_used > self.idle_timeout:
+                    sessions.remove(session)
+                    self._forget(session)
+            if not sessions:
+                del self._idle[key]
+
+    def _evict_one_for_host(self, server):
+        # must hold self._cond; frees a slot held by an idle session to the
+        # same server opened under a different user or key
+        for key, sessions in self._idle.items():
+            if key[0] == server and sessions:
+                self._forget(sessions.pop(0))
+                return True
+        return False
+
+    def acquire(self, server, user, key_filename=None):
+        """Check out a healthy session, opening a new one if needed.
+
+        Blocks while ``server`` already has ``max_per_host`` sessions open.
+        The session must be handed back with :meth:`release`.
+
+        """
+        key = (server, user, key_filename)
+        deadline = (None if self.wait_timeout is None
+                    else time.time() + self.wait_timeout)
+
+        with self._cond:
+            while True:
+                self._evict_idle()
+
+                idle = self._idle.get(key, [])
+                while idle:
+                    session = idle.pop()
+                    if session.is_alive():
+                        return session
+                    self._forget(session)
+
+                if self._nopen.get(server, 0) < self.max_per_host:
+                    self._nopen[server] = self._nopen.get(server, 0) + 1
+                    break
+
+                if self._evict_one_for_host(server):
+                    continue
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise IOError(errno.EAGAIN,
+                                  "Timed out waiting for a free SSH session "
+                                  "to {}".format(server))
+                self._cond.wait(remaining)
+
+        # connect outside the lock; the slot is already reserved for us
+        try:
+            return self._connect(key)
+        except:
+            with self._cond:
+                self._nopen[server] -= 1
+                self._cond.notify_all()
+            raise
+
+    def release(self, session, discard=False):
+        """Return a session to the pool; broken sessions are closed."""
+        with self._cond:
+            if discard or not session.is_active():
+                self._forget(session)
+            else:
+                session.last_used = time.time()
+                self._idle.setdefault(session.key, []).append(session)
+                self._cond.notify_all()
+
+    @contextmanager
+    def session(self, server, user, key_filename=None):
+        """Context manager giving a pooled :class:`SFTPSession`.
+
+        If the body raises and the connection is no longer healthy, the
+        session is discarded instead of being returned to the pool.
+
+        """
+        session = self.acquire(server, user, key_filename)
+        try:
+            yield session
+        except:
+            self.release(session, discard=not session.is_alive())
+            raise
+        else:
+            self.release(session)
+
+    def close_all(self):
+        """Close every idle session; in-use sessions close on release."""
+        with self._cond:
+            for sessions in self._idle.values():
+                for session in sessions:
+                    self._forget(session)
+            self._idle = {}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide :class:`SSHPool`, creating it if needed."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SSHPool()
+            atexit.register(_pool.close_all)
+        return _pool
+
+
+def configure_pool(**kwargs):
+    """Replace the process-wide pool with one built from ``kwargs``.
+
+    Accepts the same keywords as :class:`SSHPool`; idle sessions of the
+    previous pool are closed.
+
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+        _pool = SSHPool(**kwargs)
+        atexit.register(_pool.close_all)
+        return _pool
+
+
+class HostThrottle(object):
+    """Per-host rate limit: spaces out operations against the same server.
+
+    Callers reserve consecutive slots ``interval`` seconds apart, so many
+    threads hitting one host are spread out instead of arriving at once,
+    while different hosts never wait on each other.
+
+    """
+    def __init__(self):
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, server, interval):
+        if not interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(server, 0))
+            self._next[server] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_throttle = HostThrottle()
+
+
+def throttle(server, interval):
+    """Wait for this process's next free slot on ``server``."""
+    _throttle.wait(server, interval)
+
+
+def split_server(server):
+    """Split a ``host[:port]`` server string; port defaults to 22."""
+    host, sep, port = server.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return server, 22
+
+
+def rexists(sftp, path):
+    """os.path.exists for paramiko's SFTP object."""
+    try:
+        sftp.stat(path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    else:
+        return True
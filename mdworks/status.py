@@ -0,0 +1,256 @@
+"""
+Progress of every Sim in an ensemble, kept in one place.
+
+Workflow construction and each continuation append a record per Sim to a
+status log: when it was submitted, and after each leg the step reached, the
+total steps, the number of legs run, the host the leg ran on and whether the
+Sim is finished. The log is a file of JSON lines that is only ever appended
+to, so any number of rockets sharing a filesystem can write to it at once.
+
+Next to the log, an index holds the latest state of each Sim together with
+the length of log it covers; reading the store loads the index and replays
+only the records appended since. Questions such as which Sims are behind,
+stalled or done are then answered without touching any Sim's directory::
+
+    python -m mdworks.status status.jsonl --behind
+    python -m mdworks.status status.jsonl --stalled 86400
+
+The store used is given by the ``status`` parameter of
+:func:`~mdworks.general.make_md_workflow` and its siblings, or else the
+``MDWORKS_STATUS`` environment variable; without either, nothing is
+recorded.
+
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+import time
+
+#: environment variable giving the status log to use by default
+STATUS_ENV = 'MDWORKS_STATUS'
+
+#: bytes of log past the index after which reading rewrites the index
+REINDEX_BYTES = 1 << 20
+
+
+def default_path(path=None):
+    """Status log `path` if given, else from ``MDWORKS_STATUS``; may be None."""
+    return path or os.environ.get(STATUS_ENV) or None
+
+
+class StatusStore(object):
+    """Append-only status log of an ensemble, with an index of latest states.
+
+    Parameters
+    ----------
+    path : str
+        Path of the status log; the index is kept at ``<path>.idx``.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+
+    def append(self, records):
+        """Append `records`, dicts each with at least a 'uuid' and an 'event'.
+
+        All records are written with a single append, so that concurrent
+        writers never interleave within a line. Each gets the current 'time'
+        unless it has one.
+
+        """
+        now = round(time.time(), 3)
+        lines = ''.join(json.dumps(dict({'time': now}, **r), sort_keys=True)
+                        + '\n' for r in records)
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def submitted(self, sims, **extra):
+        """Record Sims given as ``(uuid, name)`` pairs as submitted."""
+        self.append([dict(extra, uuid=uuid, name=name, event='submitted')
+                     for uuid, name in sims])
+
+    def leg(self, uuid, step, nsteps, finished=False, **extra):
+        """Record a leg of Sim `uuid` ending at `step` of `nsteps`."""
+        self.append([dict(extra, uuid=uuid, event='leg', step=step,
+                          nsteps=nsteps, finished=finished)])
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'offset': 0, 'sims': {}}
+
+        # a log replaced since the index was written is read afresh
+        try:
+            if os.path.getsize(self.path) < index['offset']:
+                return {'offset': 0, 'sims': {}}
+        except OSError:
+            pass
+        return index
+
+    def _save_index(self, index):
+        part = '{}.{}.part'.format(self.index_path, os.getpid())
+        with open(part, 'w') as f:
+            json.dump(index, f)
+        os.rename(part, self.index_path)
+
+    def states(self):
+        """Latest state of each Sim, by uuid.
+
+        Returns
+        -------
+        dict
+            For each Sim, its 'name', 'status' ('submitted', 'running' or
+            'finished'), 'step' and 'nsteps' after its last leg, the number
+            of 'legs' recorded, the 'host' of its last leg, and the times it
+            was first 'submitted' and last 'updated'.
+
+        """
+        index = self._load_index()
+        sims = index['sims']
+        index['indexed'] = index['offset']
+
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            return sims
+
+        with f:
+            f.seek(index['offset'])
+            for line in f:
+                # a line still being written is left for the next reader
+                if not line.endswith(b'\n'):
+                    break
+                index['offset'] += len(line)
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                _apply(sims, record)
+
+        if index['offset'] - index['indexed'] > REINDEX_BYTES:
+            index['indexed'] = index['offset']
+            self._save_index(index)
+
+        return sims
+
+    def done(self):
+        """uuids of Sims that are finished."""
+        return sorted(uuid for uuid, s in self.states().items()
+                      if s['status'] == 'finished')
+
+    def behind(self, fraction=0.9):
+        """uuids of unfinished Sims with progress below `fraction` of the
+        ensemble's median progress, least progressed first.
+
+        Progress is the fraction of its steps a Sim has run; Sims without a
+        leg yet count as none.
+
+        """
+        states = self.states()
+        progress = {uuid: _progress(s) for uuid, s in states.items()}
+        if not progress:
+            return []
+
+        values = sorted(progress.values())
+        median = values[len(values) // 2]
+        return sorted((uuid for uuid, s in states.items()
+                       if s['status'] != 'finished'
+                       and progress[uuid] < fraction * median),
+                      key=lambda uuid: progress[uuid])
+
+    def stalled(self, max_age=2 * 24 * 3600, now=None):
+        """uuids of unfinished Sims with no record for `max_age` seconds,
+        longest silent first."""
+        now = time.time() if now is None else now
+        states = self.states()
+        return sorted((uuid for uuid, s in states.items()
+                       if s['status'] != 'finished'
+                       and now - s['updated'] > max_age),
+                      key=lambda uuid: states[uuid]['updated'])
+
+
+def _apply(sims, record):
+    uuid = record.get('uuid')
+    if uuid is None:
+        return
+
+    s = sims.setdefault(uuid, {'name': None, 'status': 'submitted',
+                               'step': None, 'nsteps': None, 'legs': 0,
+                               'host': None, 'submitted': record['time'],
+                               'updated': record['time']})
+    s['updated'] = record['time']
+    if record.get('name'):
+        s['name'] = record['name']
+
+    if record['event'] == 'submitted':
+        # a finished Sim submitted again, e.g. to extend it, runs again
+        if s['status'] == 'finished':
+            s['status'] = 'submitted'
+    elif record['event'] == 'leg':
+        s['legs'] += 1
+        s['step'] = record.get('step')
+        s['nsteps'] = record.get('nsteps')
+        s['host'] = record.get('host')
+        s['status'] = 'finished' if record.get('finished') else 'running'
+
+
+def _progress(state):
+    if state['status'] == 'finished':
+        return 1.0
+    if not state['step'] or not state['nsteps']:
+        return 0.0
+    return float(state['step']) / state['nsteps']
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description="Query the progress of an mdworks ensemble.")
+    parser.add_argument('path', nargs='?', default=default_path(),
+                        help="status log; defaults to $MDWORKS_STATUS")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--behind', nargs='?', type=float, const=0.9,
+                       metavar='FRACTION', help="unfinished Sims below "
+                       "FRACTION of the median progress")
+    group.add_argument('--stalled', nargs='?', type=float,
+                       const=2 * 24 * 3600, metavar='SECONDS',
+                       help="unfinished Sims with no record for SECONDS")
+    group.add_argument('--done', action='store_true', help="finished Sims")
+    args = parser.parse_args(argv)
+
+    if not args.path:
+        parser.error("no status log given, and $MDWORKS_STATUS not set")
+
+    store = StatusStore(args.path)
+    states = store.states()
+    if args.behind is not None:
+        uuids = store.behind(args.behind)
+    elif args.stalled is not None:
+        uuids = store.stalled(args.stalled)
+    elif args.done:
+        uuids = store.done()
+    else:
+        uuids = sorted(states)
+
+    print('{:<36} {:<24} {:>10} {:>12} {:>12} {:>5} {:<20}'.format(
+        'uuid', 'name', 'status', 'step', 'nsteps', 'legs', 'host'))
+    for uuid in uuids:
+        s = states[uuid]
+        print('{:<36} {:<24} {:>10} {:>12} {:>12} {:>5} {:<20}'.format(
+            uuid, s['name'] or '-', s['status'],
+            '-' if s['step'] is None else s['step'],
+            '-' if s['nsteps'] is None else s['nsteps'],
+            s['legs'], s['host'] or '-'))
+
+
+if __name__ == '__main__':
+    main()
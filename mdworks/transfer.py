@@ -0,0 +1,1727 @@
+"""
+Helpers for moving files between the archive and remote resources over SFTP,
+and between directories on a resource.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import stat
+import errno
+import hashlib
+
+#: name of the manifest file kept in each incrementally-staged directory
+MANIFEST = '.mdworks-manifest.json'
+
+#: hash algorithm used for content digests
+HASH = 'md5'
+
+
+def file_digest(path, blocksize=1 << 20):
+    """Hex digest of the contents of a local file."""
+    h = hashlib.new(HASH)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def local_manifest(files, previous=None):
+    """Build a manifest for local `files`.
+
+    Parameters
+    ----------
+    files : list
+        Absolute paths of local files.
+    previous : dict
+        A previous manifest; the digest of an entry with identical size and
+        mtime is reused rather than re-reading the file.
+
+    Returns
+    -------
+    dict
+        Mapping of basename to ``{'size', 'mtime', 'hash'}``.
+
+    """
+    previous = previous or {}
+    manifest = {}
+    for path in files:
+        st = os.stat(path)
+        name = os.path.basename(path)
+        entry = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+        old = previous.get(name)
+        if (old and old.get('hash') and old['size'] == entry['size']
+                and old['mtime'] == entry['mtime']):
+            entry['hash'] = old['hash']
+        else:
+            entry['hash'] = file_digest(path)
+
+        manifest[name] = entry
+
+    return manifest
+
+
+def read_manifest(sftp, directory):
+    """Load the manifest stored in remote `directory`; empty if absent."""
+    try:
+        with sftp.open(os.path.join(directory, MANIFEST), 'r') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return {}
+        raise
+    except ValueError:
+        # corrupt manifest; treat everything as changed
+        return {}
+
+
+def write_manifest(sftp, directory, manifest):
+    """Atomically replace the manifest in remote `directory`."""
+    path = os.path.join(directory, MANIFEST)
+    tmp = path + '.part'
+    with sftp.open(tmp, 'w') as f:
+        f.write(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    rrename(sftp, tmp, path)
+
+
+def rrename(sftp, src, dest):
+    """Rename on the remote side, replacing `dest` if it exists."""
+    try:
+        sftp.posix_rename(src, dest)
+    except IOError:
+        # server lacks the posix-rename extension
+        try:
+            sftp.remove(dest)
+        except IOError:
+            pass
+        sftp.rename(src, dest)
+
+
+def is_partial_of(name, names):
+    """True if `name` is the partial transfer of one of `names`."""
+    for suffix in ('.part', '.part.json'):
+        if name.endswith(suffix) and name[:-len(suffix)] in names:
+            return True
+    return False
+
+
+def remote_files(sftp, directory):
+    """Sizes of regular files in remote `directory`, in one round trip."""
+    return {a.filename: a.st_size for a in sftp.listdir_attr(directory)
+            if stat.S_ISREG(a.st_mode or 0)}
+
+
+def plan_sync(local, remote, remote_sizes):
+    """Decide which files an incremental sync must upload and delete.
+
+    Parameters
+    ----------
+    local : dict
+        Manifest of the files that should be present.
+    remote : dict
+        Manifest last written at the destination.
+    remote_sizes : dict
+        Actual sizes of the files present at the destination.
+
+    Returns
+    -------
+    upload : list
+        Names of files that are new or changed.
+    delete : list
+        Names of stale files at the destination.
+
+    """
+    upload = []
+    for name, entry in local.items():
+        old = remote.get(name)
+        if (old is None or old.get('hash') != entry['hash']
+                or remote_sizes.get(name) != entry['size']):
+            upload.append(name)
+
+    delete = [name for name in remote_sizes
+              if name not in local and not name.startswith(MANIFEST)
+              and not is_partial_of(name, local)]
+
+    return sorted(upload), sorted(delete)
+
+
+#: files at least this large go through the chunked transfer engine
+LARGE_FILE = 64 << 20
+
+#: size of the independently resumable chunks large files are split into
+CHUNK_SIZE = 8 << 20
+
+#: chunks completed between journal updates
+JOURNAL_EVERY = 8
+
+#: times chunks failing verification are transferred again before giving up
+VERIFY_RETRIES = 2
+
+
+class TransferStats(object):
+    """Thread-safe tally of what a task moved and how fast.
+
+    Attributes
+    ----------
+    files : int
+        Number of files transferred.
+    bytes : int
+        Number of bytes sent over the wire.
+    resumed_bytes : int
+        Bytes of partial files that were kept rather than re-sent.
+    seconds : float
+        Wall time spent transferring.
+    retries : int
+        Number of failed operations that were retried.
+    wasted_bytes : int
+        Bytes sent by failed attempts that had to be sent again.
+    cached_files, cached_bytes : int
+        Files, and their bytes, placed from a remote cache without sending.
+
+    """
+    def __init__(self):
+        import threading
+
+        self.files = 0
+        self.bytes = 0
+        self.resumed_bytes = 0
+        self.seconds = 0.0
+        self.retries = 0
+        self.wasted_bytes = 0
+        self.cached_files = 0
+        self.cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, seconds, files=1, resumed=0):
+        with self._lock:
+            self.files += files
+            self.bytes += nbytes
+            self.resumed_bytes += resumed
+            self.seconds += seconds
+
+    def add_retry(self, wasted=0):
+        with self._lock:
+            self.retries += 1
+            self.wasted_bytes += wasted
+
+    def add_cached(self, nbytes, files=1):
+        with self._lock:
+            self.cached_files += files
+            self.cached_bytes += nbytes
+
+    @classmethod
+    def combined(cls, stats):
+        """A new tally summing those in iterable `stats`."""
+        total = cls()
+        for s in stats:
+            for attr in ('files', 'bytes', 'resumed_bytes', 'seconds',
+                         'retries', 'wasted_bytes', 'cached_files',
+                         'cached_bytes'):
+                setattr(total, attr, getattr(total, attr) + getattr(s, attr))
+        return total
+
+    @property
+    def throughput(self):
+        """Achieved throughput in bytes per second."""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {'files': self.files,
+                'bytes': self.bytes,
+                'resumed_bytes': self.resumed_bytes,
+                'seconds': round(self.seconds, 3),
+                'throughput_MBps': round(self.throughput / 1e6, 3),
+                'retries': self.retries,
+                'wasted_bytes': self.wasted_bytes,
+                'cached_files': self.cached_files,
+                'cached_bytes': self.cached_bytes}
+
+
+def _wasted(error, nbytes):
+    """Note on `error` that `nbytes` sent before it will be sent again."""
+    error.wasted_bytes = getattr(error, 'wasted_bytes', 0) + nbytes
+
+
+class Retrier(object):
+    """Retry individual transfer operations with exponential backoff.
+
+    Each failing call is retried up to `max_retry` times, waiting a random
+    time between half and all of ``delay * 2**attempt`` (capped at
+    `max_delay`) so that many tasks failing together do not retry in
+    lockstep.
+
+    Parameters
+    ----------
+    max_retry : int
+        Number of retries per operation.
+    delay : float
+        Base wait in seconds before the first retry.
+    max_delay : float
+        Upper bound on the wait between retries.
+    stats : :class:`TransferStats`
+        Where retries and the bytes they wasted are tallied.
+
+    """
+    def __init__(self, max_retry=0, delay=10, max_delay=300, stats=None):
+        self.max_retry = max_retry
+        self.delay = delay
+        self.max_delay = max_delay
+        self.stats = stats
+
+    def backoff(self, attempt):
+        import random
+
+        wait = min(self.max_delay, self.delay * 2 ** attempt)
+        return random.uniform(wait / 2., wait)
+
+    def __call__(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)``, retrying it on failure."""
+        import time
+        import traceback
+
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retry:
+                    raise
+                traceback.print_exc()
+                if self.stats is not None:
+                    self.stats.add_retry(getattr(e, 'wasted_bytes', 0))
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+
+
+class _Journal(object):
+    """Record of which chunks of a ``.part`` file are complete.
+
+    Stored next to the partial file on whichever side is being written, so
+    an interrupted transfer resumes from the chunks already verified.
+
+    """
+    def __init__(self, path, size, mtime, chunk_size):
+        self.path = path
+        self.key = {'size': size, 'mtime': int(mtime),
+                    'chunk_size': chunk_size}
+        self.done = set()
+        self.digests = {}
+
+    def load(self, opener):
+        """Load completed chunks; stale or missing journals give none."""
+        try:
+            with opener(self.path, 'rb') as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return self.done
+        if all(state.get(k) == v for k, v in self.key.items()):
+            self.done = set(state.get('done', []))
+            self.digests = {int(i): d for i, d
+                            in state.get('digests', {}).items()}
+        return self.done
+
+    def save(self, opener):
+        state = dict(self.key, done=sorted(self.done),
+                     digests={str(i): d for i, d in self.digests.items()
+                              if i in self.done})
+        with opener(self.path, 'wb') as f:
+            f.write(json.dumps(state).encode('utf-8'))
+
+
+class _Progress(object):
+    """Callback for paramiko's get/put remembering how far it got."""
+    def __init__(self):
+        self.done = 0
+
+    def __call__(self, done, total):
+        self.done = done
+
+
+class IntegrityError(IOError):
+    """Contents that arrived differ from those sent."""
+
+
+class _Hashing(object):
+    """File-like wrapper hashing all data read from or written to `f`."""
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.new(HASH)
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.hash.update(data)
+        return data
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def _digest(data):
+    return hashlib.new(HASH, data).hexdigest()
+
+
+class _RemoteHasher(object):
+    """Remote half of verification: a shell loop on a single exec channel
+    hashing byte ranges of remote files, in the order they are queued.
+
+    Transfers queue ranges as soon as the remote side holds them: at once
+    for downloads, and as each group of chunks is acknowledged for uploads.
+    The remote thus hashes while data still streams, reading what was just
+    uploaded back from the page cache rather than in a pass of its own once
+    the transfer is done, and all verified transfers over a session share
+    the one channel (see :func:`_hasher`).
+
+    """
+    def __init__(self, session):
+        import threading
+
+        self.session = session
+        self.stdin = self.stdout = None
+        self.queued = 0     # tickets handed out
+        self.read = 0       # tickets whose digests have been read
+        self.digests = {}   # ticket -> digest read, until taken
+        self._queue_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        if session.remote_hash is False:
+            return
+
+        tool = HASH + 'sum'
+        try:
+            self.stdin, self.stdout, _ = session.ssh.exec_command(
+                    'command -v {0} >/dev/null || exit 127; '
+                    'while read -r offset length path; do '
+                    'if [ "$length" = - ]; then {0} < "$path"; '
+                    'else tail -c +$((offset + 1)) "$path" | '
+                    'head -c "$length" | {0}; fi || echo -; done'.format(tool))
+        except Exception:
+            self._fail()
+
+    @property
+    def active(self):
+        """False once the remote side turned out unable to hash."""
+        return self.stdout is not None
+
+    def _fail(self):
+        self.stdin = self.stdout = None
+        self.session.remote_hash = False
+
+    def queue(self, ranges):
+        """Queue hashing of `ranges`, ``(path, offset, length)`` triples with
+        None as length for the whole file; returns a ticket for each, to
+        get its digest from :meth:`result`."""
+        with self._queue_lock:
+            if not self.active:
+                return [None] * len(ranges)
+            request = ''.join('{} {} {}\n'.format(
+                                  offset, '-' if length is None else length,
+                                  path)
+                              for path, offset, length in ranges)
+            try:
+                self.stdin.write(request.encode('utf-8'))
+                self.stdin.flush()
+            except Exception:
+                self._fail()
+                return [None] * len(ranges)
+            tickets = list(range(self.queued, self.queued + len(ranges)))
+            self.queued += len(ranges)
+            return tickets
+
+    def result(self, ticket):
+        """Hex digest for `ticket`, once the remote side has computed it;
+        None if it could not, or cannot hash at all."""
+        if ticket is None:
+            return None
+
+        width = hashlib.new(HASH).digest_size * 2
+        with self._read_lock:
+            while ticket >= self.read and self.active:
+                try:
+                    line = self.stdout.readline()
+                except Exception:
+                    line = b''
+                if not line:
+                    # the loop only ends if the remote cannot hash
+                    self._fail()
+                    break
+                digest = (line.split() or [b''])[0].decode('utf-8', 'replace')
+                self.digests[self.read] = (digest if len(digest) == width
+                                           else None)
+                self.read += 1
+                self.session.remote_hash = True
+            return self.digests.pop(ticket, None)
+
+
+def _hasher(session):
+    """The :class:`_RemoteHasher` of `session`, started on first use."""
+    if session.hasher is None:
+        session.hasher = _RemoteHasher(session)
+    return session.hasher
+
+
+def _mismatched(local, remote):
+    """Keys of `local` digests differing from the `remote` ones."""
+    return sorted(k for k, d in local.items()
+                  if remote.get(k) is not None and remote[k] != d)
+
+
+def _unchanged(before, after):
+    return (before.st_size == after.st_size
+            and int(before.st_mtime) == int(after.st_mtime))
+
+
+def _chunks(size, chunk_size):
+    return [(i, i * chunk_size, min(chunk_size, size - i * chunk_size))
+            for i in range(max(1, -(-size // chunk_size)))]
+
+
+def _run_streams(session, todo, streams, work):
+    """Split chunks `todo` over up to `streams` SFTP channels.
+
+    A single stream uses the session's own channel. Parallel streams each
+    open their own channel on the same authenticated transport, since an
+    SFTP channel must not be shared between threads.
+
+    """
+    import threading
+
+    streams = max(1, min(streams, len(todo)))
+    if streams == 1:
+        work(session.sftp, todo)
+        return
+
+    share = -(-len(todo) // streams)
+    errors = []
+
+    def stream(n, chunks):
+        try:
+            sftp = session.ssh.open_sftp()
+            try:
+                work(sftp, chunks)
+            finally:
+                sftp.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stream,
+                                args=(n, todo[n * share:(n + 1) * share]))
+               for n in range(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def _verify_loop(transfer, todo, check, local, remote, hasher, stats, what):
+    """Transfer chunks `todo`, then again those of `check` whose `local`
+    digests differ from the remote ones, until all agree.
+
+    Parameters
+    ----------
+    transfer : callable
+        Transfers the chunks it is given, filling in their `local` digests;
+        uploads also queue their new remote digests in `remote`.
+    remote : dict
+        Tickets of `hasher` for the remote digests of the chunks in `check`,
+        by chunk index; each is taken out once its digest is read. Downloads
+        queue them once, before transferring, as the source does not change.
+    hasher : :class:`_RemoteHasher`
+        Remote side hashing the chunks.
+
+    """
+    digests = {}
+    for attempt in range(VERIFY_RETRIES + 1):
+        transfer(todo)
+
+        for c in check:
+            if c[0] in remote:
+                digests[c[0]] = hasher.result(remote.pop(c[0]))
+        if not hasher.active:
+            # remote can't hash; nothing more to compare against
+            return
+
+        bad = _mismatched({c[0]: local.get(c[0]) for c in check}, digests)
+        if not bad:
+            return
+
+        if stats is not None:
+            stats.add_retry(sum(c[2] for c in check if c[0] in bad))
+        todo = check = [c for c in check if c[0] in bad]
+
+    error = IntegrityError("chunks {} of {} differ after {} transfers".format(
+        bad, what, VERIFY_RETRIES + 1))
+    error.chunks = bad
+    raise error
+
+
+def _read_digests(f, chunks):
+    """Digests of `chunks` of open file `f`, by reading them."""
+    digests = {}
+    for i, offset, length in chunks:
+        f.seek(offset)
+        digests[i] = _digest(f.read(length))
+    return digests
+
+
+def get(session, remotepath, localpath, stats=None, streams=1,
+        chunk_size=None, threshold=None, resume=True, verify=True):
+    """Download a file, using the chunked engine for large files.
+
+    Large files are fetched in `chunk_size` chunks over `streams` parallel
+    SFTP channels, each keeping many read requests in flight. Data lands in
+    ``<localpath>.part`` and is renamed into place once complete; if
+    interrupted, a later call with `resume` fetches only missing chunks.
+
+    With `verify`, data is hashed as it arrives while the remote side
+    hashes the file, in the same chunks for large files, over the exec
+    channel the session shares for it. Chunks whose digests differ are
+    fetched again before the file is renamed into place, and
+    :class:`IntegrityError` is raised if they keep differing, or if the
+    remote file changed while being fetched. Where the remote side cannot
+    run ``md5sum``, only the latter is checked.
+
+    Parameters
+    ----------
+    session : :class:`~mdworks.ssh.SFTPSession`
+        Session to transfer over.
+    remotepath, localpath : str
+        Source and destination paths.
+    stats : :class:`TransferStats`
+        If given, the transfer is tallied here.
+
+    """
+    import time
+    import threading
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    threshold = LARGE_FILE if threshold is None else threshold
+
+    t0 = time.time()
+    rstat = session.sftp.stat(remotepath)
+    size = rstat.st_size
+    part = localpath + '.part'
+    local = {}
+
+    if size < threshold and not verify:
+        progress = _Progress()
+        try:
+            session.sftp.get(remotepath, localpath, callback=progress)
+        except Exception as e:
+            _wasted(e, progress.done)
+            raise
+        if stats is not None:
+            stats.add(size, time.time() - t0)
+        return
+
+    if size < threshold:
+        hasher = _hasher(session)
+        remote = dict(enumerate(hasher.queue([(remotepath, 0, None)])))
+
+        def fetch(todo):
+            progress = _Progress()
+            try:
+                with open(part, 'wb') as f:
+                    hashing = _Hashing(f)
+                    session.sftp.getfo(remotepath, hashing, callback=progress)
+            except Exception as e:
+                _wasted(e, progress.done)
+                raise
+            local[0] = hashing.hexdigest()
+
+        whole = [(0, 0, size)]
+        _verify_loop(fetch, whole, whole, local, remote, hasher, stats,
+                     remotepath)
+
+        if not _unchanged(rstat, session.sftp.stat(remotepath)):
+            raise IntegrityError("{} changed while fetched".format(remotepath))
+        os.rename(part, localpath)
+
+        if stats is not None:
+            stats.add(size, time.time() - t0)
+        return
+
+    journal = _Journal(part + '.json', size, rstat.st_mtime, chunk_size)
+    done = journal.load(open) if resume and os.path.exists(part) else set()
+
+    with open(part, 'r+b' if done else 'wb') as f:
+        f.truncate(size)
+
+    chunks = _chunks(size, chunk_size)
+    todo = [c for c in chunks if c[0] not in done]
+    lock = threading.Lock()
+
+    def work(sftp, mine):
+        with sftp.open(remotepath, 'rb') as rf, open(part, 'r+b') as lf:
+            # a single readv of all our chunks, in blocks no larger than one
+            # read request, keeps requests in flight across chunk boundaries;
+            # reading a large range at once makes paramiko copy it quadratically
+            block = rf.MAX_REQUEST_SIZE
+            blocks = rf.readv([(o, min(block, offset + length - o))
+                               for i, offset, length in mine
+                               for o in range(offset, offset + length, block)])
+            for i, offset, length in mine:
+                lf.seek(offset)
+                # digests are only needed to verify against
+                h = hashlib.new(HASH) if verify else None
+                got = 0
+                try:
+                    while got < length:
+                        data = next(blocks)
+                        lf.write(data)
+                        if h is not None:
+                            h.update(data)
+                        got += len(data)
+                except Exception as e:
+                    _wasted(e, got)
+                    raise
+                lf.flush()
+                with lock:
+                    journal.done.add(i)
+                    if h is not None:
+                        journal.digests[i] = local[i] = h.hexdigest()
+                    if len(journal.done) % JOURNAL_EVERY == 0:
+                        # chunks are only journaled once on disk
+                        os.fsync(lf.fileno())
+                        journal.save(open)
+
+    def fetch(todo):
+        try:
+            _run_streams(session, todo, streams, work)
+        finally:
+            with open(part, 'rb') as f:
+                os.fsync(f.fileno())
+            journal.save(open)
+
+    if not verify:
+        fetch(todo)
+    else:
+        hasher = _hasher(session)
+        remote = dict(zip([c[0] for c in chunks],
+                          hasher.queue([(remotepath, offset, length)
+                                        for i, offset, length in chunks])))
+
+        # chunks resumed from an earlier call keep the digests taken then
+        local.update((i, d) for i, d in journal.digests.items() if i in done)
+        unknown = [c for c in chunks if c[0] in done and c[0] not in local]
+        if unknown:
+            with open(part, 'rb') as f:
+                local.update(_read_digests(f, unknown))
+
+        try:
+            _verify_loop(fetch, todo, chunks, local, remote, hasher, stats,
+                         remotepath)
+        except IntegrityError as e:
+            # so that a retry fetches only the chunks that differ
+            journal.done -= set(e.chunks)
+            journal.save(open)
+            raise
+
+        if not _unchanged(rstat, session.sftp.stat(remotepath)):
+            raise IntegrityError("{} changed while fetched".format(remotepath))
+
+    os.rename(part, localpath)
+    os.remove(journal.path)
+
+    if stats is not None:
+        sent = sum(c[2] for c in todo)
+        stats.add(sent, time.time() - t0, resumed=size - sent)
+
+
+def put(session, localpath, remotepath, stats=None, streams=1,
+        chunk_size=None, threshold=None, resume=True, verify=True):
+    """Upload a file, using the chunked engine for large files.
+
+    The mirror image of :func:`get`: chunks are written to
+    ``<remotepath>.part`` with pipelined writes and the completed file is
+    renamed into place on the remote side. With `verify`, data is hashed as
+    it is sent, and compared with the remote side's digests of the written
+    ``.part`` before the rename; the remote side hashes each group of chunks
+    as soon as its writes are acknowledged, while later ones still stream.
+
+    """
+    import time
+    import threading
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    threshold = LARGE_FILE if threshold is None else threshold
+
+    t0 = time.time()
+    lstat = os.stat(localpath)
+    size = lstat.st_size
+    part = remotepath + '.part'
+    local = {}
+
+    if size < threshold and not verify:
+        progress = _Progress()
+        try:
+            session.sftp.put(localpath, remotepath, callback=progress)
+        except Exception as e:
+            _wasted(e, progress.done)
+            raise
+        if stats is not None:
+            stats.add(size, time.time() - t0)
+        return
+
+    if size < threshold:
+        hasher = _hasher(session)
+        remote = {}
+
+        def send(todo):
+            progress = _Progress()
+            try:
+                with open(localpath, 'rb') as f:
+                    hashing = _Hashing(f)
+                    session.sftp.putfo(hashing, part, file_size=size,
+                                       callback=progress)
+            except Exception as e:
+                _wasted(e, progress.done)
+                raise
+            local[0] = hashing.hexdigest()
+            remote[0], = hasher.queue([(part, 0, None)])
+
+        whole = [(0, 0, size)]
+        _verify_loop(send, whole, whole, local, remote, hasher, stats,
+                     localpath)
+
+        if not _unchanged(lstat, os.stat(localpath)):
+            raise IntegrityError("{} changed while sent".format(localpath))
+        rrename(session.sftp, part, remotepath)
+
+        if stats is not None:
+            stats.add(size, time.time() - t0)
+        return
+
+    journal = _Journal(part + '.json', size, lstat.st_mtime, chunk_size)
+    done = set()
+    if resume:
+        try:
+            session.sftp.stat(part)
+        except IOError:
+            pass
+        else:
+            done = journal.load(session.sftp.open)
+
+    if not done:
+        session.sftp.open(part, 'wb').close()
+
+    chunks = _chunks(size, chunk_size)
+    todo = [c for c in chunks if c[0] not in done]
+    lock = threading.Lock()
+    hasher = _hasher(session) if verify else None
+    remote = {}
+
+    def work(sftp, mine):
+        with open(localpath, 'rb') as lf:
+            # closing the remote file waits until every pipelined write has
+            # been acknowledged; doing so only every few chunks keeps writes
+            # in flight across chunk boundaries
+            for n in range(0, len(mine), JOURNAL_EVERY):
+                group = mine[n:n + JOURNAL_EVERY]
+                digests = {}
+                sent = 0
+                try:
+                    with sftp.open(part, 'r+b') as rf:
+                        rf.set_pipelined(True)
+                        for i, offset, length in group:
+                            lf.seek(offset)
+                            data = lf.read(length)
+                            rf.seek(offset)
+                            rf.write(data)
+                            sent += len(data)
+                            if verify:
+                                digests[i] = _digest(data)
+                except Exception as e:
+                    _wasted(e, sent)
+                    raise
+                # the group is written; have the remote hash it meanwhile
+                tickets = (hasher.queue([(part, offset, length)
+                                         for i, offset, length in group])
+                           if verify else [])
+                with lock:
+                    journal.done.update(c[0] for c in group)
+                    journal.digests.update(digests)
+                    local.update(digests)
+                    remote.update(zip([c[0] for c in group], tickets))
+                    journal.save(sftp.open)
+
+    def send(todo):
+        try:
+            _run_streams(session, todo, streams, work)
+        finally:
+            journal.save(session.sftp.open)
+
+    if not verify:
+        send(todo)
+    else:
+        resumed = [c for c in chunks if c[0] in done]
+        remote.update(zip([c[0] for c in resumed],
+                          hasher.queue([(part, offset, length)
+                                        for i, offset, length in resumed])))
+
+        local.update((i, d) for i, d in journal.digests.items() if i in done)
+        unknown = [c for c in resumed if c[0] not in local]
+        if unknown:
+            with open(localpath, 'rb') as f:
+                local.update(_read_digests(f, unknown))
+
+        try:
+            _verify_loop(send, todo, chunks, local, remote, hasher, stats,
+                         localpath)
+        except IntegrityError as e:
+            journal.done -= set(e.chunks)
+            journal.save(session.sftp.open)
+            raise
+
+        if not _unchanged(lstat, os.stat(localpath)):
+            raise IntegrityError("{} changed while sent".format(localpath))
+
+    rrename(session.sftp, part, remotepath)
+    session.sftp.remove(journal.path)
+
+    if stats is not None:
+        sent = sum(c[2] for c in todo)
+        stats.add(sent, time.time() - t0, resumed=size - sent)
+
+
+def _tar_mode(compress):
+    return ('|gz', ' -z') if compress else ('|', '')
+
+
+def _check_exit(channel, stderr, what):
+    status = channel.recv_exit_status()
+    if status != 0:
+        raise IOError("{} failed with exit status {}: {}".format(
+            what, status, stderr.read().decode('utf-8', 'replace').strip()))
+
+
+def put_batch(session, files, remotedir, stats=None, compress=False,
+              arcnames=None, verify=True):
+    """Upload many local `files` into `remotedir` as a single tar stream.
+
+    The archive is written straight into one exec channel running ``tar``
+    on the remote side, which unpacks it as it arrives; this replaces one
+    SFTP round trip per file with a single one. Requires that the remote
+    account can execute ``tar``. Files are named as in `arcnames`, a dict
+    keyed by local path, and otherwise keep their basename.
+
+    With `verify`, files are hashed as they go into the stream, and
+    compared with the remote side's digests once unpacked, all requested at
+    once; any that differ are sent again on their own with :func:`put`.
+
+    """
+    import time
+    import tarfile
+    from six.moves import shlex_quote
+
+    if not files:
+        return
+
+    t0 = time.time()
+    mode, flag = _tar_mode(compress)
+    stdin, stdout, stderr = session.ssh.exec_command(
+            'mkdir -p {0} && tar{1} -C {0} -xf -'.format(
+                shlex_quote(remotedir), flag))
+
+    names = [(arcnames or {}).get(path, os.path.basename(path))
+             for path in files]
+    local = {}
+    nbytes = 0
+    try:
+        with tarfile.open(fileobj=stdin, mode='w' + mode) as tf:
+            for path, arcname in zip(files, names):
+                info = tf.gettarinfo(path, arcname=arcname)
+                with open(path, 'rb') as f:
+                    hashing = _Hashing(f)
+                    tf.addfile(info, hashing)
+                local[path] = hashing.hexdigest()
+                nbytes += info.size
+        stdin.channel.shutdown_write()
+
+        _check_exit(stdout.channel, stderr, 'remote tar extract')
+    except Exception as e:
+        _wasted(e, nbytes)
+        raise
+
+    if verify:
+        hasher = _hasher(session)
+        tickets = hasher.queue([(os.path.join(remotedir, name), 0, None)
+                                for name in names])
+        digests = [hasher.result(t) for t in tickets]
+        if hasher.active:
+            targets = dict(zip(files, names))
+            for path in _mismatched(local, dict(zip(files, digests))):
+                if stats is not None:
+                    stats.add_retry(os.path.getsize(path))
+                put(session, path, os.path.join(remotedir, targets[path]),
+                    stats=stats)
+
+    if stats is not None:
+        stats.add(nbytes, time.time() - t0, files=len(files))
+
+
+def get_batch(session, remotedir, names, localdir, stats=None, compress=False,
+              verify=True):
+    """Download files `names` in `remotedir` as a single tar stream.
+
+    Members are unpacked as the stream arrives, each into a ``.part`` file
+    that is renamed into place once complete. Contents are byte-identical
+    to fetching the files one by one.
+
+    With `verify`, the remote side hashes the files while they stream, all
+    requested at once, and members are hashed as they are unpacked; the
+    ``.part`` files are renamed into place only once their digests agree,
+    and any that differ are fetched again on their own with :func:`get`.
+
+    """
+    import time
+    import tarfile
+    from six.moves import shlex_quote
+
+    if not names:
+        return
+
+    t0 = time.time()
+    mode, flag = _tar_mode(compress)
+    if verify:
+        hasher = _hasher(session)
+        tickets = hasher.queue([(os.path.join(remotedir, name), 0, None)
+                                for name in names])
+    stdin, stdout, stderr = session.ssh.exec_command(
+            'tar{} -C {} -cf - -- {}'.format(
+                flag, shlex_quote(remotedir),
+                ' '.join(shlex_quote(name) for name in names)))
+    stdin.close()
+
+    wanted = set(names)
+    local = {}
+    nbytes = 0
+    try:
+        with tarfile.open(fileobj=stdout, mode='r' + mode) as tf:
+            for member in tf:
+                # only ever write the regular files we asked for
+                if not member.isfile() or member.name not in wanted:
+                    continue
+                dest = os.path.join(localdir, member.name)
+                source = tf.extractfile(member)
+                with open(dest + '.part', 'wb') as f:
+                    hashing = _Hashing(f)
+                    for block in iter(lambda: source.read(1 << 20), b''):
+                        hashing.write(block)
+                local[member.name] = hashing.hexdigest()
+                if not verify:
+                    os.rename(dest + '.part', dest)
+                nbytes += member.size
+
+        _check_exit(stdout.channel, stderr, 'remote tar create')
+
+        if len(local) != len(wanted):
+            raise IOError("tar stream from {} held {} of {} files".format(
+                remotedir, len(local), len(wanted)))
+    except Exception as e:
+        _wasted(e, nbytes)
+        raise
+
+    if verify:
+        digests = [hasher.result(t) for t in tickets]
+        bad = _mismatched(local, dict(zip(names, digests)))
+        for name in names:
+            dest = os.path.join(localdir, name)
+            if name in bad:
+                if stats is not None:
+                    stats.add_retry(os.path.getsize(dest + '.part'))
+                os.remove(dest + '.part')
+                get(session, os.path.join(remotedir, name), dest, stats=stats)
+            else:
+                os.rename(dest + '.part', dest)
+
+    if stats is not None:
+        stats.add(nbytes, time.time() - t0, files=len(local))
+
+
+#: ways of populating a directory from another on the same resource
+POPULATE_METHODS = ('auto', 'reflink', 'hardlink', 'symlink', 'copy')
+
+#: extensions of inputs MD only ever reads, and so may share with the source
+READ_ONLY_EXTS = ('.tpr', '.top', '.itp', '.mdp', '.ndx')
+
+# ioctl request number of Linux's FICLONE
+_FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    """Copy-on-write clone of `src` at `dest`; raises OSError if the
+    filesystem cannot share extents between the two."""
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            fdest.close()
+            os.remove(dest)
+            raise
+
+
+def same_filesystem(a, b):
+    """True if directories `a` and `b` live on the same device."""
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def _shareable(path):
+    """True if `path` may be linked into a rundir rather than copied."""
+    return path.endswith(READ_ONLY_EXTS) and os.stat(path).st_nlink == 1
+
+
+def populate(srcdir, destdir, names, method='auto', workers=4):
+    """Place files `names` from `srcdir` into `destdir`.
+
+    Parameters
+    ----------
+    method : {'auto', 'reflink', 'hardlink', 'symlink', 'copy'}
+        'auto' tries a reflink, then a hardlink when both directories are on
+        the same filesystem, and copies otherwise. Any method that fails for
+        a file falls back to copying it. Hardlinks and symlinks share the
+        source's contents, so are only used for inputs MD never writes
+        (:data:`READ_ONLY_EXTS`) whose source has no other links; anything
+        else MD rewrote or appended to in place would change the source,
+        and whatever else shares it.
+    workers : int
+        Number of files copied in parallel.
+
+    Returns
+    -------
+    dict
+        Count of files placed by each method actually used.
+
+    """
+    import shutil
+    from multiprocessing.pool import ThreadPool
+
+    if method not in POPULATE_METHODS:
+        raise ValueError("Unknown population method `{}`; choose from "
+                         "{}".format(method, POPULATE_METHODS))
+
+    if method == 'auto':
+        order = (['reflink', 'hardlink'] if same_filesystem(srcdir, destdir)
+                 else [])
+    elif method == 'copy':
+        order = []
+    else:
+        order = [method]
+
+    def place(name):
+        src = os.path.join(srcdir, name)
+        dest = os.path.join(destdir, name)
+
+        # rerunning on an existing rundir; links fail on existing targets
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+        for how in order:
+            if how != 'reflink' and not _shareable(src):
+                continue
+            try:
+                if how == 'reflink':
+                    reflink(src, dest)
+                elif how == 'hardlink':
+                    os.link(src, dest)
+                else:
+                    os.symlink(src, dest)
+                return how
+            except (IOError, OSError):
+                continue
+
+        shutil.copy(src, dest)
+        return 'copy'
+
+    workers = ThreadPool(max(1, min(workers, len(names) or 1)))
+    try:
+        used = workers.map(place, names)
+    finally:
+        workers.close()
+        workers.join()
+
+    return {how: used.count(how) for how in set(used)}
+
+
+def get_tail(session, remotepath, localpath, offset, stats=None,
+             verify=True):
+    """Append the bytes of `remotepath` past `offset` to `localpath`.
+
+    Used when `localpath` already holds the first `offset` bytes of the
+    remote file, e.g. after a :class:`LiveSyncer` streamed them, and
+    verified them as it did.
+
+    With `verify`, the tail is hashed as it arrives while the remote side
+    hashes the same bytes, and fetched again if the two differ;
+    :class:`IntegrityError` is raised if they keep differing.
+
+    """
+    import time
+
+    t0 = time.time()
+    size = session.sftp.stat(remotepath).st_size
+    if os.path.getsize(localpath) != offset or size < offset:
+        raise IOError("{} is not a prefix of {}".format(localpath, remotepath))
+
+    tail = [(0, offset, size - offset)]
+    local = {}
+    remote = {}
+    if verify:
+        hasher = _hasher(session)
+        remote[0], = hasher.queue([(remotepath, offset, size - offset)])
+
+    def fetch(todo):
+        h = hashlib.new(HASH)
+        got = 0
+        try:
+            with session.sftp.open(remotepath, 'rb') as rf, \
+                    open(localpath, 'r+b') as lf:
+                # drop whatever an earlier attempt appended
+                lf.truncate(offset)
+                lf.seek(offset)
+                rf.seek(offset)
+                rf.prefetch(size)
+                while got < size - offset:
+                    data = rf.read(min(1 << 20, size - offset - got))
+                    if not data:
+                        raise IOError("{} shrank while fetched".format(
+                            remotepath))
+                    lf.write(data)
+                    h.update(data)
+                    got += len(data)
+        except Exception as e:
+            _wasted(e, got)
+            raise
+        local[0] = h.hexdigest()
+
+    if verify:
+        _verify_loop(fetch, tail, tail, local, remote, hasher, stats,
+                     remotepath)
+    else:
+        fetch(tail)
+
+    if stats is not None:
+        stats.add(size - offset, time.time() - t0, resumed=offset)
+
+
+#: extensions of files GROMACS only ever appends to
+APPEND_EXTS = ('.xtc', '.trr', '.edr', '.log')
+
+#: name of the journal a LiveSyncer leaves in the directory it syncs
+SYNC_JOURNAL = '.mdworks-sync.json'
+
+
+class LiveSyncer(object):
+    """Background thread streaming a running simulation's outputs back.
+
+    Every `interval` seconds, newly appended bytes of trajectory, energy
+    and log files are appended to their copies in `dest`, and any other
+    file that changed (e.g. checkpoints) is uploaded whole and atomically
+    swapped in once it has not been modified for `settle` seconds.
+
+    Only files changed since :meth:`start` are sent. An appended file whose
+    copy in `dest` is a prefix of it, as left by pulling an earlier leg run
+    with ``-append``, gets only the bytes past that copy.
+
+    After each round a :data:`SYNC_JOURNAL` in `rundir` records how many
+    bytes of each appended file `dest` holds, so that a later pull can
+    fetch only the remaining tail.
+
+    With `verify`, whole files are verified as by :func:`put`, and appended
+    bytes are hashed as they are sent and compared with the remote side's
+    digest of them once written; bytes that differ are sent again, and a
+    round whose bytes keep differing fails, to be redone by the next.
+
+    Parameters
+    ----------
+    rundir : str
+        Local directory the simulation writes to.
+    server, user : str
+        Host holding `dest`, and the user to log in as.
+    dest : str
+        Directory on `server` to sync into.
+    key_filename : str
+        Optional SSH key location.
+    interval : float
+        Seconds between sync rounds.
+    settle : float
+        Seconds a non-appended file must be unmodified before it is sent.
+    idle_stop : float
+        Stop on our own if nothing in `rundir` changed for this long, in
+        case the task that should stop us never runs.
+    verify : bool
+        Check what arrived against digests taken by the remote side.
+
+    """
+    def __init__(self, rundir, server, user, dest, key_filename=None,
+                 interval=300, settle=5, idle_stop=3600, verify=True):
+        import threading
+
+        self.rundir = rundir
+        self.server = server
+        self.user = user
+        self.dest = dest
+        self.key_filename = key_filename
+        self.interval = interval
+        self.settle = settle
+        self.idle_stop = idle_stop
+        self.verify = verify
+
+        self.stats = TransferStats()
+        self.synced = {}     # name -> (size, mtime) last sent
+        self.prefixes = {}   # name -> bytes of an appended file held in dest
+        self.last_change = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        import time
+
+        # only what changes once MD runs is sent; whatever is in the rundir
+        # now, such as staged inputs, came from the archive
+        for name in os.listdir(self.rundir):
+            path = os.path.join(self.rundir, name)
+            if os.path.isfile(path):
+                st = os.stat(path)
+                self.synced[name] = (st.st_size, st.st_mtime)
+
+        self.last_change = time.time()
+        self._thread.start()
+
+    def stop(self, final=True):
+        """Stop the thread; by default do one last sync round."""
+        self._stop.set()
+        self._thread.join()
+        if final:
+            self.sync()
+
+    def _run(self):
+        import time
+        import traceback
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except Exception:
+                # a failed round is retried next interval
+                traceback.print_exc()
+            if time.time() - self.last_change > self.idle_stop:
+                break
+
+    def _changed(self):
+        import time
+
+        now = time.time()
+        changed = []
+        for name in sorted(os.listdir(self.rundir)):
+            path = os.path.join(self.rundir, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            if self.synced.get(name) == (st.st_size, st.st_mtime):
+                continue
+            if (not name.endswith(APPEND_EXTS)
+                    and now - st.st_mtime < self.settle):
+                continue
+            changed.append((name, st))
+        return changed
+
+    def sync(self):
+        """Run one sync round."""
+        import time
+        from .ssh import get_pool
+
+        changed = self._changed()
+        if not changed:
+            return
+        self.last_change = time.time()
+
+        with get_pool().session(self.server, self.user,
+                                self.key_filename) as session:
+            for name, st in changed:
+                src = os.path.join(self.rundir, name)
+                dest = os.path.join(self.dest, name)
+                offset = self.prefixes.get(name)
+
+                if not name.endswith(APPEND_EXTS):
+                    put(session, src, dest + '.sync', stats=self.stats,
+                        verify=self.verify)
+                    rrename(session.sftp, dest + '.sync', dest)
+                else:
+                    if offset is None:
+                        # first sight of this file; with -append, the
+                        # archive holds it up to where the last leg ended
+                        offset = self._archived_prefix(session, src, dest,
+                                                       st.st_size)
+                    elif (st.st_size < offset or
+                            session.sftp.stat(dest).st_size != offset):
+                        # our copy was touched
+                        offset = None
+
+                    if offset is not None:
+                        self._send_range(session, src, dest, offset,
+                                         st.st_size)
+                    else:
+                        # copy up to the size seen, then swap it in
+                        self._send_range(session, src, dest + '.sync', 0,
+                                         st.st_size)
+                        rrename(session.sftp, dest + '.sync', dest)
+                    self.prefixes[name] = st.st_size
+
+                self.synced[name] = (st.st_size, st.st_mtime)
+
+        tmp = os.path.join(self.rundir, SYNC_JOURNAL + '.part')
+        with open(tmp, 'w') as f:
+            json.dump(self.prefixes, f)
+        os.rename(tmp, os.path.join(self.rundir, SYNC_JOURNAL))
+
+    def _archived_prefix(self, session, src, dest, size):
+        """Bytes of `src` already held by remote `dest`, if that is a prefix
+        of the first `size` bytes of `src`, else None.
+
+        Only the last block of `dest` is compared with `src`, which is
+        enough to tell an earlier leg's copy from an unrelated file.
+
+        """
+        try:
+            held = session.sftp.stat(dest).st_size
+        except IOError:
+            return None
+        if held > size:
+            return None
+
+        n = min(held, 1 << 16)
+        with open(src, 'rb') as lf, session.sftp.open(dest, 'rb') as rf:
+            lf.seek(held - n)
+            rf.seek(held - n)
+            if lf.read(n) != rf.read(n):
+                return None
+        return held
+
+    def _send_range(self, session, src, dest, offset, size):
+        """Write bytes `offset` to `size` of `src` at the same place in
+        remote `dest`; a zero `offset` starts `dest` afresh."""
+        import time
+
+        t0 = time.time()
+        span = [(0, offset, size - offset)]
+        local = {}
+        remote = {}
+        hasher = _hasher(session) if self.verify else None
+
+        def send(todo):
+            h = hashlib.new(HASH)
+            with open(src, 'rb') as lf, \
+                    session.sftp.open(dest, 'r+b' if offset else 'wb') as rf:
+                rf.set_pipelined(True)
+                lf.seek(offset)
+                rf.seek(offset)
+                for position in range(offset, size, 1 << 20):
+                    data = lf.read(min(1 << 20, size - position))
+                    rf.write(data)
+                    h.update(data)
+            local[0] = h.hexdigest()
+            if hasher is not None:
+                remote[0], = hasher.queue([(dest, offset, size - offset)])
+
+        if hasher is None:
+            send(span)
+        else:
+            _verify_loop(send, span, span, local, remote, hasher, self.stats,
+                         src)
+
+        self.stats.add(size - offset, time.time() - t0, resumed=offset)
+
+
+#: suffix of directories set aside for deletion in the background
+TRASH = '.mdworks-trash-'
+
+
+def remove_tree_exec(session, path, background=False):
+    """Recursively remove remote `path` with a single ``rm -rf``.
+
+    With `background`, `path` is only renamed aside before returning, and
+    removed by a detached remote process; anything set aside earlier and
+    not yet removed is swept up too. Requires that the remote account can
+    execute commands.
+
+    """
+    import uuid
+    from six.moves import shlex_quote
+
+    quoted = shlex_quote(path)
+    if background:
+        trash = shlex_quote(path + TRASH + uuid.uuid4().hex[:8])
+        command = ('if [ -e {0} ]; then mv -- {0} {1}; fi && '
+                   '(nohup rm -rf -- {0}{2}* < /dev/null > /dev/null 2>&1 &)'
+                   ).format(quoted, trash, TRASH)
+    else:
+        command = 'rm -rf -- {}'.format(quoted)
+
+    stdin, stdout, stderr = session.ssh.exec_command(command)
+    stdin.close()
+    _check_exit(stdout.channel, stderr, 'remote rm')
+
+
+def remove_tree_sftp(session, path, workers=4):
+    """Recursively remove remote `path` over SFTP.
+
+    Directories are listed one round trip each; files are then removed
+    over up to `workers` parallel channels, and directories deepest first.
+
+    """
+    import stat as stat_
+
+    sftp = session.sftp
+    if not stat_.S_ISDIR(sftp.lstat(path).st_mode):
+        sftp.remove(path)
+        return
+
+    files = []
+    dirs = [path]
+    i = 0
+    while i < len(dirs):
+        for a in sftp.listdir_attr(dirs[i]):
+            child = os.path.join(dirs[i], a.filename)
+            if stat_.S_ISDIR(a.st_mode or 0):
+                dirs.append(child)
+            else:
+                files.append(child)
+        i += 1
+
+    def work(channel, mine):
+        for f in mine:
+            channel.remove(f)
+
+    if files:
+        _run_streams(session, files, workers, work)
+
+    for d in reversed(dirs):
+        sftp.rmdir(d)
+
+
+def set_aside(session, path):
+    """Rename remote `path` out of the way; returns the new name, or None
+    if `path` does not exist."""
+    import uuid
+
+    trash = path + TRASH + uuid.uuid4().hex[:8]
+    try:
+        session.sftp.rename(path, trash)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return trash
+
+
+#: name of the content-addressed cache kept in each staging directory
+CACHE = '.mdworks-cache'
+
+#: times entries evicted between checking the cache and copying from it are
+#: uploaded again before giving up
+CACHE_ROUNDS = 3
+
+
+class RemoteCache(object):
+    """Content-addressed store of staged files on one remote resource.
+
+    Each file is kept once, named by its content digest, and copied into the
+    staging directories that need it; identical inputs across an ensemble
+    are then sent once per resource. Copies are reflinks where the
+    filesystem supports them, so they take no extra space until written, but
+    never share an inode with the cache: MD rewriting a staged file in place
+    cannot change the entry, or another Sim's copy of it.
+
+    Uploads land in an ``.incoming`` subdirectory under a name unique to the
+    uploading task, and are moved into place once complete without replacing
+    an entry another task put there first, so no entry is ever seen
+    half-written.
+
+    Parameters
+    ----------
+    directory : str
+        Absolute path of the cache on the remote resource; should be on the
+        same filesystem as the staging directories for reflinks to work.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.incoming = os.path.join(directory, '.incoming')
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    @staticmethod
+    def incoming_name(digest, token):
+        """Name in ``.incoming`` of `digest` as uploaded by the task with
+        unique `token`."""
+        return '{}.{}'.format(digest, token)
+
+    def missing(self, sftp, digests):
+        """Those of `digests` not in the cache yet, in one round trip."""
+        try:
+            present = set(sftp.listdir(self.directory))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            sftp.mkdir(self.directory)
+            present = set()
+
+        if '.incoming' not in present:
+            try:
+                sftp.mkdir(self.incoming)
+            except IOError:
+                # another task got there first
+                pass
+
+        return sorted(set(digests) - present)
+
+    def place(self, session, uploaded, copies, token):
+        """Move the `uploaded` digests from ``.incoming`` into the cache,
+        then copy entries to their destinations.
+
+        All of it runs as one remote shell script, so requires that the
+        account can execute commands; over SFTP alone, a copy would have to
+        travel to the client and back.
+
+        Parameters
+        ----------
+        uploaded : list
+            Digests just uploaded to ``.incoming`` with :meth:`incoming_name`
+            and `token`. Where another task moved the same digest into the
+            cache first, the upload is dropped instead.
+        copies : list
+            ``(digest, remotepath)`` pairs. Existing files at `remotepath`
+            are replaced, never written to, since they may be hardlinks left
+            by an older cache. Each copied entry counts as freshly used.
+
+        Returns
+        -------
+        list
+            Digests that could not be copied because they are no longer in
+            the cache, e.g. evicted by another task since :meth:`missing`.
+
+        """
+        from six.moves import shlex_quote
+
+        lines = ['set -e', 'cd {}'.format(shlex_quote(self.directory))]
+        for digest in uploaded:
+            # ln never replaces an existing entry
+            lines.append('if [ -e .incoming/{1} ]; then '
+                         'ln .incoming/{1} {0} 2>/dev/null || :; '
+                         'rm -f .incoming/{1}; fi'.format(
+                             digest, self.incoming_name(digest, token)))
+        for digest, dest in copies:
+            part = shlex_quote(dest + '.part')
+            lines.append('if cp --reflink=auto -- {0} {1} 2>/dev/null || '
+                         'cp -- {0} {1} 2>/dev/null; then '
+                         'mv -f -- {1} {2}; touch -c -- {0}; '
+                         'else rm -f -- {1}; echo {0}; fi'.format(
+                             digest, part, shlex_quote(dest)))
+
+        stdin, stdout, stderr = session.ssh.exec_command('sh')
+        stdin.write('\n'.join(lines).encode('utf-8') + b'\n')
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode('utf-8', 'replace')
+        _check_exit(stdout.channel, stderr, 'remote cache copy')
+
+        return self._gone(session.sftp, output.split())
+
+    def unload(self, sftp, uploaded, token):
+        """Move uploads out of ``.incoming`` straight to where their entries
+        were to be copied, for when :meth:`place` cannot run.
+
+        Parameters
+        ----------
+        uploaded : dict
+            Remote paths by the digests uploaded with `token`.
+
+        Returns
+        -------
+        list
+            Digests whose uploads were moved.
+
+        """
+        moved = []
+        for digest, dest in uploaded.items():
+            try:
+                rrename(sftp, os.path.join(self.incoming,
+                                           self.incoming_name(digest, token)),
+                        dest)
+            except IOError:
+                # never made it, or already moved into the cache
+                continue
+            moved.append(digest)
+        return moved
+
+    def _gone(self, sftp, failed):
+        """Those of `failed` digests that are missing from the cache; raises
+        if any others failed to copy."""
+        if not failed:
+            return []
+        gone = self.missing(sftp, failed)
+        if len(gone) < len(set(failed)):
+            raise IOError("Copying from cache {} failed for {}".format(
+                self.directory, sorted(set(failed) - set(gone))))
+        return gone
+
+    def evict(self, sftp, max_bytes=None, max_age=None,
+              incoming_max_age=24 * 3600):
+        """Drop entries unused for `max_age` seconds, then the least recently
+        used ones until the cache holds at most `max_bytes`.
+
+        Uploads left in ``.incoming`` by tasks that died are removed once
+        untouched for `incoming_max_age` seconds.
+
+        Returns
+        -------
+        files, nbytes : int
+            Number and total size of the entries evicted.
+
+        """
+        import time
+
+        now = time.time()
+        try:
+            stale = [a.filename for a in sftp.listdir_attr(self.incoming)
+                     if now - a.st_mtime > incoming_max_age]
+        except IOError:
+            stale = []
+        for name in stale:
+            try:
+                sftp.remove(os.path.join(self.incoming, name))
+            except IOError:
+                # removed concurrently by another task
+                pass
+
+        entries = sorted((a for a in sftp.listdir_attr(self.directory)
+                          if stat.S_ISREG(a.st_mode or 0)),
+                         key=lambda a: a.st_mtime)
+        total = sum(a.st_size for a in entries)
+
+        files = nbytes = 0
+        for a in entries:
+            if not ((max_age is not None and now - a.st_mtime > max_age) or
+                    (max_bytes is not None and total > max_bytes)):
+                break
+            try:
+                sftp.remove(self.path(a.filename))
+            except IOError:
+                # evicted concurrently by another task
+                continue
+            total -= a.st_size
+            files += 1
+            nbytes += a.st_size
+
+        return files, nbytes
@@ -0,0 +1,45 @@
+"""Fixtures shared by the tests: an in-process SSH/SFTP stand-in for a
+remote resource, and pooled sessions to it.
+
+"""
+import os
+import sys
+
+import pytest
+
+# test the checkout, whether or not mdworks is installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sftp_standin import Standin  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def standin():
+    """A running stand-in, with the process-wide pool trusting its key."""
+    from mdworks.ssh import configure_pool
+
+    standin = Standin().start()
+    pool = configure_pool(known_hosts=standin.known_hosts)
+    yield standin
+    pool.close_all()
+    standin.stop()
+
+
+@pytest.fixture
+def session(standin):
+    """A pooled session to the stand-in."""
+    from mdworks.ssh import get_pool
+
+    with get_pool().session(standin.server, 'mdworks',
+                            standin.key_filename) as session:
+        yield session
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    """Empty local and 'remote' directories; the stand-in serves the local
+    filesystem, so both are paths under pytest's temporary directory."""
+    local, remote = tmp_path / 'local', tmp_path / 'remote'
+    local.mkdir()
+    remote.mkdir()
+    return str(local), str(remote)
@@ -0,0 +1,374 @@
+"""In-process SSH/SFTP server on localhost standing in for a remote resource.
+
+Serves the local filesystem over SFTP, and runs exec requests with the
+local shell, behind a proxy that adds a fixed latency to every packet in
+each direction and limits the bandwidth of each direction of each
+connection. Counts SFTP requests, exec channels, connections and bytes
+moved, so benchmarks can report round trips alongside wall time.
+
+Used by the tests and ``benchmarks/bench_transfer.py``; start one with::
+
+    standin = Standin(latency=0.02, bandwidth=50e6)
+    standin.start()
+    ... connect to standin.server ('127.0.0.1:<port>') as any user,
+        with standin.key_filename and standin.known_hosts ...
+    standin.stop()
+
+"""
+from __future__ import print_function
+
+import os
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+
+import paramiko
+from paramiko import (SFTPServer, SFTPServerInterface, SFTPAttributes,
+                      SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL, AUTH_FAILED,
+                      OPEN_SUCCEEDED)
+from six.moves import queue
+
+
+class Counters(object):
+    """Tally of what clients asked of the stand-in."""
+    FIELDS = ('connections', 'requests', 'exec', 'bytes_up', 'bytes_down')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, field, n=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def snapshot(self):
+        with self._lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def _errno(e):
+    return SFTPServer.convert_errno(e.errno)
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return _errno(e)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class _Filesystem(SFTPServerInterface):
+    """The local filesystem, as is."""
+    def list_folder(self, path):
+        try:
+            attrs = []
+            for name in os.listdir(path):
+                a = SFTPAttributes.from_stat(
+                        os.lstat(os.path.join(path, name)))
+                a.filename = name
+                attrs.append(a)
+            return attrs
+        except OSError as e:
+            return _errno(e)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return _errno(e)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return _errno(e)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return _errno(e)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return _errno(e)
+        return SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def symlink(self, target, path):
+        return self._call(os.symlink, target, path)
+
+    def chattr(self, path, attr):
+        if attr.st_atime is not None and attr.st_mtime is not None:
+            return self._call(os.utime, path, (attr.st_atime, attr.st_mtime))
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if os.path.isabs(path) else '/' + path)
+
+
+def _counting_sftp_server(counters):
+    class CountingSFTPServer(SFTPServer):
+        def _process(self, t, request_number, msg):
+            counters.add('requests')
+            return SFTPServer._process(self, t, request_number, msg)
+    return CountingSFTPServer
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, counters, allow_exec):
+        self.counters = counters
+        self.allow_exec = allow_exec
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        if not self.allow_exec:
+            return False
+        self.counters.add('exec')
+        threading.Thread(target=_run_exec, args=(channel, command)).start()
+        return True
+
+
+def _run_exec(channel, command):
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        try:
+            while True:
+                data = channel.recv(1 << 16)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                # as sshd does, hand data on as it comes
+                proc.stdin.flush()
+        except Exception:
+            pass
+        finally:
+            proc.stdin.close()
+
+    def drain_stderr():
+        err = proc.stderr.read()
+        if err:
+            channel.sendall_stderr(err)
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    errors = threading.Thread(target=drain_stderr)
+    errors.start()
+
+    try:
+        for data in iter(lambda: proc.stdout.read(1 << 16), b''):
+            channel.sendall(data)
+        errors.join()
+        channel.send_exit_status(proc.wait())
+    finally:
+        channel.close()
+
+
+class _Link(object):
+    """One direction of a proxied connection: data arrives `latency` seconds
+    after it was sent, and leaves no faster than `bandwidth` bytes/s."""
+    def __init__(self, src, dst, latency, bandwidth, counters, field):
+        self.src = src
+        self.dst = dst
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.counters = counters
+        self.field = field
+        self.queue = queue.Queue()
+
+    def start(self):
+        for target in (self._receive, self._send):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _receive(self):
+        free = 0.
+        while True:
+            try:
+                data = self.src.recv(1 << 16)
+            except socket.error:
+                data = b''
+            now = time.time()
+            if data and self.bandwidth:
+                # data is serialized onto the link one piece after another
+                free = max(free, now) + len(data) / self.bandwidth
+                due = free + self.latency
+            else:
+                due = now + self.latency
+            self.queue.put((due, data))
+            if not data:
+                return
+
+    def _send(self):
+        while True:
+            due, data = self.queue.get()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if not data:
+                try:
+                    self.dst.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                return
+            try:
+                self.dst.sendall(data)
+            except socket.error:
+                return
+            self.counters.add(self.field, len(data))
+
+
+class Standin(object):
+    """SSH/SFTP stand-in for a remote resource.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds added to every packet in each direction; a round trip takes
+        twice this.
+    bandwidth : float
+        Bytes per second each direction of each connection carries; None for
+        no limit.
+    allow_exec : bool
+        Whether exec channels (``tar``, ``rm -rf``, ``md5sum``, ...) are
+        allowed, as on an ordinary shell account; without, only SFTP works.
+
+    """
+    def __init__(self, latency=0., bandwidth=None, allow_exec=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.allow_exec = allow_exec
+        self.counters = Counters()
+        self._sockets = []
+        self._transports = []
+        self._tmpdir = None
+
+    @property
+    def server(self):
+        """``host:port`` clients connect to."""
+        return '127.0.0.1:{}'.format(self._proxy.getsockname()[1])
+
+    def start(self):
+        self._tmpdir = tempfile.mkdtemp(prefix='mdworks-standin-')
+        self.host_key = paramiko.RSAKey.generate(2048)
+        client_key = paramiko.RSAKey.generate(2048)
+        self.key_filename = os.path.join(self._tmpdir, 'id_rsa')
+        client_key.write_private_key_file(self.key_filename)
+
+        self._sshd = self._listen()
+        self._proxy = self._listen()
+        self.known_hosts = os.path.join(self._tmpdir, 'known_hosts')
+        with open(self.known_hosts, 'w') as f:
+            f.write('[127.0.0.1]:{} {} {}\n'.format(
+                self._proxy.getsockname()[1], self.host_key.get_name(),
+                self.host_key.get_base64()))
+
+        for target in (self._serve_ssh, self._serve_proxy):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        import shutil
+
+        for transport in self._transports:
+            transport.close()
+        for sock in self._sockets:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _listen(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        self._sockets.append(sock)
+        return sock
+
+    def _accept(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except socket.error:
+            return None
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sockets.append(conn)
+        return conn
+
+    def _serve_ssh(self):
+        sftp_server = _counting_sftp_server(self.counters)
+        while True:
+            conn = self._accept(self._sshd)
+            if conn is None:
+                return
+            transport = paramiko.Transport(conn)
+            self._transports.append(transport)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', sftp_server, _Filesystem)
+            transport.start_server(server=_Server(self.counters,
+                                                  self.allow_exec))
+
+    def _serve_proxy(self):
+        while True:
+            client = self._accept(self._proxy)
+            if client is None:
+                return
+            self.counters.add('connections')
+            upstream = socket.create_connection(self._sshd.getsockname())
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sockets.append(upstream)
+            _Link(client, upstream, self.latency, self.bandwidth,
+                  self.counters, 'bytes_up').start()
+            _Link(upstream, client, self.latency, self.bandwidth,
+                  self.counters, 'bytes_down').start()
@@ -0,0 +1,115 @@
+"""FireTasks moving files, against the in-process SFTP stand-in."""
+import os
+
+import pytest
+
+from mdworks import transfer
+from mdworks.firetasks import StagingTask, CleanupTask
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def inputs(dirs):
+    local, _ = dirs
+    files = {'md.gro': b'shared starting coords\n' * 100,
+             'topol.tpr': b'shared run input\n' * 100}
+    for name, data in files.items():
+        _write(os.path.join(local, name), data)
+    return [os.path.join(local, name) for name in sorted(files)]
+
+
+def _stage(standin, staging, files, uuid, **params):
+    task = StagingTask(stages=[{'server': standin.server, 'user': 'mdworks',
+                                'staging': staging}],
+                       files=files, uuid=uuid,
+                       key_filename=standin.key_filename, host_interval=0,
+                       **params)
+    return task.run_task({}).stored_data
+
+
+def test_cached_copies_share_nothing(standin, dirs, inputs):
+    _, staging = dirs
+    _stage(standin, staging, inputs, 'a', cache=True)
+    stored = _stage(standin, staging, inputs, 'b', cache=True)
+    assert stored['transfer_b']['cached_files'] == 2
+    assert stored['transfer_b']['bytes'] == 0
+
+    a, b = (os.path.join(staging, uuid, 'md.gro') for uuid in 'ab')
+    entry = os.path.join(staging, transfer.CACHE,
+                         transfer.file_digest(inputs[0]))
+    assert len({os.stat(p).st_ino for p in (a, b, entry)}) == 3
+
+    # mdrun writing its final coordinates over the staged ones
+    with open(a, 'r+b') as f:
+        f.write(b'sim a final coords\n')
+    assert _read(b) == _read(entry) == _read(inputs[0])
+
+
+def test_cache_falls_back_to_direct_uploads(standin, dirs, inputs,
+                                            monkeypatch):
+    def place(*args):
+        raise IOError("no shell access")
+
+    monkeypatch.setattr(transfer.RemoteCache, 'place', place)
+
+    _, staging = dirs
+    stored = _stage(standin, staging, inputs, 'a', cache=True)
+
+    record, = stored['metrics_staging_a']
+    assert record['cache_fallback'] is True
+    # uploads meant for the cache are moved into place, not sent again
+    assert record['bytes'] == sum(os.path.getsize(p) for p in inputs)
+    for path in inputs:
+        assert _read(os.path.join(staging, 'a',
+                                  os.path.basename(path))) == _read(path)
+    assert os.listdir(os.path.join(staging, transfer.CACHE,
+                                   '.incoming')) == []
+
+
+def _rundir(remote, name='rundir'):
+    rundir = os.path.join(remote, name)
+    os.makedirs(os.path.join(rundir, 'sub'))
+    for path in ('md.xtc', 'sub/md.log'):
+        _write(os.path.join(rundir, path), b'output\n')
+    return rundir
+
+
+def _cleanup(standin, rundir, **params):
+    task = CleanupTask(uuid='a', key_filename=standin.key_filename, **params)
+    spec = {'server': standin.server, 'user': 'mdworks', 'files': [rundir]}
+    record, = task.run_task(spec).stored_data['metrics_cleanup_a']
+    return record
+
+
+@pytest.mark.parametrize('mode', ['auto', 'exec', 'sftp'])
+def test_cleanup(standin, dirs, mode):
+    _, remote = dirs
+    rundir = _rundir(remote)
+
+    record = _cleanup(standin, rundir, mode=mode)
+
+    assert not os.path.exists(rundir)
+    assert record['methods'] == {'sftp' if mode == 'sftp' else 'exec': 1}
+
+
+def test_cleanup_records_fallback(standin, dirs, monkeypatch):
+    def remove_tree_exec(*args, **kwargs):
+        raise IOError("no shell access")
+
+    monkeypatch.setattr(transfer, 'remove_tree_exec', remove_tree_exec)
+    _, remote = dirs
+    rundir = _rundir(remote)
+
+    record = _cleanup(standin, rundir)
+
+    assert not os.path.exists(rundir)
+    assert record['methods'] == {'sftp': 1}
@@ -0,0 +1,275 @@
+"""Transfer engine against the in-process SFTP stand-in.
+
+The stand-in serves the local filesystem, so remote paths here are paths in
+pytest's temporary directories.
+
+"""
+import os
+import json
+
+import pytest
+
+from mdworks import transfer
+from mdworks.transfer import TransferStats, IntegrityError
+
+CHUNK = 64 << 10
+
+
+def _write(path, size, seed=0):
+    data = bytes(bytearray((seed + i * 7 + (i >> 9)) % 251
+                           for i in range(size)))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _corrupting(monkeypatch, data, times):
+    """Make the remote digest of chunk or file contents `data` look wrong
+    for the next `times` comparisons."""
+    result = transfer._RemoteDigests.result
+    digest = transfer._digest(data)
+    left = [times]
+
+    def corrupt(self):
+        digests = result(self)
+        if digests is not None and digest in digests and left[0] > 0:
+            left[0] -= 1
+            digests[digests.index(digest)] = '0' * len(digest)
+        return digests
+
+    monkeypatch.setattr(transfer._RemoteDigests, 'result', corrupt)
+
+
+@pytest.mark.parametrize('size', [1000, 5 * CHUNK + 123])
+@pytest.mark.parametrize('streams', [1, 3])
+@pytest.mark.parametrize('verify', [True, False])
+def test_round_trip(session, dirs, size, streams, verify):
+    local, remote = dirs
+    data = _write(os.path.join(local, 'a.xtc'), size)
+    opts = dict(streams=streams, chunk_size=CHUNK, threshold=2 * CHUNK,
+                verify=verify)
+
+    up, down = TransferStats(), TransferStats()
+    transfer.put(session, os.path.join(local, 'a.xtc'),
+                 os.path.join(remote, 'a.xtc'), stats=up, **opts)
+    transfer.get(session, os.path.join(remote, 'a.xtc'),
+                 os.path.join(local, 'b.xtc'), stats=down, **opts)
+
+    assert _read(os.path.join(remote, 'a.xtc')) == data
+    assert _read(os.path.join(local, 'b.xtc')) == data
+    assert up.bytes == down.bytes == size
+    assert up.retries == down.retries == 0
+    assert sorted(os.listdir(remote)) == ['a.xtc']
+    assert sorted(os.listdir(local)) == ['a.xtc', 'b.xtc']
+
+
+def _partial(path, data, done, mtime):
+    """Leave `path`.part holding chunks `done` of `data`, as an interrupted
+    transfer would, with its journal."""
+    with open(path + '.part', 'wb') as f:
+        f.truncate(len(data))
+        for i in done:
+            f.seek(i * CHUNK)
+            f.write(data[i * CHUNK:(i + 1) * CHUNK])
+    journal = transfer._Journal(path + '.part.json', len(data), mtime, CHUNK)
+    journal.done = set(done)
+    journal.save(open)
+
+
+@pytest.mark.parametrize('verify', [True, False])
+def test_get_resumes_from_part(session, dirs, verify):
+    local, remote = dirs
+    src, dest = os.path.join(remote, 'a.trr'), os.path.join(local, 'a.trr')
+    data = _write(src, 5 * CHUNK + 10)
+    _partial(dest, data, [0, 1, 3], os.stat(src).st_mtime)
+
+    stats = TransferStats()
+    transfer.get(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK, verify=verify)
+
+    assert _read(dest) == data
+    assert stats.resumed_bytes == 3 * CHUNK
+    assert stats.bytes == 2 * CHUNK + 10
+    assert not os.path.exists(dest + '.part.json')
+
+
+@pytest.mark.parametrize('verify', [True, False])
+def test_put_resumes_from_part(session, dirs, verify):
+    local, remote = dirs
+    src, dest = os.path.join(local, 'a.trr'), os.path.join(remote, 'a.trr')
+    data = _write(src, 5 * CHUNK + 10)
+    _partial(dest, data, [1, 2], os.stat(src).st_mtime)
+
+    stats = TransferStats()
+    transfer.put(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK, verify=verify)
+
+    assert _read(dest) == data
+    assert stats.resumed_bytes == 2 * CHUNK
+    assert stats.bytes == 3 * CHUNK + 10
+    assert sorted(os.listdir(remote)) == ['a.trr']
+
+
+def test_stale_journal_is_ignored(session, dirs):
+    local, remote = dirs
+    src, dest = os.path.join(remote, 'a.trr'), os.path.join(local, 'a.trr')
+    data = _write(src, 3 * CHUNK)
+    # journaled against an older version of the file
+    _partial(dest, b'\0' * len(data), [0, 1, 2], os.stat(src).st_mtime - 60)
+
+    stats = TransferStats()
+    transfer.get(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK, verify=False)
+
+    assert _read(dest) == data
+    assert stats.resumed_bytes == 0
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_batch_round_trip(session, dirs, compress):
+    local, remote = dirs
+    names = ['conf.gro', 'topol.top', 'md.mdp', 'empty.itp']
+    data = {name: _write(os.path.join(local, name),
+                         0 if name == 'empty.itp' else 1000 * (n + 1), n)
+            for n, name in enumerate(names)}
+    files = [os.path.join(local, name) for name in names]
+
+    up = TransferStats()
+    transfer.put_batch(session, files, os.path.join(remote, 'sub'),
+                       stats=up, compress=compress)
+    assert up.files == len(names)
+    for name in names:
+        assert _read(os.path.join(remote, 'sub', name)) == data[name]
+
+    back = os.path.join(local, 'back')
+    os.mkdir(back)
+    down = TransferStats()
+    transfer.get_batch(session, os.path.join(remote, 'sub'), names, back,
+                       stats=down, compress=compress)
+    assert down.files == len(names)
+    assert up.retries == down.retries == 0
+    assert sorted(os.listdir(back)) == sorted(names)
+    for name in names:
+        assert _read(os.path.join(back, name)) == data[name]
+
+
+def test_get_refetches_mismatched_chunk(session, dirs, monkeypatch):
+    local, remote = dirs
+    src, dest = os.path.join(remote, 'a.xtc'), os.path.join(local, 'a.xtc')
+    data = _write(src, 4 * CHUNK)
+    _corrupting(monkeypatch, data[2 * CHUNK:3 * CHUNK], times=1)
+
+    stats = TransferStats()
+    transfer.get(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK)
+
+    assert _read(dest) == data
+    assert stats.retries == 1
+    assert stats.wasted_bytes == CHUNK
+
+
+def test_put_resends_mismatched_chunk(session, dirs, monkeypatch):
+    local, remote = dirs
+    src, dest = os.path.join(local, 'a.xtc'), os.path.join(remote, 'a.xtc')
+    data = _write(src, 4 * CHUNK)
+    _corrupting(monkeypatch, data[CHUNK:2 * CHUNK], times=1)
+
+    stats = TransferStats()
+    transfer.put(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK)
+
+    assert _read(dest) == data
+    assert stats.retries == 1
+    assert stats.wasted_bytes == CHUNK
+
+
+def test_persistent_mismatch_raises_and_resumes(session, dirs, monkeypatch):
+    local, remote = dirs
+    src, dest = os.path.join(remote, 'a.xtc'), os.path.join(local, 'a.xtc')
+    data = _write(src, 4 * CHUNK)
+    _corrupting(monkeypatch, data[3 * CHUNK:],
+                times=transfer.VERIFY_RETRIES + 1)
+
+    with pytest.raises(IntegrityError) as error:
+        transfer.get(session, src, dest, chunk_size=CHUNK, threshold=CHUNK)
+    assert error.value.chunks == [3]
+    assert not os.path.exists(dest)
+    with open(dest + '.part.json') as f:
+        assert json.load(f)['done'] == [0, 1, 2]
+
+    # once the mismatch clears, only the chunk that differed is fetched again
+    stats = TransferStats()
+    transfer.get(session, src, dest, stats=stats, chunk_size=CHUNK,
+                 threshold=CHUNK)
+    assert _read(dest) == data
+    assert stats.bytes == CHUNK
+    assert stats.resumed_bytes == 3 * CHUNK
+
+
+def test_small_file_mismatch(session, dirs, monkeypatch):
+    local, remote = dirs
+    src, dest = os.path.join(local, 'md.mdp'), os.path.join(remote, 'md.mdp')
+    data = _write(src, 1000)
+    _corrupting(monkeypatch, data, times=transfer.VERIFY_RETRIES + 1)
+
+    with pytest.raises(IntegrityError):
+        transfer.put(session, src, dest)
+    assert not os.path.exists(dest)
+
+
+def test_batch_resends_mismatched_file(session, dirs, monkeypatch):
+    local, remote = dirs
+    names = ['conf.gro', 'topol.top', 'md.mdp']
+    data = {name: _write(os.path.join(local, name), 2000, n)
+            for n, name in enumerate(names)}
+    _corrupting(monkeypatch, data['topol.top'], times=1)
+
+    stats = TransferStats()
+    transfer.put_batch(session, [os.path.join(local, name) for name in names],
+                       remote, stats=stats)
+
+    assert stats.retries == 1
+    assert stats.wasted_bytes == 2000
+    for name in names:
+        assert _read(os.path.join(remote, name)) == data[name]
+
+    back = os.path.join(local, 'back')
+    os.mkdir(back)
+    _corrupting(monkeypatch, data['md.mdp'], times=1)
+    stats = TransferStats()
+    transfer.get_batch(session, remote, names, back, stats=stats)
+
+    assert stats.retries == 1
+    assert sorted(os.listdir(back)) == sorted(names)
+    for name in names:
+        assert _read(os.path.join(back, name)) == data[name]
+
+
+@pytest.mark.parametrize('method', ['auto', 'hardlink', 'symlink'])
+def test_populate_never_shares_what_md_writes(tmp_path, method):
+    staging, rundir = tmp_path / 'staging', tmp_path / 'rundir'
+    staging.mkdir()
+    rundir.mkdir()
+    names = ['md.gro', 'md.xtc', 'topol.tpr', 'shared.itp']
+    data = {name: _write(str(staging / name), 1000, n)
+            for n, name in enumerate(names)}
+    # e.g. a staged file that is itself a copy's link
+    os.link(str(staging / 'shared.itp'), str(tmp_path / 'elsewhere.itp'))
+
+    transfer.populate(str(staging), str(rundir), names, method=method)
+
+    for name in names:
+        with open(str(rundir / name), 'r+b') as f:
+            f.write(b'written by sim a')
+    for name in ('md.gro', 'md.xtc', 'shared.itp'):
+        assert _read(str(staging / name)) == data[name]
+        assert not os.path.islink(str(rundir / name))
+
+    # inputs MD only reads are still linked where asked to
+    if method != 'auto':
+        assert _read(str(staging / 'topol.tpr')) != data['topol.tpr']